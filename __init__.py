@@ -5,6 +5,7 @@
 from trytond.pool import Pool
 from .electronic_mail import *
 from .configuration import *
+from .smtp import *
 from .user import *
 
 def register():
@@ -13,6 +14,7 @@ def register():
         ElectronicMail,
         ElectronicMailConfiguration,
         ReadUser,
+        SMTPServer,
         User,
         WriteUser,
         module='electronic_mail', type_='model')
@@ -0,0 +1,807 @@
+# This file is part of electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Sending backend keeping many SMTP transactions in flight from one thread.
+
+It is written with asyncio protocols and callbacks, without coroutines, so
+the same code runs with asyncio and with trollius, its Python 2 backport.
+"""
+from StringIO import StringIO
+from base64 import b64encode
+from collections import deque
+from smtplib import (SMTPException, SMTPServerDisconnected,
+    SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError,
+    SMTPConnectError, SMTPHeloError, SMTPAuthenticationError, quoteaddr,
+    CRLF)
+from time import time
+from trytond.config import config
+from .metrics import metrics
+from .sender import SEND_SIZE, quote_data, smtp_pool
+import logging
+import socket
+import ssl
+import sys
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['AsyncDeliveryPool', 'use_asyncio']
+
+
+def use_asyncio(server):
+    """
+    Returns True if the emails to the smtp.server record must be sent with
+    the asyncio backend (smtp_backend option of the electronic_mail section)
+    """
+    if config.get('electronic_mail', 'smtp_backend',
+            default='thread') != 'asyncio':
+        return False
+    if asyncio is None:
+        logger.warning('Unable to import asyncio or trollius. '
+            'Emails are sent with threads.')
+        return False
+    if server.smtp_tls and not hasattr(asyncio.AbstractEventLoop,
+            'start_tls'):
+        logger.warning('The event loop does not support STARTTLS. '
+            'Emails to SMTP server %s are sent with threads.' % server.id)
+        return False
+    return True
+
+
+def _copy(source, target):
+    "Sets the outcome of the future source to target"
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _then(loop, future, callback):
+    """
+    Returns a future of callback(result of future), waiting for it if
+    callback returns a future. Exceptions skip callback.
+    """
+    result = asyncio.Future(loop=loop)
+
+    def done(future):
+        if result.done():
+            return
+        if future.cancelled() or future.exception() is not None:
+            _copy(future, result)
+            return
+        try:
+            value = callback(future.result())
+        except Exception, e:
+            result.set_exception(e)
+            return
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(lambda value: _copy(value, result))
+        else:
+            result.set_result(value)
+    future.add_done_callback(done)
+    return result
+
+
+def _retrieve(future):
+    "Marks the exception of future as handled"
+    if not future.cancelled():
+        future.exception()
+
+
+def _resolved(loop, value=None):
+    future = asyncio.Future(loop=loop)
+    future.set_result(value)
+    return future
+
+
+def _wait_all(loop, futures):
+    "Returns a future done when all the futures are, whatever their outcome"
+    result = asyncio.Future(loop=loop)
+    pending = [len(futures)]
+
+    def done(future):
+        pending[0] -= 1
+        if not pending[0] and not result.done():
+            result.set_result(None)
+    for future in futures:
+        future.add_done_callback(done)
+    if not futures:
+        result.set_result(None)
+    return result
+
+
+def _with_timeout(loop, future, timeout):
+    "Returns future failing with socket.timeout after timeout seconds"
+    result = asyncio.Future(loop=loop)
+
+    def expire():
+        if not result.done():
+            future.cancel()
+            result.set_exception(socket.timeout('timed out'))
+    handle = loop.call_later(timeout, expire)
+
+    def done(future):
+        handle.cancel()
+        _copy(future, result)
+    future.add_done_callback(done)
+    return result
+
+
+class SMTPClientProtocol(asyncio.Protocol if asyncio else object):
+    """
+    Client side of an SMTP connection: it writes commands and resolves, in
+    order, one future per reply with (code, message)
+    """
+
+    def __init__(self, loop, timeout):
+        self.loop = loop
+        self.timeout = timeout
+        self.transport = None
+        self.closed = False
+        self._buffer = ''
+        self._lines = []
+        self._waiters = deque()
+        self._replies = deque()
+        self._paused = False
+        self._drain_waiter = None
+        # The first reply is the greeting of the server
+        self.greeting = self.reply()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.closed = True
+        error = SMTPServerDisconnected(
+            'Connection unexpectedly closed: %s' % exc if exc
+            else 'Connection unexpectedly closed')
+        while self._waiters:
+            waiter, handle = self._waiters.popleft()
+            handle.cancel()
+            if not waiter.done():
+                waiter.set_exception(error)
+        if self._drain_waiter and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(error)
+
+    def data_received(self, data):
+        self._buffer += data
+        while True:
+            index = self._buffer.find('\n')
+            if index < 0:
+                break
+            line = self._buffer[:index].rstrip('\r')
+            self._buffer = self._buffer[index + 1:]
+            self._lines.append(line[4:])
+            if line[3:4] == '-':
+                continue
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+            reply = (code, '\n'.join(self._lines))
+            self._lines = []
+            if self._waiters:
+                waiter, handle = self._waiters.popleft()
+                handle.cancel()
+                if not waiter.done():
+                    waiter.set_result(reply)
+            else:
+                self._replies.append(reply)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        if self._drain_waiter and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _expire(self, waiter):
+        if not waiter.done():
+            waiter.set_exception(socket.timeout('SMTP reply timed out'))
+        # The next replies would not match their commands
+        self.close()
+
+    def reply(self):
+        "Returns a future of the next reply of the server"
+        waiter = asyncio.Future(loop=self.loop)
+        if self._replies:
+            waiter.set_result(self._replies.popleft())
+        elif self.closed:
+            waiter.set_exception(SMTPServerDisconnected(
+                    'Connection unexpectedly closed'))
+        else:
+            handle = self.loop.call_later(self.timeout, self._expire, waiter)
+            self._waiters.append((waiter, handle))
+        return waiter
+
+    def write(self, data):
+        if self.closed or self.transport is None:
+            raise SMTPServerDisconnected('Connection unexpectedly closed')
+        self.transport.write(data)
+
+    def command(self, line):
+        "Sends line and returns a future of its reply"
+        if isinstance(line, unicode):
+            # The addresses of the records are unicode
+            line = line.encode('utf-8')
+        try:
+            self.write(line + CRLF)
+        except SMTPServerDisconnected, e:
+            future = asyncio.Future(loop=self.loop)
+            future.set_exception(e)
+            return future
+        return self.reply()
+
+    def drain(self):
+        "Returns a future done when the written data may be sent"
+        if self.closed:
+            future = asyncio.Future(loop=self.loop)
+            future.set_exception(SMTPServerDisconnected(
+                    'Connection unexpectedly closed'))
+            return future
+        if not self._paused:
+            return _resolved(self.loop)
+        if self._drain_waiter is None or self._drain_waiter.done():
+            self._drain_waiter = asyncio.Future(loop=self.loop)
+        return self._drain_waiter
+
+    def close(self):
+        if self.transport and not self.closed:
+            self.transport.close()
+
+
+class AsyncSMTPConnection(object):
+    """
+    SMTP connection of an AsyncDeliveryPool. Its methods return futures.
+
+    Commands of a transaction are pipelined when the server supports it and
+    the message is streamed from a file opened and read in the executor of
+    the loop, so the storage is never read by the loop thread.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.loop = pool.loop
+        self.protocol = None
+        self.extensions = {}
+        self.semaphore = None
+
+    @property
+    def connected(self):
+        return self.protocol is not None and not self.protocol.closed
+
+    @property
+    def pipelining(self):
+        return self.pool.pipelining and 'pipelining' in self.extensions
+
+    def _command(self, line, expected, exception=SMTPException):
+        def check(reply):
+            code, message = reply
+            if code not in expected:
+                if exception is SMTPException:
+                    raise exception('%s: %s %s' % (line.split()[0], code,
+                            message))
+                raise exception(code, message)
+            return reply
+        return _then(self.loop, self.protocol.command(line), check)
+
+    def connect(self):
+        "Returns a future done when connected and authenticated"
+        pool = self.pool
+        start = time()
+        context = pool.ssl_context() if pool.ssl else None
+        connection = asyncio.ensure_future(self.loop.create_connection(
+                lambda: SMTPClientProtocol(self.loop, pool.timeout),
+                pool.host, pool.port, ssl=context,
+                server_hostname=pool.host if context else None),
+            loop=self.loop)
+
+        def connected(result):
+            self.protocol = result[1]
+            return self.protocol.greeting
+
+        def greeted(reply):
+            code, message = reply
+            if code != 220:
+                raise SMTPConnectError(code, message)
+            return self._ehlo()
+
+        def starttls(_):
+            if not pool.starttls:
+                return
+            if 'starttls' not in self.extensions:
+                raise SMTPException(
+                    'STARTTLS extension not supported by server.')
+            return _then(self.loop, self._command('STARTTLS', (220,)),
+                self._start_tls)
+
+        def done(future):
+            if future.exception() is None:
+                metrics.observe('electronic_mail_smtp_connect_seconds',
+                    time() - start, server=pool.server)
+            elif self.protocol:
+                self.protocol.close()
+        future = _with_timeout(self.loop, connection, pool.timeout)
+        for callback in (connected, greeted, starttls, self._login):
+            future = _then(self.loop, future, callback)
+        future.add_done_callback(done)
+        return future
+
+    def _ehlo(self):
+        def parse(reply):
+            code, message = reply
+            self.extensions = {}
+            if code != 250:
+                return self._command('HELO %s' % self.pool.local_hostname,
+                    (250,), SMTPHeloError)
+            for line in message.split('\n')[1:]:
+                feature, _, params = line.partition(' ')
+                self.extensions[feature.lower()] = params.strip()
+        return _then(self.loop, self.protocol.command(
+                'EHLO %s' % self.pool.local_hostname), parse)
+
+    def _start_tls(self, _):
+        pool = self.pool
+        upgrade = asyncio.ensure_future(self.loop.start_tls(
+                self.protocol.transport, self.protocol, pool.ssl_context(),
+                server_hostname=pool.host), loop=self.loop)
+
+        def upgraded(transport):
+            self.protocol.transport = transport
+            return self._ehlo()
+        return _then(self.loop, upgrade, upgraded)
+
+    def _login(self, _):
+        user, password = self.pool.user, self.pool.password
+        if not user or not password:
+            return
+        if 'auth' not in self.extensions:
+            raise SMTPException('SMTP AUTH extension not supported by server.')
+        mechanisms = self.extensions['auth'].upper().split()
+        if 'PLAIN' in mechanisms:
+            return self._command('AUTH PLAIN %s'
+                % b64encode('\0%s\0%s' % (user, password)), (235,),
+                SMTPAuthenticationError)
+        elif 'LOGIN' in mechanisms:
+            return _then(self.loop,
+                self._command('AUTH LOGIN %s' % b64encode(user), (334,),
+                    SMTPAuthenticationError),
+                lambda _: self._command(b64encode(password), (235,),
+                    SMTPAuthenticationError))
+        raise SMTPException('No suitable authentication method found.')
+
+    def _acquire(self):
+        "Returns a future done when the rate limit allows a transaction"
+        limiter = self.pool.limiter
+        if not limiter:
+            return _resolved(self.loop)
+        future = asyncio.Future(loop=self.loop)
+        start = time()
+
+        def take():
+            wait = limiter.poll()
+            if wait:
+                self.loop.call_later(wait, take)
+            else:
+                metrics.observe('electronic_mail_rate_limit_wait_seconds',
+                    time() - start, server=self.pool.server)
+                future.set_result(None)
+        take()
+        return future
+
+    def _commands(self, lines):
+        """
+        Returns a future of the replies to lines, sent at once if the server
+        supports pipelining. Otherwise RCPT and DATA are not sent once the
+        sender or all the recipients are refused.
+        """
+        protocol = self.protocol
+        if self.pipelining:
+            futures = [protocol.command(line) for line in lines]
+            for future in futures[:-1]:
+                future.add_done_callback(_retrieve)
+            # Replies come in order and a failure closes the connection
+            return _then(self.loop, futures[-1],
+                lambda _: [f.result() for f in futures])
+        replies = []
+
+        def send(reply):
+            replies.append(reply)
+            if (len(replies) == len(lines)
+                    or replies[0][0] != 250
+                    or (len(replies) == len(lines) - 1
+                        and all(code not in (250, 251)
+                            for code, _ in replies[1:]))):
+                return replies
+            return _then(self.loop, protocol.command(lines[len(replies)]),
+                send)
+        return _then(self.loop, protocol.command(lines[0]), send)
+
+    def _reset(self, exception, data_accepted=False):
+        "Resets the transaction and raises exception"
+        def reset(_):
+            return self.protocol.command('RSET')
+
+        def failed(future):
+            # Even if the connection is lost meanwhile
+            _retrieve(future)
+            result.set_exception(exception)
+        if data_accepted:
+            # The server waits for the message: end it empty
+            future = _then(self.loop, self.protocol.command('.'), reset)
+        else:
+            future = reset(None)
+        result = asyncio.Future(loop=self.loop)
+        future.add_done_callback(failed)
+        return result
+
+    def _data(self, file_p):
+        "Streams the DATA of the message read from file_p"
+        protocol = self.protocol
+        chunks = quote_data(file_p)
+
+        def read():
+            buffer, buffered = [], 0
+            for data in chunks:
+                buffer.append(data)
+                buffered += len(data)
+                if buffered >= SEND_SIZE:
+                    break
+            return ''.join(buffer)
+
+        def write(data):
+            if not data:
+                return protocol.reply()
+            protocol.write(data)
+            return _then(self.loop, protocol.drain(),
+                lambda _: _then(self.loop,
+                    self.loop.run_in_executor(None, read), write))
+
+        def aborted(future):
+            if future.exception() is not None:
+                # The message can not be ended without sending it
+                protocol.close()
+        future = _then(self.loop, self.loop.run_in_executor(None, read),
+            write)
+        future.add_done_callback(aborted)
+        return future
+
+    def _transaction(self, from_addr, to_addrs, msg):
+        opened = self.loop.run_in_executor(None, msg)
+        file_ps = []
+
+        options = ''
+        if 'size' in self.extensions and getattr(msg, 'size', None):
+            options += ' SIZE=%d' % msg.size
+        if '8bitmime' in self.extensions:
+            options += ' BODY=8BITMIME'
+
+        def send(file_p):
+            file_ps.append(file_p)
+            lines = (['MAIL FROM:%s%s' % (quoteaddr(from_addr), options)]
+                + ['RCPT TO:%s' % quoteaddr(a) for a in to_addrs]
+                + ['DATA'])
+            return _then(self.loop, self._commands(lines), replied)
+
+        def replied(replies):
+            count = len(to_addrs)
+            code, message = replies[0]
+            data = replies[count + 1] if len(replies) > count + 1 else None
+            refused = dict((addr, reply)
+                for addr, reply in zip(to_addrs, replies[1:count + 1])
+                if reply[0] not in (250, 251))
+            if code != 250:
+                exception = SMTPSenderRefused(code, message, from_addr)
+            elif len(refused) == count:
+                exception = SMTPRecipientsRefused(refused)
+            elif data[0] != 354:
+                exception = SMTPDataError(*data)
+            else:
+                return _then(self.loop, self._data(file_ps[0]),
+                    lambda reply: sent(reply, refused))
+            return self._reset(exception,
+                data_accepted=data is not None and data[0] == 354)
+
+        def sent(reply, refused):
+            code, message = reply
+            if code != 250:
+                return self._reset(SMTPDataError(code, message))
+            return refused
+
+        def close(future):
+            for file_p in file_ps:
+                file_p.close()
+        future = _then(self.loop, opened, send)
+        future.add_done_callback(close)
+        return future
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Returns a future of the refused recipients of msg, a string or a
+        function returning a file-like object to stream it. There is one
+        transaction per max_recipients recipients of the pool.
+        """
+        if isinstance(to_addrs, basestring):
+            to_addrs = [to_addrs]
+        if not callable(msg):
+            data = msg
+            msg = lambda: StringIO(data)
+            msg.size = len(data)
+        size = self.pool.max_recipients or len(to_addrs) or 1
+        chunks = deque(to_addrs[i:i + size]
+            for i in range(0, max(len(to_addrs), 1), size))
+        server = self.pool.server
+        refused = {}
+
+        def transaction(_):
+            start = time()
+
+            def done(future):
+                metrics.observe('electronic_mail_smtp_data_seconds',
+                    time() - start, server=server)
+                exception = future.exception()
+                if exception is not None:
+                    metrics.inc('electronic_mail_smtp_errors_total',
+                        server=server, exception=exception.__class__.__name__)
+            future = self._transaction(from_addr, chunks.popleft(), msg)
+            future.add_done_callback(done)
+            return _then(self.loop, recipients_refused(future), next_chunk)
+
+        def recipients_refused(future):
+            # The other transactions may be accepted
+            result = asyncio.Future(loop=self.loop)
+
+            def done(future):
+                exception = future.exception()
+                if isinstance(exception, SMTPRecipientsRefused):
+                    result.set_result(exception.recipients)
+                else:
+                    _copy(future, result)
+            future.add_done_callback(done)
+            return result
+
+        def next_chunk(result):
+            refused.update(result or {})
+            if chunks:
+                return _then(self.loop, self._acquire(), transaction)
+            if len(refused) == len(to_addrs):
+                raise SMTPRecipientsRefused(refused)
+            return refused
+        return next_chunk(None)
+
+    def quit(self):
+        "Returns a future done when the connection is closed"
+        result = asyncio.Future(loop=self.loop)
+
+        def close(future):
+            _retrieve(future)
+            self.protocol.close()
+            self.release()
+            result.set_result(None)
+        if self.connected:
+            self.protocol.command('QUIT').add_done_callback(close)
+        else:
+            self.release()
+            result.set_result(None)
+        return result
+
+    def release(self):
+        if self.semaphore:
+            self.semaphore.release()
+            self.semaphore = None
+
+
+class AsyncDeliveryPool(object):
+    """
+    Send a batch of emails over many SMTP connections of an event loop run
+    by the calling thread.
+
+    It has the interface of DeliveryPool: deliver receives (key, from_addr,
+    to_addrs, msg) jobs and yields (key, exception, refused) results. Jobs
+    are taken from the iterator, and results handled by the caller, in its
+    thread between two runs of the loop, so the caller keeps all the
+    bookkeeping in its own transaction.
+
+    Options of the electronic_mail configuration section:
+        smtp_pipelining: pipeline the commands if the server supports it
+            (default True)
+        smtp_timeout: seconds to wait for the server (default 60)
+    """
+
+    def __init__(self, host, port, connections=1, ssl=False, starttls=False,
+            user=None, password=None, limiter=None, semaphore=None,
+            max_recipients=None, server=None, pipelining=None, timeout=None):
+        if pipelining is None:
+            pipelining = config.getboolean('electronic_mail',
+                'smtp_pipelining', default=True)
+        if timeout is None:
+            timeout = config.getint('electronic_mail', 'smtp_timeout',
+                default=60)
+        self.host = host
+        self.port = port
+        self.size = max(connections, 1)
+        self.ssl = ssl
+        self.starttls = starttls
+        self.user = user
+        self.password = password
+        self.limiter = limiter
+        self.semaphore = semaphore
+        self.max_recipients = max_recipients
+        self.server = server
+        self.pipelining = pipelining
+        self.timeout = timeout
+        self.local_hostname = socket.getfqdn()
+        self.loop = None
+        self.connections = []
+        self._jobs = None
+        self._results = deque()
+        self._active = 0
+        self._wakeup = None
+        self._failure = None
+
+    @classmethod
+    def from_server(cls, server, connections=1):
+        "Returns a pool to the smtp.server record"
+        def encode(value):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            return value
+        return cls(server.smtp_server, server.smtp_port,
+            connections=connections, ssl=server.smtp_ssl,
+            starttls=server.smtp_tls, user=encode(server.smtp_user),
+            password=encode(server.smtp_password),
+            limiter=smtp_pool._limiter(server),
+            semaphore=smtp_pool._semaphore(server),
+            max_recipients=server.max_recipients, server=server.id)
+
+    @staticmethod
+    def ssl_context():
+        # As smtplib, the certificate of the server is not verified
+        return ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+
+    def open(self):
+        """
+        Opens the connections. Only the first one waits for the
+        max_connections of the server. It raises the error of the first
+        connection if none could be opened.
+        """
+        self.loop = asyncio.new_event_loop()
+        connections = []
+        for i in range(self.size):
+            connection = AsyncSMTPConnection(self)
+            if self.semaphore:
+                if not self.semaphore.acquire(not i):
+                    break
+                connection.semaphore = self.semaphore
+            connections.append(connection)
+        futures = [c.connect() for c in connections]
+        self.loop.run_until_complete(_wait_all(self.loop, futures))
+        for connection, future in zip(connections, futures):
+            if future.exception() is None:
+                self.connections.append(connection)
+            else:
+                connection.release()
+        if not self.connections:
+            exception = futures[0].exception()
+            self.close()
+            raise exception
+
+    def _wake(self):
+        if self._wakeup and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _next_job(self):
+        if self._failure:
+            return
+        try:
+            return next(self._jobs, None)
+        except Exception:
+            self._failure = sys.exc_info()
+            self._wake()
+
+    def _work(self, connection, job=None, retried=False):
+        if job is None:
+            job = self._next_job()
+            if job is None:
+                self._stop()
+                return
+        key, from_addr, to_addrs, msg = job
+        future = connection.sendmail(from_addr, to_addrs, msg)
+        future.add_done_callback(
+            lambda future: self._done(connection, job, future, retried))
+
+    def _done(self, connection, job, future, retried):
+        exception = future.exception()
+        if exception is None or connection.connected:
+            self._results.append((job[0], exception,
+                    future.result() if exception is None else {}))
+            self._wake()
+            self._work(connection)
+            return
+        # Resend once the messages of connections dropped by the server
+        retry = None
+        if isinstance(exception, SMTPServerDisconnected) and not retried:
+            retry = job
+        else:
+            self._results.append((job[0], exception, {}))
+            self._wake()
+        logger.info('SMTP connection lost, reconnecting')
+
+        def reconnected(future):
+            exception = future.exception()
+            if exception is None:
+                self._work(connection, retry, retried=retry is not None)
+                return
+            if retry:
+                self._results.append((retry[0], exception, {}))
+            self.connections.remove(connection)
+            connection.release()
+            self._stop(exception)
+        connection.connect().add_done_callback(reconnected)
+
+    def _stop(self, exception=None):
+        self._active -= 1
+        if not self._active and exception is not None:
+            # No connection left for the remaining jobs
+            while True:
+                job = self._next_job()
+                if job is None:
+                    break
+                self._results.append((job[0], exception, {}))
+        self._wake()
+
+    def deliver(self, jobs):
+        '''
+        Send jobs and yield (key, exception, refused) as each one finishes.
+        exception is None when the message was accepted by the server for
+        the recipients not in the refused dict.
+        '''
+        self._jobs = iter(jobs)
+        self._active = len(self.connections)
+        for connection in self.connections[:]:
+            self._work(connection)
+        try:
+            while True:
+                while self._results:
+                    yield self._results.popleft()
+                if self._failure:
+                    failure, self._failure = self._failure, None
+                    raise failure[0], failure[1], failure[2]
+                if not self._active:
+                    break
+                self._wakeup = asyncio.Future(loop=self.loop)
+                self.loop.run_until_complete(self._wakeup)
+        finally:
+            # No new job once the caller stops
+            self._jobs = iter(())
+
+    def close(self):
+        "Closes the connections and the loop"
+        if self.loop is None:
+            return
+        # The transactions in flight end, no new job is taken
+        self._jobs = iter(())
+        while self._active:
+            self._wakeup = asyncio.Future(loop=self.loop)
+            self.loop.run_until_complete(self._wakeup)
+        futures = [c.quit() for c in self.connections]
+        self.loop.run_until_complete(_wait_all(self.loop, futures))
+        self.connections = []
+        # Run the callbacks closing the transports
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        self.loop.close()
+        self.loop = None
@@ -0,0 +1,59 @@
+# This file is part of electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from collections import OrderedDict
+import threading
+
+__all__ = ['SizeLRUCache']
+
+
+class SizeLRUCache(object):
+    """
+    Thread safe LRU cache bounded by the total size of its values.
+
+    The size of each value is given by the caller when it is set.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            # Move to the most recently used end
+            self._data[key] = (value, size)
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self.size -= old_size
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
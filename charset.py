@@ -0,0 +1,72 @@
+# This file is part of electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.config import config
+import codecs
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The fastest charset detector available
+try:
+    import cchardet as detector
+except ImportError:
+    try:
+        import charset_normalizer as detector
+    except ImportError:
+        try:
+            import chardet as detector
+        except ImportError:
+            detector = None
+            logger.warning('Unable to import cchardet, charset_normalizer or '
+                'chardet. Charset detection disabled.')
+
+__all__ = ['detect_charset', 'decode_payload']
+
+# Charset used when it can not be detected, decodes any byte
+FALLBACK_CHARSET = 'latin-1'
+
+
+def _known(charset):
+    try:
+        return codecs.lookup(charset).name
+    except (LookupError, TypeError):
+        return None
+
+
+def detect_charset(payload):
+    """
+    Returns the charset of payload: UTF-8 if it decodes strictly, otherwise
+    the charset detected on its first charset_sample_size bytes (default 64
+    KB) of the electronic_mail section
+    """
+    try:
+        payload.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if detector:
+        sample_size = config.getint('electronic_mail', 'charset_sample_size',
+            default=64 * 1024)
+        charset = _known(detector.detect(payload[:sample_size]).get(
+                'encoding'))
+        if charset:
+            return charset
+    return FALLBACK_CHARSET
+
+
+def decode_payload(payload, charset=None):
+    """
+    Returns payload decoded with charset or the detected one if charset is
+    unknown or wrong, and the charset used
+    """
+    if not payload:
+        return u'', charset
+    charset = _known(charset)
+    if charset:
+        try:
+            return payload.decode(charset), charset
+        except UnicodeDecodeError:
+            pass
+    charset = detect_charset(payload)
+    return payload.decode(charset, 'replace'), charset
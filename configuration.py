@@ -17,3 +17,23 @@ class ElectronicMailConfiguration(ModelSingleton, ModelSQL, ModelView):
         'Error', required=True))
     outbox = fields.Property(fields.Many2One('electronic.mail.mailbox',
         'Outbox', required=True))
+    max_attempts = fields.Integer('Maximum Attempts',
+        help='Emails not sent after this number of attempts are moved to the '
+        'error mailbox. Leave empty to retry forever.')
+    retry_delay = fields.Integer('Retry Delay', required=True,
+        help='Seconds before retrying a failed email, doubled on each '
+        'attempt')
+    retry_max_delay = fields.Integer('Maximum Retry Delay', required=True,
+        help='Maximum seconds between two attempts')
+
+    @staticmethod
+    def default_max_attempts():
+        return 10
+
+    @staticmethod
+    def default_retry_delay():
+        return 300
+
+    @staticmethod
+    def default_retry_max_delay():
+        return 24 * 60 * 60
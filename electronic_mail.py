@@ -4,35 +4,48 @@
 from __future__ import with_statement
 from itertools import groupby
 from _socket import gaierror, error
-from datetime import datetime
+from ast import literal_eval
+from contextlib import closing
+from datetime import datetime, timedelta
 from sys import getsizeof
-from time import mktime
+from time import mktime, time
+from sql import Null
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+from trytond import backend
 from trytond.config import config
 from trytond.exceptions import UserError
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
 from trytond.pyson import Bool, Eval, PYSONEncoder
-from trytond.tools.misc import reduce_ids
+from trytond.tools.misc import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from email import message_from_string
 from email.utils import parsedate, parseaddr, getaddresses
 from email.header import decode_header, make_header
-import operator
+from email.parser import HeaderParser, Parser
+from mailbox import mbox, Maildir
+import hashlib
 import logging
 import os
-from smtplib import SMTPAuthenticationError, SMTPException
-import chardet
+from smtplib import (SMTPAuthenticationError, SMTPException,
+    SMTPRecipientsRefused)
 import mimetypes
 import platform
+import tempfile
+
+from .aiosender import AsyncDeliveryPool, use_asyncio
+from .cache import SizeLRUCache
+from .charset import decode_payload, _known
+from .fulltext import get_full_text, register_trigram_indexes
+from .metrics import metrics
+from .sender import (DeliveryPool, smtp_pool, is_permanent_error,
+    retry_delay, run_processes)
+from .storage import (compression_method, get_storage, merge_keys,
+    sorted_keys)
 
 logger = logging.getLogger(__name__)
 
-try:
-    import hashlib
-except ImportError:
-    hashlib = None
-    import md5
-    
 try:
     from emailvalid import check_email
     CHECK_EMAIL = True
@@ -45,6 +58,21 @@ if platform.python_implementation() == 'PyPy':
 else:
     PyPy = False
 
+# Full text indexes by searcher field name
+FULL_TEXT_INDEXES = {
+    'full_text': ('electronic_mail_full_text_idx',
+        ['subject', 'from_', 'to', 'cc', 'bcc', 'body_plain']),
+    'full_text_body': ('electronic_mail_full_text_body_idx', ['body_plain']),
+    }
+
+# Detected charsets by (database, storage key, part index) of the parts
+# without a charset or with a wrong one
+charset_cache = SizeLRUCache(config.getint('electronic_mail',
+        'charset_cache_size', default=10000))
+# Key of the owner, read and write users of the mailboxes in the transaction
+# cache of each user
+ACL_CACHE = 'electronic.mail.mailbox.acl'
+
 def _make_header(data, charset='utf-8'):
     return str(make_header([(data, charset)]))
 
@@ -60,12 +88,16 @@ def _decode_header(data):
             headers.append(unicode(decoded_str, 'utf8'))
     return " ".join(headers)
 
-def _decode_body(part):
-    charset = str(part.get_content_charset())
+def _decode_body(part, key=None):
+    charset = part.get_content_charset()
     payload = part.get_payload(decode=True)
-    if not charset or charset == 'None':
-        charset = chardet.detect(payload).get('encoding')
-    return payload.decode(charset).strip()
+    if key:
+        charset = charset_cache.get(key, charset)
+    body, used = decode_payload(payload, charset)
+    # Only remember the charsets that differ from the declared one
+    if key and payload and used != _known(charset):
+        charset_cache.set(key, used, 1)
+    return body.strip()
 
 def msg_from_string(email_file):
     " Convert email file to string"
@@ -73,6 +105,27 @@ def msg_from_string(email_file):
         return message_from_string(email_file)
     return None
 
+def storage_key(digest, collision=0):
+    "Returns the storage key of an email file"
+    if not digest:
+        return
+    if collision:
+        return '%s-%s' % (digest, collision)
+    return digest
+
+
+def _send_emails_process(database_name, user, context, mailbox_ids, limit,
+        shards):
+    "Sends the emails of shards in a process of run_processes"
+    pool = Pool(database_name)
+    with Transaction().start(database_name, 0, readonly=True):
+        pool.init()
+    with Transaction().start(database_name, user, context=context):
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        ElectronicMail._send_emails_shard(Mailbox.browse(mailbox_ids),
+            limit, shards)
+
 
 __all__ = ['Mailbox', 'ReadUser', 'WriteUser', 'ElectronicMail']
 
@@ -93,6 +146,9 @@ class Mailbox(ModelSQL, ModelView):
         domain=[('state', '=', 'done')], states={
             'required': Eval('scheduler', True),
         }, depends=['scheduler'])
+    act_window = fields.Many2One('ir.action.act_window', 'Menu Action',
+        readonly=True, ondelete='SET NULL',
+        help='Action of the menu created for the mailbox')
 
     @classmethod
     def __setup__(cls):
@@ -105,10 +161,52 @@ class Mailbox(ModelSQL, ModelView):
                 })
         cls._buttons.update({
                 'create_menu': {
-                    'invisible': Bool(Eval('menu')),
+                    'invisible': Bool(Eval('act_window')),
                     },
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        # Migration from 4.0: act_window stored
+        link_act_windows = (TableHandler.table_exist(cls._table)
+            and not TableHandler(cls, module_name).column_exist('act_window'))
+
+        super(Mailbox, cls).__register__(module_name)
+
+        if link_act_windows:
+            cls._link_act_windows()
+
+    @classmethod
+    def _link_act_windows(cls):
+        "Fills act_window from the domain of the existing menu actions"
+        pool = Pool()
+        ActWindow = pool.get('ir.action.act_window')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        act_window = ActWindow.__table__()
+
+        cursor.execute(*act_window.select(act_window.id, act_window.domain,
+                where=(act_window.res_model == 'electronic.mail')
+                & act_window.domain.like('%mailbox%'),
+                order_by=act_window.id))
+        act_windows = {}
+        for act_window_id, domain in cursor.fetchall():
+            try:
+                # Encoded with PYSONEncoder or str by older versions
+                domain = literal_eval(domain.replace('"', "'"))
+                (field, operator, mailbox_id), = domain
+            except (SyntaxError, ValueError, TypeError):
+                continue
+            if (field == 'mailbox' and operator == '='
+                    and isinstance(mailbox_id, (int, long))):
+                act_windows.setdefault(mailbox_id, act_window_id)
+        for mailbox_id, act_window_id in act_windows.iteritems():
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.act_window], values=[act_window_id],
+                    where=sql_table.id == mailbox_id))
+
     @staticmethod
     def default_scheduler():
         return False
@@ -124,36 +222,24 @@ class Mailbox(ModelSQL, ModelView):
         # by clicking menu User > Refresh Menu
         pool = Pool()
         Menu = pool.get('ir.ui.menu')
-        Action = pool.get('ir.action')
         ActWindow = pool.get('ir.action.act_window')
         ActionKeyword = pool.get('ir.action.keyword')
         ActWindowView = pool.get('ir.action.act_window.view')
 
-        encoder = PYSONEncoder()
-
-        act_windows = []
-        actions = []
-        keywords = []
-        menus = []
-        act_window_views = []
-        for mailbox in mailboxes:
-            act_windows.extend(ActWindow.search([
-                    ('res_model', '=', 'electronic.mail'),
-                    ('domain', '=', encoder.encode([('mailbox', '=', mailbox.id)])),
-                    ]))
-            actions.extend([a_w.action for a_w in act_windows])
-            keywords.extend(ActionKeyword.search([('action', 'in', actions)]))
-            menus.extend([k.model for k in keywords])
-            act_window_views.extend(ActWindowView.search([
-                    ('act_window', 'in', [a_w.id for a_w in act_windows]),
-                    ]))
+        act_windows = [m.act_window for m in mailboxes if m.act_window]
+        keywords = cls._menu_keywords(act_windows)
+        menus = [k.model for k in keywords]
+        act_window_views = ActWindowView.search([
+                ('act_window', 'in', [a_w.id for a_w in act_windows]),
+                ])
 
         ActWindowView.delete(act_window_views)
-        ActWindow.delete(act_windows)
         ActionKeyword.delete(keywords)
-        Action.delete(actions)
+        # Deletes the ir.action of the act windows too
+        ActWindow.delete(act_windows)
         Menu.delete(menus)
-        return super(Mailbox, cls).delete(mailboxes)
+        super(Mailbox, cls).delete(mailboxes)
+        cls._clear_acl_cache()
 
     @classmethod
     def write(cls, *args):
@@ -161,30 +247,39 @@ class Mailbox(ModelSQL, ModelView):
         # and that in order to see it, you must type ALT+T or refresh the menu
         # by clicking menu User > Refresh Menu
         pool = Pool()
-        ActWindow = pool.get('ir.action.act_window')
         Action = pool.get('ir.action')
-        ActionKeyword = pool.get('ir.action.keyword')
         Menu = pool.get('ir.ui.menu')
 
-        encoder = PYSONEncoder()
-
         acts = iter(args)
         for mailboxes, values in zip(acts, acts):
             if 'name' in values:
-                actions = []
-                menus = []
-                for mailbox in mailboxes:
-                    act_windows = ActWindow.search([
-                            ('res_model', '=', 'electronic.mail'),
-                            ('domain', '=', encoder.encode([('mailbox', '=', mailbox.id)])),
-                            ])
-                    actions.extend([a_w.action for a_w in act_windows])
-                    keywords = ActionKeyword.search([
-                            ('action', 'in', actions)])
-                    menus.extend([k.model for k in keywords])
-                Action.write(actions, {'name': values['name']})
-                Menu.write(menus, {'name': values['name']})
+                act_windows = [m.act_window for m in mailboxes
+                    if m.act_window]
+                keywords = cls._menu_keywords(act_windows)
+                Action.write([a_w.action for a_w in act_windows],
+                    {'name': values['name']})
+                Menu.write([k.model for k in keywords],
+                    {'name': values['name']})
         super(Mailbox, cls).write(*args)
+        cls._clear_acl_cache()
+
+    @staticmethod
+    def _clear_acl_cache():
+        "Clears the mailbox access control read by the emails"
+        for cache in Transaction().cache.itervalues():
+            cache.pop(ACL_CACHE, None)
+
+    @staticmethod
+    def _menu_keywords(act_windows):
+        "Returns the keywords that open act_windows from a menu"
+        ActionKeyword = Pool().get('ir.action.keyword')
+        if not act_windows:
+            return []
+        return ActionKeyword.search([
+                ('action', 'in', [a_w.action.id for a_w in act_windows]),
+                ('keyword', '=', 'tree_open'),
+                ('model', 'like', 'ir.ui.menu,%'),
+                ])
 
     @classmethod
     @ModelView.button
@@ -195,78 +290,71 @@ class Mailbox(ModelSQL, ModelView):
         pool = Pool()
         ModelData = pool.get('ir.model.data')
         Menu = pool.get('ir.ui.menu')
-        Action = pool.get('ir.action')
         ActWindow = pool.get('ir.action.act_window')
         ActionKeyword = pool.get('ir.action.keyword')
         ActWindowView = pool.get('ir.action.act_window.view')
-        View = pool.get('ir.ui.view')
 
         encoder = PYSONEncoder()
 
-        for mailbox in mailboxes:
-            act_windows = ActWindow.search([
-                    ('res_model', '=', 'electronic.mail'),
-                    ('domain', '=', str([('mailbox', '=', mailbox.id)])),
-                    ])
-            actions = [a_w.action for a_w in act_windows]
-            keywords = ActionKeyword.search([('action', 'in', actions)])
-            menus = [k.model for k in keywords]
-        if menus:
+        if any(m.act_window for m in mailboxes):
             cls.raise_user_error('menu_exist')
-        data_menu_mailbox, = ModelData.search([
-                ('module', '=', 'electronic_mail'),
-                ('model', '=', 'ir.ui.menu'),
-                ('fs_id', '=', 'menu_mail'),
-                ])
-        menu_mailbox, = Menu.search([
-                ('id', '=', data_menu_mailbox.db_id)
-                ])
-        actions = Action.create([{
-                    'name': mb.name,
-                    'type': 'ir.action.act_window',
-                    } for mb in mailboxes])
+        menu_mailbox = ModelData.get_id('electronic_mail', 'menu_mail')
         act_windows = ActWindow.create([{
+                    'name': mb.name,
                     'res_model': 'electronic.mail',
                     'domain': encoder.encode([('mailbox', '=', mb.id)]),
-                    'action': a.id,
-                    }
-                for mb in mailboxes for a in actions if a.name == mb.name])
+                    } for mb in mailboxes])
         menus = Menu.create([{
-                    'parent': menu_mailbox.id,
+                    'parent': menu_mailbox,
                     'name': mb.name,
                     'icon': 'tryton-list',
                     'active': True,
                     'sequence': 10,
                     } for mb in mailboxes])
+        # create returns the records in the order of the values
         ActionKeyword.create([{
                     'model': 'ir.ui.menu,%s' % m.id,
                     'action': a_w.id,
                     'keyword': 'tree_open',
-                    }
-                for mb in mailboxes
-                    for a_w in act_windows
-                        for m in menus
-                            if mb.id == eval(a_w.domain)[0][2]
-                                and m.name == mb.name
-                ])
-        data_views = ModelData.search([
-                ('module', '=', 'electronic_mail'),
-                ('model', '=', 'ir.ui.view'),
-                ['OR',
-                    ('fs_id', '=', 'mail_view_tree'),
-                    ('fs_id', '=', 'mail_view_form'),
-                    ],
-                ])
-        views = View.search([('id', 'in', [v.db_id for v in data_views])])
+                    } for a_w, m in zip(act_windows, menus)])
+        views = [
+            (ModelData.get_id('electronic_mail', 'mail_view_tree'), 10),
+            (ModelData.get_id('electronic_mail', 'mail_view_form'), 20),
+            ]
         ActWindowView.create([{
                     'act_window': a_w.id,
-                    'view': v.id,
-                    'sequence': 10 if v.type == 'tree' else 20,
-                    } for a_w in act_windows for v in views])
+                    'view': view,
+                    'sequence': sequence,
+                    } for a_w in act_windows for view, sequence in views])
+        args = []
+        for mailbox, act_window in zip(mailboxes, act_windows):
+            args.extend(([mailbox], {'act_window': act_window.id}))
+        if args:
+            cls.write(*args)
         return 'reload menu'
 
 
-class ReadUser(ModelSQL):
+class MailboxUserMixin(object):
+    "Clears the access control read when the users of the mailboxes change"
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(MailboxUserMixin, cls).create(vlist)
+        Pool().get('electronic.mail.mailbox')._clear_acl_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(MailboxUserMixin, cls).write(*args)
+        Pool().get('electronic.mail.mailbox')._clear_acl_cache()
+
+    @classmethod
+    def delete(cls, records):
+        super(MailboxUserMixin, cls).delete(records)
+        Pool().get('electronic.mail.mailbox')._clear_acl_cache()
+
+
+class ReadUser(MailboxUserMixin, ModelSQL):
     'Electronic Mail - read - User'
     __name__ = 'electronic.mail.mailbox.read.res.user'
 
@@ -276,7 +364,7 @@ class ReadUser(ModelSQL):
             required=True, select=1)
 
 
-class WriteUser(ModelSQL):
+class WriteUser(MailboxUserMixin, ModelSQL):
     'Mailbox - write - User'
     __name__ = 'electronic.mail.mailbox.write.res.user'
 
@@ -300,16 +388,15 @@ class ElectronicMail(ModelSQL, ModelView):
     bcc = fields.Char('BCC')
     subject = fields.Char('Subject')
     date = fields.DateTime('Date')
-    body_html = fields.Function(fields.Text('Body HTML'), 'get_email')
-    body_plain = fields.Function(fields.Text('Body Plain'), 'get_email')
+    body_html = fields.Text('Body HTML', readonly=True)
+    body_plain = fields.Text('Body Plain', readonly=True)
     deliveredto = fields.Char('Deliveret-To')
     reference = fields.Char('References')
     reply_to = fields.Char('Reply-To')
-    num_attach = fields.Function(fields.Integer('Number of attachments'),
-        'get_email')
+    num_attach = fields.Integer('Number of attachments', readonly=True)
     message_id = fields.Char('Message-ID', help='Unique Message Identifier')
     in_reply_to = fields.Char('In-Reply-To')
-    digest = fields.Char('MD5 Digest', size=32)
+    digest = fields.Char('Digest', size=64)
     collision = fields.Integer('Collision')
     email_file = fields.Function(fields.Binary('Email File'), 'get_email',
         setter='set_email')
@@ -331,6 +418,19 @@ class ElectronicMail(ModelSQL, ModelView):
         fields.One2Many('res.user', None, 'Write Users'),
         'get_mailbox_users', searcher='search_mailbox_users')
     attempts = fields.Integer("Attempts", required=True, readonly=True)
+    priority = fields.Integer('Priority', required=True,
+        help='Emails with a lower priority are sent first by the scheduler '
+        '(1 highest, 3 normal, 5 lowest)')
+    next_attempt_at = fields.DateTime('Next Attempt', readonly=True,
+        help='The scheduler does not send the email before this date')
+    leased_until = fields.DateTime('Leased Until', readonly=True,
+        help='Date until the email is reserved by a scheduler run')
+    full_text = fields.Function(fields.Text('Full Text',
+            help='Search the words in subject, addresses and body'),
+        'get_full_text', searcher='search_full_text')
+    full_text_body = fields.Function(fields.Text('Full Text Body',
+            help='Search the words in body'),
+        'get_full_text', searcher='search_full_text')
 
     @classmethod
     def __setup__(cls):
@@ -345,9 +445,14 @@ class ElectronicMail(ModelSQL, ModelView):
 
     @classmethod
     def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
         cursor = Transaction().connection.cursor()
         sql_table = cls.__table__()
 
+        # Migration from 4.0: body_plain, body_html and num_attach stored
+        backfill_bodies = (TableHandler.table_exist(cls._table)
+            and not TableHandler(cls, module_name).column_exist('num_attach'))
+
         super(ElectronicMail, cls).__register__(module_name)
 
         # Migration from 3.2: fill required attempts
@@ -359,14 +464,33 @@ class ElectronicMail(ModelSQL, ModelView):
                 columns=[sql_table.attempts], values=[0],
                 where=(records_to_update)))
 
+        if backfill_bodies:
+            cls._backfill_bodies()
+
+        # Index used to dequeue the emails to send
+        table = TableHandler(cls, module_name)
+        table.index_action(['mailbox', 'priority', 'date'], 'add')
+
+        for name in FULL_TEXT_INDEXES:
+            index = cls._full_text_index(name)
+            if index:
+                index.register(cursor)
+        # Substring searches of search_rec_name
+        register_trigram_indexes(cursor, cls._table,
+            ['subject', 'from_', 'to', 'cc', 'bcc'])
+
     @staticmethod
     def default_attempts():
         return 0
 
+    @staticmethod
+    def default_priority():
+        return 3
+
     @classmethod
     def validate(cls, emails):
         super(ElectronicMail, cls).validate(emails)
-        if CHECK_EMAIL:
+        if CHECK_EMAIL and Transaction().context.get('check_email', True):
             for email in emails:
                 if email.from_ and not check_email(parseaddr(email.from_)[1]):
                     cls.raise_user_error('email_invalid', (email.from_,))
@@ -411,50 +535,367 @@ class ElectronicMail(ModelSQL, ModelView):
             logger.warning('Configure mailboxs to send by the scheduler')
             return
 
-        emails = cls.search([
-            ('mailbox', 'in', mailboxs)
-            ], order=[('date', 'ASC')], limit=limit)
+        # The emails of the node, when several nodes share the sending
+        shards = []
+        shard_count = config.getint('electronic_mail', 'shard_count',
+            default=1)
+        if shard_count > 1:
+            shards.append((config.getint('electronic_mail', 'shard_index',
+                        default=0), shard_count))
+        processes = config.getint('electronic_mail', 'send_processes',
+            default=1)
+        if processes <= 1:
+            try:
+                return cls._send_emails_shard(mailboxs, limit, shards)
+            finally:
+                metrics.export()
+
+        if limit:
+            limit = -(-limit // processes)
+        transaction = Transaction()
+        args = (transaction.database.name, transaction.user,
+            dict(transaction.context), [m.id for m in mailboxs], limit)
+        failed = run_processes(_send_emails_process,
+            [args + (shards + [(i, processes)],) for i in range(processes)])
+        if failed:
+            logger.error('%s of %s sending processes failed'
+                % (failed, processes))
+        metrics.export()
+
+    @classmethod
+    def _send_emails_shard(cls, mailboxes, limit=None, shards=None,
+            commit=True):
+        emails = cls.dequeue(mailboxes, limit=limit, shards=shards,
+            commit=commit)
         logger.info('Start send %s emails' % (len(emails)))
-        return cls.send_emails(emails)
+        if not commit:
+            return cls.send_emails(emails)
+        # A new transaction sees the committed leases, so writing the emails
+        # leased after the start of the current one does not conflict
+        with Transaction().new_transaction():
+            return cls.send_emails(cls.browse([e.id for e in emails]),
+                commit=True)
+
+    @classmethod
+    def dequeue(cls, mailboxes, limit=None, shards=None, commit=True):
+        """
+        Leases and returns the emails of mailboxes to send now, by priority
+        and date. The lease is committed in its own transaction, retried on
+        concurrent updates, so several scheduler runs, even on other nodes,
+        never return the same emails until it expires (the lease_duration
+        seconds of the electronic_mail section).
+
+        :param shards: list of (index, count) restricting the emails to the
+            index-th of count partitions by id, each partition being divided
+            by the next (index, count)
+        :param commit: if False, lease in the current transaction
+        """
+        if not commit:
+            return cls.browse(cls._lease(mailboxes, limit, shards))
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        for count in range(config.getint('database', 'retry'), -1, -1):
+            try:
+                with Transaction().new_transaction():
+                    ids = cls._lease(mailboxes, limit, shards)
+            except DatabaseOperationalError:
+                if not count:
+                    raise
+                logger.debug('Retry dequeue', exc_info=True)
+                continue
+            return cls.browse(ids)
+
+    @classmethod
+    def _lease(cls, mailboxes, limit, shards):
+        "Leases the emails to send of dequeue and returns their ids"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        now = datetime.now()
+        lease_duration = config.getint('electronic_mail', 'lease_duration',
+            default=3600)
+
+        where = (table.mailbox.in_([m.id for m in mailboxes])
+            & ((table.next_attempt_at == Null)
+                | (table.next_attempt_at <= now))
+            & ((table.leased_until == Null)
+                | (table.leased_until < now)))
+        divisor = 1
+        for index, count in shards or []:
+            id_ = table.id / divisor if divisor > 1 else table.id
+            where &= (id_ % count) == index
+            divisor *= count
+        query = table.select(table.id, where=where,
+            order_by=[table.priority.asc, table.date.asc],
+            limit=limit)
+        query, params = tuple(query)
+        if backend.name() == 'postgresql':
+            # Rows being leased by another run are left to it
+            query += ' FOR UPDATE SKIP LOCKED'
+        cursor.execute(query, params)
+        ids = [r[0] for r in cursor.fetchall()]
+        if ids:
+            cursor.execute(*table.update(
+                    columns=[table.leased_until],
+                    values=[now + timedelta(seconds=lease_duration)],
+                    where=reduce_ids(table.id, ids)))
+        return ids
+
+    @staticmethod
+    def _smtp_workers(count, server=None, asynchronous=False):
+        """
+        Returns the number of SMTP connections used to send count emails
+        """
+        if asynchronous:
+            workers = config.getint('electronic_mail', 'async_connections',
+                default=100)
+        else:
+            workers = config.getint('electronic_mail', 'smtp_workers',
+                default=1)
+        if server and server.max_connections:
+            workers = min(workers, server.max_connections)
+        return max(min(workers, count), 1)
+
+    @classmethod
+    def _write_send_states(cls, states):
+        """
+        Writes the delivery bookkeeping grouped by resulting state
+
+        :param states: dict of (attempts, mailbox id, flag_send,
+            next_attempt_at): email ids
+        """
+        to_write = []
+        for (attempts, mailbox, flag_send, next_attempt_at), ids in (
+                states.iteritems()):
+            to_write.extend((cls.browse(ids), {
+                        'attempts': attempts,
+                        'mailbox': mailbox,
+                        'flag_send': flag_send,
+                        'next_attempt_at': next_attempt_at,
+                        'leased_until': None,
+                        }))
+        states.clear()
+        if to_write:
+            # Only bookkeeping fields are written, addresses are unchanged
+            with Transaction().set_context(check_email=False), \
+                    metrics.timer('electronic_mail_db_write_seconds'):
+                cls.write(*to_write)
+
+    def _get_failed_state(self, exception, email_configuration):
+        """
+        Returns the send state of the email after a failed attempt: moved to
+        the error mailbox for permanent errors or when the attempts are
+        exhausted, otherwise retried later with an exponential backoff.
+        Without error mailbox, the email is always retried.
+        """
+        attempts = self.attempts + 1
+        if (is_permanent_error(exception)
+                or (email_configuration.max_attempts
+                    and attempts >= email_configuration.max_attempts)):
+            if email_configuration.error:
+                logger.error('Message %s moved to error mailbox after %s '
+                    'attempts: %s' % (self.id, attempts, exception))
+                return (attempts, email_configuration.error.id,
+                    self.flag_send, None)
+            logger.error('Message %s kept in its mailbox after %s attempts, '
+                'no error mailbox is configured: %s'
+                % (self.id, attempts, exception))
+        else:
+            logger.error('Messages not sent: %s' % (exception,))
+        delay = retry_delay(attempts, email_configuration.retry_delay,
+            email_configuration.retry_max_delay)
+        # Rounded to the minute to keep the states grouped
+        next_attempt_at = (datetime.now() + timedelta(seconds=delay + 59)
+            ).replace(second=0, microsecond=0)
+        return (attempts, self.mailbox.id, self.flag_send, next_attempt_at)
+
+    @classmethod
+    def _delivery_jobs(cls, emails, max_recipients=None):
+        """
+        Returns the jobs sending emails, ordered by priority and domain of
+        their first recipient. Emails with the same file and sender are
+        merged in one job of at most max_recipients recipients (the
+        smtp_merge_recipients option of the electronic_mail section, default
+        100, 0 does not merge).
+
+        The key of each job is the list of (email id, recipients) it sends.
+        """
+        if max_recipients is None:
+            max_recipients = config.getint('electronic_mail',
+                'smtp_merge_recipients', default=100)
+
+        def order(item):
+            email, recipients = item
+            domain = recipients[0].rpartition('@')[2].lower() if recipients \
+                else ''
+            return (email.priority, domain)
+        # sorted keeps the date order of the emails of a same domain
+        emails = sorted(((e, e.recipients_from_fields()) for e in emails),
+            key=order)
+
+        jobs = []
+        merged = {}
+        for email, recipients in emails:
+            key = email._storage_key()
+            job = merged.get((email.from_, key)) if key else None
+            if job and recipients:
+                keys, to_addrs = job[0], job[2]
+                new_recipients = [r for r in recipients if r not in to_addrs]
+                if len(to_addrs) + len(new_recipients) <= max_recipients:
+                    keys.append((email.id, recipients))
+                    to_addrs.extend(new_recipients)
+                    continue
+            job = ([(email.id, recipients)], email.from_, list(recipients),
+                email._open_email())
+            jobs.append(job)
+            if key and recipients and len(recipients) < max_recipients:
+                merged[(email.from_, key)] = job
+        return jobs
 
     @classmethod
-    def send_emails(cls, emails):
+    def send_emails(cls, emails, commit=False):
+        """
+        Sends emails grouped by SMTP server, identical emails merged in one
+        transaction (see _delivery_jobs)
+
+        :param commit: commit the transaction each time the states are
+            written, so a crash does not lose more than flush_interval
+            emails already sent
+        """
         pool = Pool()
         EMailConfiguration = pool.get('electronic.mail.configuration')
         email_configuration = EMailConfiguration(1)
         sent_mailbox = email_configuration.sent
+        flush_interval = config.getint('electronic_mail', 'flush_interval',
+            default=500)
+
+        def server_id(email):
+            server = email.mailbox.smtp_server
+            return server.id if server else 0
+        # groupby only groups consecutive emails
+        grouped_emails = groupby(sorted(emails, key=server_id),
+            key=lambda email: email.mailbox.smtp_server)
+        states = {}
+        pending = 0
+
+        def flush():
+            cls._write_send_states(states)
+            if commit:
+                Transaction().commit()
 
-        grouped_emails = groupby(emails, operator.attrgetter('mailbox'))
-
-        for mailbox, emails in grouped_emails:
-            smtp_server = None
-            if not mailbox.smtp_server:
-                logger.error('Not configured SMTP server '
-                    'in mailbox %s' % (mailbox.name))
-                continue
-            try:
-                smtp_server = mailbox.smtp_server.get_smtp_server()
-            except (error, gaierror, SMTPAuthenticationError), e:
+        try:
+            for server, emails in grouped_emails:
+                emails = list(emails)
+                if not server:
+                    for mailbox in set(e.mailbox for e in emails):
+                        logger.error('Not configured SMTP server '
+                            'in mailbox %s' % (mailbox.name))
+                    continue
+                jobs = cls._delivery_jobs(emails)
+                asynchronous = use_asyncio(server)
+                workers = cls._smtp_workers(len(jobs), server, asynchronous)
+                connections = []
                 try:
-                    cls.raise_user_error('smtp_error', error_args=(e,))
-                except UserError:
-                    logger.error('Messages not sent: %s' % (e,))
-            else:
-                for email in emails:
-                    email.attempts += 1
+                    if asynchronous:
+                        delivery = AsyncDeliveryPool.from_server(server,
+                            workers)
+                        delivery.open()
+                    else:
+                        try:
+                            for _ in range(workers):
+                                # Only wait for the first connection if the
+                                # server has already all its connections in
+                                # use
+                                try:
+                                    smtp_server = smtp_pool.get(server,
+                                        block=not connections)
+                                except (EnvironmentError, SMTPException), e:
+                                    if not connections:
+                                        raise
+                                    # Send with the connections opened
+                                    logger.warning('Only %s connections '
+                                        'opened to SMTP server %s: %s'
+                                        % (len(connections), server.id, e))
+                                    break
+                                if not smtp_server:
+                                    break
+                                connections.append(smtp_server)
+                            delivery = DeliveryPool(connections)
+                        except:
+                            for smtp_server in connections:
+                                smtp_pool.put(smtp_server)
+                            raise
+                # socket errors are IOError, asyncio ones OSError
+                except (EnvironmentError, SMTPException), e:
                     try:
-                        smtp_server.sendmail(email.from_,
-                            email.recipients_from_fields(), email._get_email())
-                    except SMTPException, e:
+                        cls.raise_user_error('smtp_error', error_args=(e,))
+                    except UserError:
                         logger.error('Messages not sent: %s' % (e,))
-                    else:
-                        logger.info('Send email: %s' % email.rec_name)
-                        email.mailbox = sent_mailbox
-                        email.flag_send = True
-                    finally:
-                        email.save()
-            finally:
-                smtp_server.quit()
+                    # Sent by the next run instead of after the lease expiry
+                    with Transaction().set_context(check_email=False):
+                        cls.write(emails, {'leased_until': None})
+                    continue
+
+                opened = len(delivery.connections)
+                start = time()
+                sent = 0
+                # sent and failed emails by mailbox
+                mailbox_results = {}
+                records = dict((email.id, email) for email in emails)
+                try:
+                    for keys, e, refused in delivery.deliver(jobs):
+                        for email_id, recipients in keys:
+                            email = records[email_id]
+                            error = e
+                            if (not error and refused and recipients
+                                    and all(r in refused
+                                        for r in recipients)):
+                                error = SMTPRecipientsRefused(dict(
+                                        (r, refused[r]) for r in recipients))
+                            if error:
+                                state = email._get_failed_state(error,
+                                    email_configuration)
+                                result = ('retry'
+                                    if state[1] == email.mailbox.id
+                                    else 'error')
+                            else:
+                                logger.info('Send email: %s'
+                                    % email.rec_name)
+                                state = (email.attempts + 1,
+                                    sent_mailbox.id, True, None)
+                                sent += 1
+                                result = 'sent'
+                            metrics.inc('electronic_mail_sent_total',
+                                server=server.id, result=result)
+                            results = mailbox_results.setdefault(
+                                email.mailbox.name, [0, 0])
+                            results[result != 'sent'] += 1
+                            states.setdefault(state, []).append(email.id)
+                            pending += 1
+                        if pending >= flush_interval:
+                            flush()
+                            pending = 0
+                finally:
+                    if asynchronous:
+                        delivery.close()
+                    for smtp_server in connections:
+                        smtp_pool.put(smtp_server)
+                elapsed = time() - start
+                metrics.observe('electronic_mail_send_seconds', elapsed,
+                    server=server.id)
+                metrics.inc('electronic_mail_merged_total',
+                    len(emails) - len(jobs), server=server.id)
+                logger.info('SMTP server %s: %s sent, %s failed in %.2fs '
+                    '(%.2f emails/s, %s transactions, %s connections)'
+                    % (server.id, sent, len(emails) - sent, elapsed,
+                        len(emails) / elapsed if elapsed else 0.0,
+                        len(jobs), opened))
+                for name, (mailbox_sent, failed) in sorted(
+                        mailbox_results.iteritems()):
+                    logger.info('Mailbox %s: %s sent, %s failed '
+                        '(%.2f emails/s)' % (name, mailbox_sent, failed,
+                            (mailbox_sent + failed) / elapsed
+                            if elapsed else 0.0))
+        finally:
+            flush()
 
     def send_email(self):
         pool = Pool()
@@ -482,50 +923,66 @@ class ElectronicMail(ModelSQL, ModelView):
             server, = servers
 
         try:
-            smtp_server = server.get_smtp_server()
-            smtp_server.sendmail(self.from_, recipients, self._get_email())
-            smtp_server.quit()
+            smtp_server = smtp_pool.get(server,
+                timeout=config.getint('electronic_mail', 'smtp_wait_timeout',
+                    default=60))
+            if not smtp_server:
+                self.raise_user_error('smtp_error', error_args=(
+                        'all the connections of the server are in use',))
+            try:
+                smtp_server.sendmail(self.from_, recipients,
+                    self._open_email())
+            finally:
+                smtp_pool.put(smtp_server)
             self.flag_send = True
             self.save()
-        except (error, gaierror, SMTPAuthenticationError), e:
+            metrics.inc('electronic_mail_sent_total',
+                server=server.id, result='sent')
+        except (error, gaierror, IOError, SMTPAuthenticationError), e:
+            metrics.inc('electronic_mail_sent_total',
+                server=server.id, result='error')
             try:
                 self.raise_user_error('smtp_error',
                     error_args=(e,))
             except UserError:
                 logger.error(' Message not sent: %s' % (e,))
                 return False
+        finally:
+            # Not written by each email sent from the form
+            metrics.export_if_due()
         return True
 
+    def _get_headers(self):
+        """
+        Returns the headers of the email file as a Message without payload.
+        Only the headers are read and they are parsed once per record.
+        """
+        if '_headers' not in self.__dict__:
+            key = self._storage_key()
+            head = get_storage().get_head(key) if key else None
+            self._headers = HeaderParser().parsestr(head) if head else None
+        return self._headers
+
+    def _get_addresses(self, header):
+        addresses = []
+        headers = self._get_headers()
+        if headers:
+            for name, address in getaddresses(headers.get_all(header, [])):
+                addresses.append((_decode_header(name),
+                        _decode_header(address)))
+        return addresses
+
     @property
     def all_to(self):
-        email = msg_from_string(self.email_file)
-        parse_all_to = []
-        if email:
-            all_to = getaddresses(email.get_all('to', []))
-            for to in all_to:
-                parse_all_to.append((_decode_header(to[0]), _decode_header(to[1])))
-        return parse_all_to
+        return self._get_addresses('to')
 
     @property
     def all_cc(self):
-        email = msg_from_string(self.email_file)
-        parse_all_cc = []
-        if email:
-            all_cc = getaddresses(email.get_all('cc', []))
-            for cc in all_cc:
-                parse_all_cc.append((_decode_header(cc[0]), _decode_header(cc[1])))
-        return parse_all_cc
+        return self._get_addresses('cc')
 
     @property
     def all_bcc(self):
-        email = msg_from_string(self.email_file)
-        parse_all_bcc = []
-        if email:
-            all_bcc = getaddresses(email.get_all('bcc', []))
-            for bcc in all_bcc:
-                parse_all_bcc.append(
-                    (_decode_header(bcc[0]), _decode_header(bcc[1])))
-        return parse_all_bcc
+        return self._get_addresses('bcc')
 
     @staticmethod
     def default_collision():
@@ -563,6 +1020,54 @@ class ElectronicMail(ModelSQL, ModelView):
             ('bcc',) + tuple(clause[1:]),
             ]
 
+    @classmethod
+    def _full_text_index(cls, name):
+        index_name, columns = FULL_TEXT_INDEXES[name]
+        return get_full_text(cls._table, index_name, columns)
+
+    @classmethod
+    def get_full_text(cls, records, name):
+        return dict((r.id, None) for r in records)
+
+    @classmethod
+    def search_full_text(cls, name, clause):
+        """
+        Searches the emails containing words starting by each word of the
+        value. Without full text index, it falls back to ilike on each
+        column.
+        """
+        _, operator, value = clause[:3]
+        negative = operator.startswith('!') or operator.startswith('not ')
+        index = cls._full_text_index(name)
+        query = index.match(value) if index else None
+        if query is not None:
+            return [('id', 'not in' if negative else 'in', query)]
+        columns = FULL_TEXT_INDEXES[name][1]
+        value = value if '%' in (value or '') else '%%%s%%' % (value or '')
+        return [('AND' if negative else 'OR')] + [
+            (c, 'not ilike' if negative else 'ilike', value)
+            for c in columns]
+
+    @classmethod
+    def search_full_text_ranked(cls, text, domain=None, limit=None,
+            name='full_text'):
+        """
+        Returns the emails matching text and domain ordered by relevance
+        """
+        index = cls._full_text_index(name)
+        # The domain filters after the ranking so it must not be limited
+        query = (index.ranked(text, limit=None if domain else limit)
+            if index else None)
+        if query is None:
+            return cls.search([(name, 'ilike', text)] + (domain or []),
+                limit=limit)
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*query)
+        ids = [r[0] for r in cursor.fetchall()]
+        records = cls.search([('id', 'in', ids)] + (domain or []))
+        position = dict((id_, i) for i, id_ in enumerate(ids))
+        return sorted(records, key=lambda r: position[r.id])[:limit]
+
     @classmethod
     def get_rec_name(cls, records, name):
         if not records:
@@ -572,9 +1077,14 @@ class ElectronicMail(ModelSQL, ModelView):
             res[mail.id] = '%s (ID: %s)' % (mail.subject, mail.id)
         return res
 
-    def get_body(self, msg):
+    def get_body(self, msg, key=None):
         """Returns the email body
+
+        :param key: key of the email file, to cache the detected charsets
         """
+        def decode(part, *index):
+            return _decode_body(part, key + index if key else None)
+
         maintype_text = {
             'body_plain': "",
             'body_html': ""
@@ -582,16 +1092,16 @@ class ElectronicMail(ModelSQL, ModelView):
         maintype_multipart = maintype_text.copy()
         if msg:
             if not msg.is_multipart():
-                decode_body = _decode_body(msg)
+                decode_body = decode(msg, 0)
                 if msg.get_content_subtype() == "html":
                     maintype_text['body_html'] = decode_body
                 else:
                     maintype_text['body_plain'] = decode_body
             else:
-                for part in msg.walk():
+                for i, part in enumerate(msg.walk()):
                     maintype = part.get_content_maintype()
                     if maintype == 'text':
-                        decode_body = _decode_body(part)
+                        decode_body = decode(part, i)
                         if part.get_content_subtype() == "html":
                             maintype_text['body_html'] = decode_body
                         else:
@@ -599,15 +1109,15 @@ class ElectronicMail(ModelSQL, ModelView):
                     if maintype_text['body_plain'] and maintype_text['body_html']:
                         break
                     if maintype == 'multipart':
-                        for p in part.get_payload():
+                        for j, p in enumerate(part.get_payload()):
                             if p.get_content_maintype() == 'text':
-                                decode_body = _decode_body(p)
+                                decode_body = decode(p, i, j)
                                 if p.get_content_subtype() == 'html':
                                     maintype_multipart['body_html'] = decode_body
                                 else:
                                     maintype_multipart['body_plain'] = decode_body
                     elif maintype != 'multipart' and not part.get_filename():
-                        decode_body = _decode_body(part)
+                        decode_body = decode(part, i)
                         if not maintype_multipart['body_plain']:
                             maintype_multipart['body_plain'] = decode_body
                         if not maintype_multipart['body_html']:
@@ -619,11 +1129,18 @@ class ElectronicMail(ModelSQL, ModelView):
         return maintype_text
 
     @staticmethod
-    def get_attachments(msg):
+    def get_attachments(msg, load=None, name=None):
+        """
+        Returns the attachments of msg
+
+        :param load: function called with the part number in walk order and
+            the part of the attachments returned, to set its body
+        :param name: return only the attachments with this filename
+        """
         attachments = []
         if msg:
             counter = 1
-            for part in msg.walk():
+            for number, part in enumerate(msg.walk()):
                 if part.get_content_maintype() == 'multipart':
                     continue
                 if part.get('Content-Disposition') is None:
@@ -637,6 +1154,10 @@ class ElectronicMail(ModelSQL, ModelView):
                             ext = '.bin'
                         filename = 'part-%03d%s' % (counter, ext)
                     counter += 1
+                    if name is not None and filename != name:
+                        continue
+                    if load:
+                        load(number, part)
 
                     data = part.get_payload(decode=True)
                     content_type = part.get_content_type()
@@ -649,127 +1170,450 @@ class ElectronicMail(ModelSQL, ModelView):
                             })
         return attachments
 
+    @classmethod
+    def _mailbox_acl(cls, records):
+        """
+        Returns a dict of the owner, read and write users by mailbox id of the
+        mailboxes of records, read once per transaction
+        """
+        Mailbox = Pool().get('electronic.mail.mailbox')
+        cache = Transaction().get_cache().setdefault(ACL_CACHE, {})
+        missing = {r.mailbox.id for r in records} - set(cache)
+        if missing:
+            for values in Mailbox.read(list(missing),
+                    ['user', 'read_users', 'write_users']):
+                cache[values['id']] = values
+        return cache
+
     @classmethod
     def get_mailbox_owner(cls, records, name):
         "Returns owner of mailbox"
-        mails = records
-        return dict([(mail.id, mail.mailbox.user.id) for mail in mails])
+        acl = cls._mailbox_acl(records)
+        return dict((mail.id, acl[mail.mailbox.id]['user'])
+            for mail in records)
 
     @classmethod
     def get_mailbox_users(cls, records, names):
+        acl = cls._mailbox_acl(records)
         res = {}
         for name in names:
             assert name in ('mailbox_read_users', 'mailbox_write_users')
-            for mail in records:
-                res[name][mail.id] = [x.id for x in mail.mailbox[name[8:]]]
+            res[name] = dict((mail.id, acl[mail.mailbox.id][name[8:]])
+                for mail in records)
         return res
 
     @classmethod
     def search_mailbox_owner(cls, name, clause):
-        return [('mailbox.user',) + clause[1:]]
+        return [('mailbox.user',) + tuple(clause[1:])]
 
     @classmethod
     def search_mailbox_users(cls, name, clause):
-        return [('mailbox.' + name[8:],) + clause[1:]]
+        "Joins the mailboxes with the relation table instead of the users"
+        pool = Pool()
+        Relation = pool.get({
+                'mailbox_read_users': 'electronic.mail.mailbox.read.res.user',
+                'mailbox_write_users':
+                    'electronic.mail.mailbox.write.res.user',
+                }[name])
+        relation = Relation.__table__()
+        user = Relation._fields['user']
+        where = user.convert_domain(('user',) + tuple(clause[1:]),
+            {None: (relation, None)}, Relation)
+        return [('mailbox', 'in',
+                relation.select(relation.mailbox, where=where))]
+
+    def _storage_key(self):
+        """
+        Returns the key of the email file in the storage. Emails stored with
+        an MD5 digest may have a collision suffix.
+        """
+        return storage_key(self.digest, self.collision)
 
     def _get_email(self):
         """
-        Returns the email object from reading the FS
+        Returns the email object from reading the storage
         :param electronic_mail: Browse Record of the mail
         """
-        db_name = Transaction().database.name
         value = u''
-        if self.digest:
-            filename = self.digest
-            if self.collision:
-                filename = filename + '-' + str(self.collision)
-            filename = os.path.join(config.get('database', 'path'),
-                db_name, 'email', filename[0:2], filename)
-            try:
-                with open(filename, 'rb') as file_p:
-                    value = fields.Binary.cast(file_p.read())
-            except IOError:
-                pass
+        key = self._storage_key()
+        if key:
+            with metrics.timer('electronic_mail_storage_read_seconds'):
+                data = get_storage().get(key)
+            if data is not None:
+                metrics.inc('electronic_mail_storage_read_bytes_total',
+                    len(data))
+                value = fields.Binary.cast(data)
+            else:
+                logger.error('Email file %s of email %s not found'
+                    % (key, self.id))
         return value
 
+    def _open_email(self):
+        """
+        Returns a function that opens the email file as a file-like object
+        reading it by chunks. It can be called from any thread. Its size
+        attribute is the size of the email.
+        """
+        key = self._storage_key()
+        storage = get_storage()
+
+        def open_email():
+            file_p = storage.open(key) if key else None
+            if file_p is None:
+                raise IOError('Email file %s not found' % key)
+            return file_p
+        open_email.size = self.size
+        return open_email
+
+    def _get_attachments(self, name=None):
+        """
+        Returns the attachments of the email file, only the ones with
+        filename name if given. If the parts of the file are stored apart,
+        only the parts of the attachments returned are read.
+        """
+        key = self._storage_key()
+        if not key:
+            return []
+        storage = get_storage()
+        split = storage.get_split(key)
+        if split is None:
+            file_p = storage.open(key)
+            if file_p is None:
+                return []
+            with file_p:
+                msg = Parser().parse(file_p)
+            return self.get_attachments(msg, name=name)
+        skeleton, index = split
+        parts = dict((number, part_key)
+            for _, number, part_key, _ in index)
+
+        def load(number, part):
+            if number in parts:
+                part.set_payload(storage.get_part(parts[number]))
+        return self.get_attachments(message_from_string(skeleton), load=load,
+            name=name)
+
+    @classmethod
+    def parse_email(cls, email_file, key=None):
+        """
+        Returns a dict with the body_plain, body_html and num_attach of an
+        email file. The charsets detected are cached by storage key.
+        """
+        if key:
+            key = (Transaction().database.name, key)
+        with metrics.timer('electronic_mail_parse_seconds'):
+            email = (msg_from_string(fields.Binary.cast(email_file))
+                if email_file else None)
+            body = cls().get_body(email, key)
+            return {
+                'body_plain': body.get('body_plain'),
+                'body_html': body.get('body_html'),
+                'num_attach': len(cls.get_attachments(email)),
+                }
+
     @classmethod
     def get_email(cls, mails, names):
-        result = {}
-        for fname in ['body_plain', 'body_html', 'num_attach', 'email_file']:
-            result[fname] = {}
+        result = {'email_file': {}}
         for mail in mails:
             email_file = mail._get_email() or None
             result['email_file'][mail.id] = (fields.Binary.cast(email_file)
                 if email_file else None)
-            email = msg_from_string(email_file)
-            body = cls.get_body(mail, email)
-            result['body_plain'][mail.id] = body.get('body_plain')
-            result['body_html'][mail.id] = body.get('body_html')
-            result['num_attach'][mail.id] = len(cls.get_attachments(email))
-        for fname in ['body_plain', 'body_html', 'num_attach', 'email_file']:
-            if fname not in names:
-                del result[fname]
         return result
 
     @classmethod
     def set_email(cls, records, name, data):
-        """Saves an email to the data path
+        """Saves an email to the storage
 
         :param data: Email as string
         """
         if data is False or data is None:
             return
-        db_name = Transaction().database.name
-        # Prepare Directory <DATA PATH>/<DB NAME>/email
-        directory = os.path.join(config.get('database', 'path'), db_name)
-        if not os.path.isdir(directory):
-            os.makedirs(directory, 0770)
+        cls.write(records, cls._store_email(data))
+
+    @classmethod
+    def _store_email(cls, data):
+        """
+        Saves an email file to the storage and returns the values of the
+        fields computed from it
+        """
         digest = cls.make_digest(data)
-        directory = os.path.join(directory, 'email', digest[0:2])
-        if not os.path.isdir(directory):
-            os.makedirs(directory, 0770)
-        # Filename <DIRECTORY>/<DIGEST>
-        filename = os.path.join(directory, digest)
-        collision = 0
-
-        if not os.path.isfile(filename):
-            # File doesnt exist already
-            with open(filename, 'w') as file_p:
-                file_p.write(data)
-        else:
-            # File already exists, may be its the same email data
-            # or maybe different.
-
-            # Case 1: If different: we have to write file with updated
-            # Collission index
-
-            # Case 2: Same file: Leave it as such
-            with open(filename, 'r') as file_p:
-                data2 = file_p.read()
-            if data != data2:
-                cursor = Transaction().connection.cursor()
-                cursor.execute(
-                    'SELECT DISTINCT(collision) FROM electronic_mail '
-                    'WHERE digest = %s AND collision !=0 '
-                    'ORDER BY collision', (digest,))
-                collision2 = 0
-                for row in cursor.fetchall():
-                    collision2 = row[0]
-                    filename = os.path.join(
-                        directory, digest + '-' + str(collision2))
-                    if os.path.isfile(filename):
-                        with open(filename, 'r') as file_p:
-                            data2 = file_p.read()
-                        if data == data2:
-                            collision = collision2
-                            break
-                if collision == 0:
-                    collision = collision2 + 1
-                    filename = os.path.join(
-                        directory, digest + '-' + str(collision))
-                    with open(filename, 'w') as file_p:
-                        file_p.write(data)
-        cls.write(records, {'digest': digest, 'collision': collision})
+        storage = get_storage()
+        # The SHA-256 digest addresses the content: an existing file with
+        # the same digest has the same data. It is touched so that it is not
+        # deleted as orphan before this transaction is committed.
+        if not storage.touch(digest):
+            with metrics.timer('electronic_mail_storage_write_seconds'):
+                storage.put(digest, data)
+        values = {'digest': digest, 'collision': 0}
+        values.update(cls.parse_email(data, digest))
+        return values
+
+    @classmethod
+    def backfill_bodies(cls, args=None):
+        """
+        Fills body_plain, body_html and num_attach of the emails saved before
+        they were stored. This method is intended to be called from ir.cron
+        @param args: Number of emails processed by each commit
+        """
+        batch_size = None
+        if args:
+            try:
+                batch_size = int(args)
+            except (TypeError, ValueError):
+                pass
+        cls._backfill_bodies(batch_size=batch_size, commit=True)
+
+    @classmethod
+    def _backfill_bodies(cls, batch_size=None, commit=False):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        sql_table = cls.__table__()
+        storage = get_storage()
+        if not batch_size:
+            batch_size = config.getint('electronic_mail', 'backfill_batch',
+                default=1000)
+
+        cursor.execute(*sql_table.select(Count(sql_table.id),
+                where=(sql_table.num_attach == None)))
+        total, = cursor.fetchone()
+        if not total:
+            return
+        logger.info('Backfill bodies of %s emails' % total)
+
+        start = time()
+        done = 0
+        last_id = 0
+        while True:
+            cursor.execute(*sql_table.select(
+                    sql_table.id, sql_table.digest, sql_table.collision,
+                    where=((sql_table.num_attach == None)
+                        & (sql_table.id > last_id)),
+                    order_by=sql_table.id.asc, limit=batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for id_, digest, collision in rows:
+                key = storage_key(digest, collision)
+                data = storage.get(key) if key else None
+                parsed = cls.parse_email(data, key)
+                cursor.execute(*sql_table.update(
+                        columns=[sql_table.body_plain, sql_table.body_html,
+                            sql_table.num_attach],
+                        values=[parsed['body_plain'], parsed['body_html'],
+                            parsed['num_attach']],
+                        where=(sql_table.id == id_)))
+            if commit:
+                transaction.commit()
+            last_id = rows[-1][0]
+            done += len(rows)
+            elapsed = time() - start
+            logger.info('Backfilled bodies of %s/%s emails (%.2f emails/s)'
+                % (done, total, done / elapsed if elapsed else 0.0))
+
+    @classmethod
+    def recompress_emails(cls, args=None):
+        """
+        Rewrites the email files stored with another compression than the
+        compression option. This method is intended to be called from ir.cron
+        @param args: Number of emails processed by each batch
+        """
+        batch_size = None
+        if args:
+            try:
+                batch_size = int(args)
+            except (TypeError, ValueError):
+                pass
+        cls._recompress_emails(batch_size=batch_size)
+
+    @classmethod
+    def _recompress_emails(cls, batch_size=None):
+        """
+        Rewrites the email files by batches of emails and returns the number
+        of files rewritten. Files already compressed with the compression
+        option are skipped, so it can be interrupted and run again.
+        """
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        storage = get_storage()
+        method, _ = compression_method()
+        if not batch_size:
+            batch_size = config.getint('electronic_mail', 'recompress_batch',
+                default=1000)
+
+        start = time()
+        done = rewritten = 0
+        last_id = 0
+        while True:
+            cursor.execute(*sql_table.select(
+                    sql_table.id, sql_table.digest, sql_table.collision,
+                    where=((sql_table.digest != Null)
+                        & (sql_table.id > last_id)),
+                    order_by=sql_table.id.asc, limit=batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            keys = set(storage_key(digest, collision)
+                for _, digest, collision in rows)
+            for key in keys:
+                if storage.compression(key) == method:
+                    continue
+                data = storage.get(key)
+                if data is None:
+                    continue
+                storage.put(key, data)
+                rewritten += 1
+            last_id = rows[-1][0]
+            done += len(rows)
+            elapsed = time() - start
+            logger.info('Recompressed %s files of %s emails (%.2f emails/s)'
+                % (rewritten, done, done / elapsed if elapsed else 0.0))
+        return rewritten
+
+    @classmethod
+    def check_storage(cls, args=None):
+        """
+        Reports the missing and corrupt email files and deletes the orphan
+        ones. This method is intended to be called from ir.cron
+        @param args: Days an orphan file is kept after its last write
+        """
+        grace_days = None
+        if args:
+            try:
+                grace_days = int(args)
+            except (TypeError, ValueError):
+                pass
+        cls._check_storage(grace_days=grace_days)
+
+    @classmethod
+    def _storage_keys(cls, batch_size):
+        "Yields the distinct storage keys of the emails in sorted order"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        collision = Coalesce(table.collision, 0)
+        last = None
+        while True:
+            where = table.digest != Null
+            if last:
+                where &= table.digest > last
+            cursor.execute(*table.select(table.digest, collision,
+                    where=where,
+                    group_by=[table.digest, collision],
+                    order_by=[table.digest.asc, collision.asc],
+                    limit=batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last, last_collision = rows[-1]
+            if len(rows) == batch_size:
+                # Each batch has all the collisions of its digests because
+                # the keys sort them as strings ('X-10' before 'X-2')
+                cursor.execute(*table.select(table.digest, collision,
+                        where=(table.digest == last)
+                        & (collision > last_collision),
+                        group_by=[table.digest, collision]))
+                rows.extend(cursor.fetchall())
+            for key in sorted(storage_key(d, c) for d, c in rows):
+                yield key
+
+    @classmethod
+    def _delete_orphans(cls, storage, keys):
+        """
+        Deletes the files of keys not used by any email and returns their
+        number. The emails are searched again as files may have been used
+        since the keys were read.
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        used = set()
+        for sub_keys in grouped_slice(keys):
+            digests = list(set(k.split('-')[0] for k in sub_keys))
+            cursor.execute(*table.select(table.digest,
+                    Coalesce(table.collision, 0),
+                    where=table.digest.in_(digests)))
+            used.update(storage_key(d, c) for d, c in cursor.fetchall())
+        deleted = 0
+        for key in keys:
+            if key not in used:
+                storage.delete(key)
+                deleted += 1
+        return deleted
+
+    @classmethod
+    def _check_storage(cls, grace_days=None, verify=None, delete=True):
+        """
+        Walks the email keys of the database and the files of the storage in
+        sorted order, so memory does not grow with their number, and returns
+        a dict with the number of each finding.
+
+        Missing and corrupt (with verify) files are logged. Orphan files
+        written more than grace_days ago are deleted if delete is True.
+        The parts stored apart are checked the same way.
+        """
+        storage = get_storage()
+        batch_size = config.getint('electronic_mail', 'check_batch',
+            default=1000)
+        if grace_days is None:
+            grace_days = config.getint('electronic_mail', 'orphan_grace_days',
+                default=7)
+        if verify is None:
+            verify = config.getboolean('electronic_mail', 'check_verify',
+                default=False)
+        limit = time() - grace_days * 24 * 60 * 60
+        report = dict.fromkeys(['files', 'missing', 'corrupt', 'orphans',
+                'deleted', 'parts', 'missing_parts', 'corrupt_parts',
+                'orphan_parts', 'deleted_parts'], 0)
+        has_parts = next(iter(storage.parts.keys()), None) is not None
+        part_keys = tempfile.TemporaryFile() if has_parts else None
+
+        def check(storage, keys, parts=False):
+            "Yields the batches of orphan keys to delete"
+            suffix, name = ('_parts', 'part file') if parts else ('', 'file')
+            orphans = []
+            for key, in_database, in_storage in keys:
+                if in_database and not in_storage:
+                    logger.warning('Missing email %s %s' % (name, key))
+                    report['missing' + suffix] += 1
+                    continue
+                if has_parts and not parts:
+                    # Also the parts of orphans, which may be kept or used
+                    # again, those of deleted orphans are deleted next check.
+                    # Keys of the JSON index are unicode, writelines would
+                    # write their internal buffer
+                    part_keys.writelines('%s\n' % str(p[2])
+                        for p in storage.get_index(key) or [])
+                if in_database:
+                    report['parts' if parts else 'files'] += 1
+                    if verify and not storage.verify(key):
+                        logger.warning('Corrupt email %s %s' % (name, key))
+                        report['corrupt' + suffix] += 1
+                    continue
+                report['orphans' if not parts else 'orphan_parts'] += 1
+                modified = storage.modified(key)
+                if delete and modified is not None and modified < limit:
+                    orphans.append(key)
+                if len(orphans) >= batch_size:
+                    yield orphans
+                    orphans = []
+            if orphans:
+                yield orphans
+
+        for orphans in check(storage,
+                merge_keys(cls._storage_keys(batch_size), storage.keys())):
+            report['deleted'] += cls._delete_orphans(storage, orphans)
+        if has_parts:
+            # Parts are only used by the stored files just walked
+            part_keys.seek(0)
+            with closing(part_keys):
+                for orphans in check(storage.parts,
+                        merge_keys(sorted_keys(k[:-1] for k in part_keys),
+                            storage.parts.keys()),
+                        parts=True):
+                    for key in orphans:
+                        storage.parts.delete(key)
+                    report['deleted_parts'] += len(orphans)
+        logger.info('Checked email storage: %s' % ', '.join(
+                '%s %s' % (v, k) for k, v in sorted(report.iteritems())))
+        return report
 
     @staticmethod
     def make_digest(data):
@@ -779,28 +1623,20 @@ class ElectronicMail(ModelSQL, ModelView):
         :param data: Data String
         :return: Digest
         """
-        if hashlib:
-            digest = hashlib.md5(data).hexdigest()
-        else:
-            digest = md5.new(data).hexdigest()
-        return digest
+        return hashlib.sha256(data).hexdigest()
 
-    @classmethod
-    def create_from_email(cls, mail, mailbox, context={}):
+    @staticmethod
+    def _get_email_values(mail, mailbox, context=None):
         """
-        Creates a mail record from a given mail
-        :param mail: Email
-        :param mailbox: Mailbox
-        :param context: dict
+        Returns the values of the mail record of a given mail without its
+        email file
         """
+        if context is None:
+            context = {}
         email_date = (_decode_header(mail.get('date', "")) and
             datetime.fromtimestamp(
                 mktime(parsedate(mail.get('date')))))
-        if not mailbox:
-            logger.error('Not mailbox configured.')
-            return
-
-        values = {
+        return {
             'mailbox': mailbox.id,
             'from_': _decode_header(mail.get('from')),
             'sender': _decode_header(mail.get('sender')),
@@ -814,14 +1650,132 @@ class ElectronicMail(ModelSQL, ModelView):
             'deliveredto': _decode_header(mail.get('delivered-to')),
             'reference': _decode_header(mail.get('references')),
             'reply_to': _decode_header(mail.get('reply-to')),
-            'email_file': mail.as_string(),
             }
 
-        if not PyPy:
-            values['size'] = getsizeof(mail.as_string())
+    @classmethod
+    def create_from_email(cls, mail, mailbox, context={}):
+        """
+        Creates a mail record from a given mail
+        :param mail: Email
+        :param mailbox: Mailbox
+        :param context: dict
+        """
+        emails = cls.create_from_emails([mail], mailbox, context)
+        return emails[0] if emails else None
 
-        email = cls.create([values])[0]
-        return email
+    @classmethod
+    def create_from_emails(cls, mails, mailbox, context=None):
+        """
+        Creates the mail records of given mails with a single create.
+        Each mail is serialized once and its file saved before the create.
+        :param mails: list of Email
+        :param mailbox: Mailbox
+        :param context: dict
+        :return: list of mail records in the order of mails
+        """
+        if not mailbox:
+            logger.error('Not mailbox configured.')
+            return []
+
+        vlist = []
+        for mail in mails:
+            data = mail.as_string()
+            values = cls._get_email_values(mail, mailbox, context)
+            values.update(cls._store_email(data))
+            if not PyPy:
+                values['size'] = getsizeof(data)
+            vlist.append(values)
+        return cls.create(vlist)
+
+    @classmethod
+    def import_mailbox(cls, path, mailbox, batch_size=None, commit=True):
+        """
+        Imports the messages of an mbox file or a Maildir directory.
+
+        Messages are read one at a time and created by batches, each one
+        committed, so an interrupted import can be run again: messages whose
+        Message-ID or content already exist in the mailbox are skipped.
+
+        :param path: mbox file or Maildir directory
+        :param mailbox: Mailbox
+        :param batch_size: messages created by each commit
+        :param commit: if False, the batches are not committed
+        :return: number of created and skipped messages
+        """
+        transaction = Transaction()
+        if not batch_size:
+            batch_size = config.getint('electronic_mail', 'import_batch',
+                default=500)
+        if os.path.isdir(path):
+            archive = Maildir(path, factory=None, create=False)
+        else:
+            archive = mbox(path, create=False)
+
+        start = time()
+        created = skipped = 0
+        batch = []
+
+        def flush():
+            message_ids = set(v['message_id'] for v in batch
+                if v['message_id'])
+            digests = set(v['digest'] for v in batch)
+            existing = cls.search([
+                    ('mailbox', '=', mailbox.id),
+                    ['OR',
+                        ('message_id', 'in', list(message_ids)),
+                        ('digest', 'in', list(digests)),
+                        ],
+                    ])
+            seen = (set(e.message_id for e in existing if e.message_id)
+                | set(e.digest for e in existing))
+            to_create = []
+            for values in batch:
+                if (values['digest'] in seen
+                        or values['message_id'] in seen):
+                    continue
+                seen.add(values['digest'])
+                if values['message_id']:
+                    seen.add(values['message_id'])
+                to_create.append(values)
+            # Archived messages are imported as they are
+            with transaction.set_context(check_email=False):
+                cls.create(to_create)
+            if commit:
+                transaction.commit()
+            del batch[:]
+            return len(to_create)
+
+        for key in archive.iterkeys():
+            try:
+                mail = archive.get_message(key)
+                values = cls._get_email_values(mail, mailbox)
+                data = mail.as_string()
+            except Exception, e:
+                logger.warning('Message %s of %s not imported: %s'
+                    % (key, path, e))
+                skipped += 1
+                continue
+            values.update(cls._store_email(data))
+            if not PyPy:
+                values['size'] = getsizeof(data)
+            batch.append(values)
+            if len(batch) >= batch_size:
+                count = len(batch)
+                new = flush()
+                created += new
+                skipped += count - new
+                elapsed = time() - start
+                logger.info('Imported %s messages of %s, %s skipped '
+                    '(%.2f messages/s)' % (created, path, skipped,
+                        (created + skipped) / elapsed if elapsed else 0.0))
+        if batch:
+            count = len(batch)
+            new = flush()
+            created += new
+            skipped += count - new
+        logger.info('Imported %s messages of %s, %s skipped in %.2fs'
+            % (created, path, skipped, time() - start))
+        return created, skipped
 
     @classmethod
     def validate_emails(cls, emails):
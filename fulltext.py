@@ -0,0 +1,299 @@
+# This file is part of electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from abc import ABCMeta, abstractmethod
+from sql import Table, Column
+from sql.conditionals import Coalesce
+from sql.functions import Function, Substring
+from sql.operators import BinaryOperator, Concat
+from trytond import backend
+from trytond.config import config
+from trytond.transaction import Transaction
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['FullTextIndex', 'get_full_text', 'register_trigram_indexes']
+
+# Characters of the concatenated columns indexed by PostgreSQL, whose
+# tsvector can not exceed 1MB
+MAX_LENGTH = 100000
+
+
+class ToTsvector(Function):
+    __slots__ = ()
+    _function = 'TO_TSVECTOR'
+
+
+class ToTsquery(Function):
+    __slots__ = ()
+    _function = 'TO_TSQUERY'
+
+
+class TsRank(Function):
+    __slots__ = ()
+    _function = 'TS_RANK'
+
+
+class TsMatch(BinaryOperator):
+    __slots__ = ()
+    _operator = '@@'
+
+
+class FtsMatch(BinaryOperator):
+    __slots__ = ()
+    _operator = 'MATCH'
+
+
+def tokens(text):
+    "Returns the lower case words of text"
+    if not isinstance(text, unicode):
+        text = unicode(text or '', 'utf-8', 'replace')
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+class FullTextIndex(object):
+    """
+    Full text index of some columns of a table.
+
+    name: index name, also used for the SQLite virtual table
+    columns: indexed column names
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, table, name, columns):
+        self.table = table
+        self.name = name
+        self.columns = columns
+
+    @abstractmethod
+    def register(self, cursor):
+        "Creates the index if it does not exist"
+
+    @abstractmethod
+    def match(self, text):
+        """
+        Returns a query of the ids of the rows containing words starting by
+        each word of text, or None if text has no word
+        """
+
+    @abstractmethod
+    def ranked(self, text, limit=None):
+        "Same as match but ordered by relevance"
+
+
+class PostgreSQLFullTextIndex(FullTextIndex):
+    "GIN index on the TO_TSVECTOR of the concatenated columns"
+
+    @staticmethod
+    def language():
+        return config.get('electronic_mail', 'full_text_language',
+            default='simple')
+
+    def register(self, cursor):
+        cursor.execute('SELECT indexdef FROM pg_indexes WHERE indexname = %s',
+            (self.name,))
+        row = cursor.fetchone()
+        if row:
+            if 'substring' in row[0].lower():
+                return
+            # Created before the indexed text was bounded
+            cursor.execute('DROP INDEX "%s"' % self.name)
+        logger.info('Create full text index %s' % self.name)
+        # Must be the same expression as _vector to be used by the planner
+        expression = " || ' ' || ".join('COALESCE("%s", \'\')' % c
+            for c in self.columns)
+        cursor.execute('CREATE INDEX "%s" ON "%s" '
+            'USING GIN (TO_TSVECTOR(%%s, SUBSTRING(%s FROM 1 FOR %s)))'
+            % (self.name, self.table, expression, MAX_LENGTH),
+            (self.language(),))
+
+    def _vector(self, table):
+        expression = None
+        for column in self.columns:
+            value = Coalesce(Column(table, column), '')
+            if expression is None:
+                expression = value
+            else:
+                expression = Concat(Concat(expression, ' '), value)
+        return ToTsvector(self.language(),
+            Substring(expression, 1, MAX_LENGTH))
+
+    def _query(self, text):
+        words = tokens(text)
+        if not words:
+            return
+        return ToTsquery(self.language(),
+            ' & '.join('%s:*' % w for w in words))
+
+    def match(self, text):
+        query = self._query(text)
+        if query is None:
+            return
+        table = Table(self.table)
+        return table.select(table.id,
+            where=TsMatch(self._vector(table), query))
+
+    def ranked(self, text, limit=None):
+        query = self._query(text)
+        if query is None:
+            return
+        table = Table(self.table)
+        vector = self._vector(table)
+        return table.select(table.id,
+            where=TsMatch(vector, query),
+            order_by=TsRank(vector, query).desc, limit=limit)
+
+
+class SQLiteFullTextIndex(FullTextIndex):
+    """
+    FTS virtual table kept up to date by triggers on the table.
+    Only available if SQLite is compiled with FTS5 or FTS4.
+    """
+    _module = None
+
+    def _existing_module(self, cursor):
+        cursor.execute('SELECT sql FROM sqlite_master '
+            'WHERE type = \'table\' AND name = ?', (self.name,))
+        row = cursor.fetchone()
+        if row:
+            return 'fts5' if 'fts5' in row[0].lower() else 'fts4'
+
+    @property
+    def module(self):
+        if self._module is None:
+            cursor = Transaction().connection.cursor()
+            self._module = self._existing_module(cursor) or ''
+        return self._module
+
+    def register(self, cursor):
+        columns = ', '.join('"%s"' % c for c in self.columns)
+        module = self._existing_module(cursor)
+        if module:
+            self._module = module
+            self._register_triggers(cursor)
+            return
+        for module in ('fts5', 'fts4'):
+            try:
+                cursor.execute('CREATE VIRTUAL TABLE "%s" USING %s(%s)'
+                    % (self.name, module, columns))
+            except Exception:
+                continue
+            self._module = module
+            break
+        else:
+            logger.warning('SQLite without FTS, full text search disabled')
+            return
+        self._register_triggers(cursor)
+        cursor.execute('INSERT INTO "%s" (rowid, %s) SELECT id, %s FROM "%s"'
+            % (self.name, columns, columns, self.table))
+
+    def _register_triggers(self, cursor):
+        "Creates the triggers keeping the FTS table up to date if missing"
+        columns = ', '.join('"%s"' % c for c in self.columns)
+        new_values = ', '.join('new."%s"' % c for c in self.columns)
+        insert = ('INSERT INTO "%s" (rowid, %s) VALUES (new.id, %s);'
+            % (self.name, columns, new_values))
+        delete = 'DELETE FROM "%s" WHERE rowid = old.id;' % self.name
+        # Only the updates of the indexed columns reindex the row, not the
+        # ones of the send states
+        for event, body in (
+                ('INSERT', insert),
+                ('DELETE', delete),
+                ('UPDATE OF %s' % columns, delete + ' ' + insert),
+                ):
+            trigger = '%s_%s' % (self.name, event.split()[0].lower())
+            sql = ('CREATE TRIGGER "%s" AFTER %s ON "%s" BEGIN %s END'
+                % (trigger, event, self.table, body))
+            cursor.execute('SELECT sql FROM sqlite_master '
+                'WHERE type = \'trigger\' AND name = ?', (trigger,))
+            row = cursor.fetchone()
+            if row and row[0] == sql:
+                continue
+            if row:
+                cursor.execute('DROP TRIGGER "%s"' % trigger)
+            cursor.execute(sql)
+
+    def _query(self, text):
+        words = tokens(text)
+        if not words or not self.module:
+            return
+        return ' '.join('%s*' % w for w in words)
+
+    def _where(self, fts, query):
+        if len(self.columns) == 1:
+            column = Column(fts, self.columns[0])
+        else:
+            column = Column(fts, self.name)
+        return FtsMatch(column, query)
+
+    def match(self, text):
+        query = self._query(text)
+        if query is None:
+            return
+        fts = Table(self.name)
+        return fts.select(Column(fts, 'rowid'),
+            where=self._where(fts, query))
+
+    def ranked(self, text, limit=None):
+        query = self._query(text)
+        if query is None:
+            return
+        fts = Table(self.name)
+        if self.module == 'fts5':
+            order_by = Column(fts, 'rank').asc
+        else:
+            order_by = Column(fts, 'rowid').desc
+        return fts.select(Column(fts, 'rowid'),
+            where=self._where(fts, query),
+            order_by=order_by, limit=limit)
+
+
+def register_trigram_indexes(cursor, table, columns):
+    """
+    Creates on PostgreSQL the trigram indexes of columns used by their ilike
+    searches if the pg_trgm extension is installed or can be installed
+    """
+    if backend.name() != 'postgresql':
+        return
+    cursor.execute('SELECT 1 FROM pg_extension WHERE extname = %s',
+        ('pg_trgm',))
+    if not cursor.fetchone():
+        cursor.execute('SAVEPOINT electronic_mail_trgm')
+        try:
+            cursor.execute('CREATE EXTENSION pg_trgm')
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT electronic_mail_trgm')
+            logger.warning('Unable to create the pg_trgm extension, the '
+                'searches of %s by name scan the table' % table)
+            return
+        cursor.execute('RELEASE SAVEPOINT electronic_mail_trgm')
+    for column in columns:
+        name = '%s_%s_trgm_idx' % (table, column.rstrip('_'))
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+            (name,))
+        if cursor.fetchone():
+            continue
+        logger.info('Create trigram index %s' % name)
+        cursor.execute('CREATE INDEX "%s" ON "%s" '
+            'USING GIN ("%s" gin_trgm_ops)' % (name, table, column))
+
+
+FULL_TEXT_INDEXES = {
+    'postgresql': PostgreSQLFullTextIndex,
+    'sqlite': SQLiteFullTextIndex,
+    }
+_indexes = {}
+
+
+def get_full_text(table, name, columns):
+    """
+    Returns the FullTextIndex of the database of the transaction or None if
+    its backend has no full text search
+    """
+    key = (Transaction().database.name, table, name)
+    if key not in _indexes:
+        Index = FULL_TEXT_INDEXES.get(backend.name())
+        _indexes[key] = Index(table, name, columns) if Index else None
+    return _indexes[key]
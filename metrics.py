@@ -0,0 +1,236 @@
+# This file is part of electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from contextlib import contextmanager
+from time import time
+from trytond.config import config
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Metrics', 'metrics']
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60)
+
+DESCRIPTIONS = {
+    'electronic_mail_sent_total': ('counter',
+        'Emails sent by SMTP server and result (sent, retry, error)'),
+    'electronic_mail_send_seconds': ('histogram',
+        'Time to send the emails of an SMTP server'),
+    'electronic_mail_merged_total': ('counter',
+        'Emails sent in the SMTP transaction of an identical email'),
+    'electronic_mail_smtp_connect_seconds': ('histogram',
+        'Time to connect and authenticate to the SMTP server'),
+    'electronic_mail_smtp_data_seconds': ('histogram',
+        'Time of an SMTP transaction (MAIL, RCPT and DATA)'),
+    'electronic_mail_smtp_errors_total': ('counter',
+        'SMTP transactions failed by exception'),
+    'electronic_mail_rate_limit_wait_seconds': ('histogram',
+        'Time waited for the rate limit of the SMTP server'),
+    'electronic_mail_storage_read_seconds': ('histogram',
+        'Time to read an email file from the storage'),
+    'electronic_mail_storage_read_bytes_total': ('counter',
+        'Bytes read from the storage'),
+    'electronic_mail_storage_write_seconds': ('histogram',
+        'Time to write an email file to the storage'),
+    'electronic_mail_parse_seconds': ('histogram',
+        'Time to parse the MIME structure of an email file'),
+    'electronic_mail_db_write_seconds': ('histogram',
+        'Time to write the send states of the emails'),
+    }
+
+
+def _labels(labels):
+    return tuple(sorted((k, unicode(v)) for k, v in labels.iteritems()))
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+
+
+class Metrics(object):
+    """
+    Thread safe registry of the counters and histograms of the process.
+
+    Each value is also given to the hooks added with add_hook, called as
+    hook(kind, name, value, labels) where kind is counter or histogram, so
+    that metrics can be sent to another monitoring system (statsd, ...).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._hooks = []
+        self._exported = True
+        self._last_export = 0
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def _notify(self, kind, name, value, labels):
+        for hook in self._hooks:
+            try:
+                hook(kind, name, value, labels)
+            except Exception:
+                logger.exception('Metrics hook %s failed' % hook)
+
+    def inc(self, name, value=1, **labels):
+        "Increments the counter name by value"
+        key = _labels(labels)
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+        self._notify('counter', name, value, labels)
+
+    def observe(self, name, value, **labels):
+        "Adds value to the histogram name"
+        key = _labels(labels)
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            buckets, total, count = histograms.get(key,
+                ([0] * len(BUCKETS), 0, 0))
+            buckets = [n + (value <= bound)
+                for n, bound in zip(buckets, BUCKETS)]
+            histograms[key] = (buckets, total + value, count + 1)
+        self._notify('histogram', name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        "Observes the seconds spent in the with block"
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start, **labels)
+
+    def counter(self, name, **labels):
+        return self._counters.get(name, {}).get(_labels(labels), 0)
+
+    def histogram(self, name, **labels):
+        "Returns the (sum, count) of the histogram name"
+        _, total, count = self._histograms.get(name, {}).get(
+            _labels(labels), (None, 0, 0))
+        return total, count
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def fork(self):
+        """
+        Clears the metrics of a process of run_processes, which does not
+        export them: its parent adds them with load(dump())
+        """
+        self._lock = threading.Lock()
+        self.clear()
+        self._exported = False
+
+    def dump(self):
+        "Returns the values of the metrics"
+        with self._lock:
+            return (dict((n, dict(v)) for n, v in self._counters.iteritems()),
+                dict((n, dict(v)) for n, v in self._histograms.iteritems()))
+
+    def load(self, dump):
+        "Adds the values returned by dump"
+        counters, histograms = dump
+        with self._lock:
+            for name, values in counters.iteritems():
+                current = self._counters.setdefault(name, {})
+                for key, value in values.iteritems():
+                    current[key] = current.get(key, 0) + value
+            for name, values in histograms.iteritems():
+                current = self._histograms.setdefault(name, {})
+                for key, (buckets, total, count) in values.iteritems():
+                    old_buckets, old_total, old_count = current.get(key,
+                        ([0] * len(BUCKETS), 0, 0))
+                    current[key] = (
+                        [a + b for a, b in zip(old_buckets, buckets)],
+                        old_total + total, old_count + count)
+
+    def prometheus(self):
+        "Returns the metrics in the Prometheus text format"
+        lines = []
+
+        def header(name, kind):
+            _, description = DESCRIPTIONS.get(name, (kind, name))
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self._lock:
+            for name, values in sorted(self._counters.iteritems()):
+                header(name, 'counter')
+                for labels, value in sorted(values.iteritems()):
+                    lines.append('%s%s %s' % (name, _format_labels(labels),
+                            value))
+            for name, values in sorted(self._histograms.iteritems()):
+                header(name, 'histogram')
+                for labels, (buckets, total, count) in sorted(
+                        values.iteritems()):
+                    for bound, n in zip(BUCKETS, buckets):
+                        lines.append('%s_bucket%s %s' % (name,
+                                _format_labels(labels, [('le', repr(bound))]),
+                                n))
+                    lines.append('%s_bucket%s %s' % (name,
+                            _format_labels(labels, [('le', '+Inf')]), count))
+                    lines.append('%s_sum%s %r' % (name,
+                            _format_labels(labels), total))
+                    lines.append('%s_count%s %s' % (name,
+                            _format_labels(labels), count))
+        return u'\n'.join(lines + ['']).encode('utf-8')
+
+    def export(self, filename=None):
+        """
+        Writes the metrics in the Prometheus text format to filename, by
+        default the metrics_file option of the electronic_mail section where
+        %(pid)s is replaced by the process id. Nothing is written if there is
+        no file.
+        """
+        if not self._exported:
+            return
+        self._last_export = time()
+        if filename is None:
+            filename = config.get('electronic_mail', 'metrics_file')
+            if not filename:
+                return
+            filename = filename % {'pid': os.getpid()}
+        directory = os.path.dirname(os.path.abspath(filename))
+        try:
+            # Written then renamed so collectors never read a partial file
+            fd, tmp_filename = tempfile.mkstemp(dir=directory,
+                prefix='.metrics')
+            with os.fdopen(fd, 'wb') as file_p:
+                file_p.write(self.prometheus())
+            os.chmod(tmp_filename, 0644)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError), e:
+            logger.warning('Unable to write metrics file %s: %s'
+                % (filename, e))
+
+    def export_if_due(self):
+        """
+        Exports the metrics if they were last exported more than the
+        metrics_interval seconds of the electronic_mail section ago (default
+        60)
+        """
+        interval = config.getint('electronic_mail', 'metrics_interval',
+            default=60)
+        if time() - self._last_export >= interval:
+            self.export()
+
+
+metrics = Metrics()
@@ -0,0 +1,683 @@
+# This file is part of electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from Queue import Queue, Empty
+from importlib import import_module
+from _socket import error
+from contextlib import closing
+from smtplib import (SMTPException, SMTPServerDisconnected,
+    SMTPResponseException, SMTPRecipientsRefused, SMTPSenderRefused,
+    SMTPDataError, CRLF)
+from time import sleep, time
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from .metrics import metrics
+import cPickle as pickle
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['DeliveryPool', 'SMTPConnection', 'SMTPConnectionPool',
+    'smtp_pool', 'is_permanent_error', 'retry_delay', 'TokenBucket',
+    'FileTokenBucket', 'FileSemaphore', 'quote_data', 'send_stream',
+    'run_processes']
+
+# Bytes sent to the SMTP server at once when streaming a message
+SEND_SIZE = 64 * 1024
+_LINE_BREAK = re.compile(r'\r\n|\n|\r')
+
+
+def is_permanent_error(exception):
+    """
+    Returns True if the sending error will not be solved by retrying: 5xx
+    replies of the server. 4xx replies and connection errors are transient.
+    """
+    if isinstance(exception, SMTPRecipientsRefused):
+        codes = [code for code, _ in exception.recipients.values()]
+        return bool(codes) and all(500 <= code < 600 for code in codes)
+    if isinstance(exception, SMTPResponseException):
+        return 500 <= exception.smtp_code < 600
+    return False
+
+
+def retry_delay(attempts, delay, max_delay, jitter=0.5):
+    """
+    Returns the seconds to wait before the next attempt: delay doubled on
+    each attempt up to max_delay, reduced by a random part of at most jitter
+    so that failed emails do not retry all at once
+    """
+    backoff = min(max_delay, delay * 2 ** min(max(attempts - 1, 0), 32))
+    return backoff * (1 - jitter * random.random())
+
+
+def quote_data(file_p, size=SEND_SIZE):
+    """
+    Yields the DATA of the message read from file_p: line breaks as CRLF,
+    lines starting by a dot doubled and the final dot line, as
+    smtplib.quotedata, but reading file_p by lines of at most size bytes
+    """
+    at_line_start = True
+    empty = True
+    pending = ''
+    while True:
+        line = file_p.readline(size)
+        if not line:
+            break
+        line, pending = pending + line, ''
+        if line.endswith('\r'):
+            # May be the first half of a CRLF
+            line, pending = line[:-1], '\r'
+        data = _LINE_BREAK.sub(CRLF, line)
+        if at_line_start and data.startswith('.'):
+            data = '.' + data
+        data = data.replace(CRLF + '.', CRLF + '..')
+        if data:
+            at_line_start = data.endswith(CRLF)
+            empty = False
+            yield data
+    if pending or empty or not at_line_start:
+        yield CRLF
+    yield '.' + CRLF
+
+
+def send_stream(smtp, from_addr, to_addrs, file_p, size=None):
+    """
+    Sends the message read from file_p with the smtplib.SMTP smtp, as
+    sendmail does but sending the DATA by chunks of at most SEND_SIZE bytes.
+    size is the estimated size of the message declared to the server.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    options = []
+    if smtp.does_esmtp:
+        if size and smtp.has_extn('size'):
+            options.append('SIZE=%d' % size)
+        if smtp.has_extn('8bitmime'):
+            options.append('BODY=8BITMIME')
+    code, response = smtp.mail(from_addr, options)
+    if code != 250:
+        smtp.rset()
+        raise SMTPSenderRefused(code, response, from_addr)
+    refused = {}
+    for to_addr in to_addrs:
+        code, response = smtp.rcpt(to_addr)
+        if code not in (250, 251):
+            refused[to_addr] = (code, response)
+    if len(refused) == len(to_addrs):
+        smtp.rset()
+        raise SMTPRecipientsRefused(refused)
+    smtp.putcmd('data')
+    code, response = smtp.getreply()
+    if code != 354:
+        smtp.rset()
+        raise SMTPDataError(code, response)
+    buffer = []
+    buffered = 0
+    for data in quote_data(file_p):
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= SEND_SIZE:
+            smtp.send(''.join(buffer))
+            buffer, buffered = [], 0
+    smtp.send(''.join(buffer))
+    code, response = smtp.getreply()
+    if code != 250:
+        smtp.rset()
+        raise SMTPDataError(code, response)
+    return refused
+
+
+def smtp_connector(server):
+    """
+    Returns a function that opens a new connection to the smtp.server record.
+    The function may be called from any thread: outside of the transaction
+    that created it, the record is read in a new read only transaction.
+    """
+    transaction = Transaction()
+    database_name = transaction.database.name
+    user = transaction.user
+    server_id = server.id
+
+    def connect():
+        transaction = Transaction()
+        if (transaction.database
+                and transaction.database.name == database_name):
+            SMTPServer = Pool().get('smtp.server')
+            return SMTPServer(server_id).get_smtp_server()
+        with Transaction(new=True).start(database_name, user, readonly=True):
+            SMTPServer = Pool().get('smtp.server')
+            return SMTPServer(server_id).get_smtp_server()
+    return connect
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: rate tokens are added per second up to
+    capacity and acquire waits until there are enough.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(self.rate, 1)
+        self.tokens = self.capacity
+        self.timestamp = time()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, now):
+        "Takes tokens and returns 0 or returns the seconds to wait for them"
+        self.tokens = min(self.capacity,
+            self.tokens + max(now - self.timestamp, 0) * self.rate)
+        self.timestamp = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def poll(self, tokens=1):
+        "Takes tokens and returns 0 or returns the seconds to wait for them"
+        with self._lock:
+            return self._take(tokens, time())
+
+    def acquire(self, tokens=1):
+        "Waits for tokens and returns the seconds waited"
+        waited = 0
+        while True:
+            wait = self.poll(tokens)
+            if not wait:
+                return waited
+            sleep(wait)
+            waited += wait
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket shared by all the processes using the same state file
+    """
+
+    def __init__(self, filename, rate, capacity=None):
+        super(FileTokenBucket, self).__init__(rate, capacity)
+        self.filename = filename
+
+    def _take(self, tokens, now):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0660)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            state = os.read(fd, 64).split()
+            if len(state) == 2:
+                self.tokens, self.timestamp = map(float, state)
+            wait = super(FileTokenBucket, self)._take(tokens, now)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%r %r' % (self.tokens, self.timestamp))
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+        return wait
+
+
+class FileSemaphore(object):
+    """
+    Semaphore of value slots shared by all the processes using the same
+    lock files: filename.0 to filename.<value - 1>. Each slot acquired is an
+    open lock file, so the slots of a process that dies are released.
+    """
+    poll_interval = 0.1
+
+    def __init__(self, filename, value):
+        self.filename = filename
+        self.value = value
+        self._lock = threading.Lock()
+        self._fds = []
+
+    def _take(self):
+        for i in range(self.value):
+            fd = os.open('%s.%s' % (self.filename, i),
+                os.O_RDWR | os.O_CREAT, 0660)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                continue
+            with self._lock:
+                self._fds.append(fd)
+            return True
+        return False
+
+    def acquire(self, blocking=True):
+        while not self._take():
+            if not blocking:
+                return False
+            sleep(self.poll_interval)
+        return True
+
+    def release(self):
+        with self._lock:
+            if not self._fds:
+                raise ValueError('Semaphore released too many times')
+            fd = self._fds.pop()
+        # Closing the file releases the lock
+        os.close(fd)
+
+
+def _acquire(semaphore, block=True, timeout=None):
+    "Acquires semaphore waiting at most timeout seconds if not None"
+    if not block or timeout is None:
+        return semaphore.acquire(block)
+    end = time() + timeout
+    while not semaphore.acquire(False):
+        if time() >= end:
+            return False
+        sleep(FileSemaphore.poll_interval)
+    return True
+
+
+class SMTPConnection(object):
+    """
+    SMTP connection handed out by SMTPConnectionPool.
+
+    It reconnects once when the server has dropped the connection and counts
+    the messages sent, so that the pool can recycle it. Messages are sent
+    within the rate limit of the server and in one transaction per
+    max_recipients recipients.
+
+    The message is a string or a function returning a file-like object to
+    stream it, called for each transaction.
+    """
+
+    def __init__(self, key, connect, limiter=None, max_recipients=None,
+            semaphore=None):
+        self.key = key
+        self.connect = connect
+        self.limiter = limiter
+        self.max_recipients = max_recipients
+        self.semaphore = semaphore
+        try:
+            self.smtp = self._connect()
+        except:
+            if semaphore:
+                semaphore.release()
+            raise
+        self.messages = 0
+        self.last_used = time()
+
+    @property
+    def server(self):
+        "Returns the id of the smtp.server as label of the metrics"
+        return self.key[1] if self.key else None
+
+    def _connect(self):
+        # The smtp.server authenticates when connecting
+        with metrics.timer('electronic_mail_smtp_connect_seconds',
+                server=self.server):
+            return self.connect()
+
+    def _send(self, from_addr, to_addrs, msg):
+        if callable(msg):
+            with closing(msg()) as file_p:
+                return send_stream(self.smtp, from_addr, to_addrs, file_p,
+                    getattr(msg, 'size', None))
+        return self.smtp.sendmail(from_addr, to_addrs, msg)
+
+    def _sendmail(self, from_addr, to_addrs, msg):
+        if self.limiter:
+            metrics.observe('electronic_mail_rate_limit_wait_seconds',
+                self.limiter.acquire(), server=self.server)
+        try:
+            with metrics.timer('electronic_mail_smtp_data_seconds',
+                    server=self.server):
+                try:
+                    return self._send(from_addr, to_addrs, msg)
+                except SMTPServerDisconnected:
+                    logger.info('SMTP connection lost, reconnecting')
+                    self.reconnect()
+                    return self._send(from_addr, to_addrs, msg)
+        except Exception, e:
+            metrics.inc('electronic_mail_smtp_errors_total',
+                server=self.server, exception=e.__class__.__name__)
+            raise
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if isinstance(to_addrs, basestring):
+            to_addrs = [to_addrs]
+        size = self.max_recipients or len(to_addrs) or 1
+        result = {}
+        for i in range(0, max(len(to_addrs), 1), size):
+            try:
+                result.update(self._sendmail(from_addr, to_addrs[i:i + size],
+                        msg))
+            except SMTPRecipientsRefused, e:
+                # The other transactions may be accepted
+                result.update(e.recipients)
+        self.messages += 1
+        self.last_used = time()
+        if len(result) == len(to_addrs):
+            raise SMTPRecipientsRefused(result)
+        return result
+
+    def reconnect(self):
+        self._quit()
+        self.smtp = self._connect()
+        self.messages = 0
+
+    def is_alive(self):
+        try:
+            return self.smtp.noop()[0] == 250
+        except (SMTPException, error):
+            return False
+
+    def _quit(self):
+        try:
+            self.smtp.quit()
+        except (SMTPException, error):
+            self.smtp.close()
+
+    def release(self):
+        "Releases the max_connections slot of the connection"
+        if self.semaphore:
+            self.semaphore.release()
+            self.semaphore = None
+
+    def close(self):
+        try:
+            self._quit()
+        finally:
+            self.release()
+
+    # Keep the smtplib API used before pooling
+    quit = close
+
+
+class SMTPConnectionPool(object):
+    """
+    Process wide pool of SMTP connections keyed by smtp.server record.
+
+    Options of the electronic_mail configuration section:
+        smtp_idle_timeout: seconds an unused connection is kept open (0
+            disables the pool)
+        smtp_max_messages: messages sent before a connection is recycled
+        smtp_workers: idle connections kept per server
+        rate_limit_shared: share the rate limit of the servers with the other
+            processes using the same data path (default True)
+        max_connections_shared: share the max_connections of the servers
+            with the other processes using the same data path (default True)
+
+    The connections in use are limited by the max_connections of the server,
+    the idle ones are not counted, and messages are sent within its
+    rate_limit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._limiters = {}
+        self._semaphores = {}
+
+    @staticmethod
+    def _lock_filename(server, suffix):
+        "Returns the name of a lock file of server shared by the processes"
+        database_name = Transaction().database.name
+        directory = os.path.join(config.get('database', 'path'),
+            database_name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0770)
+        return os.path.join(directory, '.smtp-%s.%s' % (server.id, suffix))
+
+    def _limiter(self, server):
+        if not server.rate_limit:
+            return
+        key = (Transaction().database.name, server.id)
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None or limiter.rate != server.rate_limit:
+                if (fcntl and config.getboolean('electronic_mail',
+                            'rate_limit_shared', default=True)):
+                    limiter = FileTokenBucket(
+                        self._lock_filename(server, 'rate'),
+                        server.rate_limit)
+                else:
+                    limiter = TokenBucket(server.rate_limit)
+                self._limiters[key] = limiter
+        return limiter
+
+    def _semaphore(self, server):
+        if not server.max_connections:
+            return
+        key = (Transaction().database.name, server.id, server.max_connections)
+        with self._lock:
+            semaphore = self._semaphores.get(key)
+            if semaphore is None:
+                if (fcntl and config.getboolean('electronic_mail',
+                            'max_connections_shared', default=True)):
+                    semaphore = FileSemaphore(
+                        self._lock_filename(server, 'connections'),
+                        server.max_connections)
+                else:
+                    semaphore = threading.BoundedSemaphore(
+                        server.max_connections)
+                self._semaphores[key] = semaphore
+        return semaphore
+
+    @staticmethod
+    def key(server):
+        # write_date makes the pool drop connections made with old settings
+        return (Transaction().database.name, server.id,
+            server.write_date or server.create_date)
+
+    def _expire(self, now):
+        timeout = config.getint('electronic_mail', 'smtp_idle_timeout',
+            default=60)
+        expired = []
+        with self._lock:
+            for key, connections in self._idle.items():
+                for connection in connections[:]:
+                    if now - connection.last_used >= timeout:
+                        connections.remove(connection)
+                        expired.append(connection)
+                if not connections:
+                    del self._idle[key]
+        for connection in expired:
+            connection.close()
+
+    def get(self, server, block=True, timeout=None):
+        """
+        Returns an open SMTPConnection to the smtp.server record.
+        If the server has already max_connections in use, it waits for one to
+        be given back, at most timeout seconds, or returns None if block is
+        False or the timeout expires.
+        """
+        key = self.key(server)
+        self._expire(time())
+        semaphore = self._semaphore(server)
+        if semaphore and not _acquire(semaphore, block, timeout):
+            return
+        while True:
+            with self._lock:
+                connections = self._idle.get(key)
+                connection = connections.pop() if connections else None
+            if connection is None:
+                return SMTPConnection(key, smtp_connector(server),
+                    limiter=self._limiter(server),
+                    max_recipients=server.max_recipients,
+                    semaphore=semaphore)
+            if connection.is_alive():
+                connection.semaphore = semaphore
+                return connection
+            connection.close()
+
+    def put(self, connection):
+        "Gives back a connection obtained with get"
+        timeout = config.getint('electronic_mail', 'smtp_idle_timeout',
+            default=60)
+        max_messages = config.getint('electronic_mail', 'smtp_max_messages',
+            default=100)
+        max_idle = config.getint('electronic_mail', 'smtp_workers',
+            default=1)
+        if timeout > 0 and connection.messages < max_messages:
+            with self._lock:
+                connections = self._idle.setdefault(connection.key, [])
+                if len(connections) < max_idle:
+                    connection.last_used = time()
+                    # Idle connections leave their slot to the senders
+                    connection.release()
+                    connections.append(connection)
+                    return
+        connection.close()
+
+    def clear(self):
+        """
+        Closes all idle connections and forgets the rate limits and
+        semaphores, created again by the next get
+        """
+        with self._lock:
+            connections = [c for cs in self._idle.values() for c in cs]
+            self._idle.clear()
+            self._limiters.clear()
+            self._semaphores.clear()
+        for connection in connections:
+            connection.close()
+
+
+smtp_pool = SMTPConnectionPool()
+
+
+class DeliveryPool(object):
+    '''
+    Send a batch of emails over several SMTP connections in parallel.
+
+    Each worker thread owns one of the given connections. Workers never touch
+    the database: they receive (key, from_addr, to_addrs, msg) jobs and
+    return (key, exception, refused) results, so the caller keeps all the
+    bookkeeping in its own transaction.
+    '''
+
+    def __init__(self, connections):
+        assert connections
+        self.connections = connections
+        # Bounded so that only a few messages are held in memory per worker
+        self._jobs = Queue(maxsize=len(connections) * 2)
+        self._results = Queue()
+
+    def _work(self, connection):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            key, from_addr, to_addrs, msg = job
+            try:
+                refused = connection.sendmail(from_addr, to_addrs, msg)
+            except Exception, e:
+                self._results.put((key, e, {}))
+            else:
+                self._results.put((key, None, refused))
+
+    def _pending_results(self):
+        while True:
+            try:
+                yield self._results.get_nowait()
+            except Empty:
+                break
+
+    def deliver(self, jobs):
+        '''
+        Send jobs and yield (key, exception, refused) as each one finishes.
+        exception is None when the message was accepted by the server for
+        the recipients not in the refused dict.
+        '''
+        threads = []
+        for connection in self.connections:
+            thread = threading.Thread(target=self._work, args=(connection,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        pending = 0
+        try:
+            for job in jobs:
+                self._jobs.put(job)
+                pending += 1
+                for result in self._pending_results():
+                    pending -= 1
+                    yield result
+        finally:
+            for thread in threads:
+                self._jobs.put(None)
+        while pending:
+            yield self._results.get()
+            pending -= 1
+        for thread in threads:
+            thread.join()
+
+
+def _main():
+    """
+    Runs in a process of run_processes the function read on stdin with the
+    configuration of the parent, and writes on stdout if it failed and its
+    metrics
+    """
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    # What the function prints must not be mixed with the result
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sections, level, module, name, args = pickle.load(sys.stdin)
+    logging.basicConfig(level=level)
+    for section, options in sections:
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options:
+            config.set(section, option, value)
+    metrics.fork()
+    failed = True
+    try:
+        getattr(import_module(module), name)(*args)
+        failed = False
+    except Exception:
+        logger.exception('Sending process %s failed' % os.getpid())
+    finally:
+        pickle.dump((failed, metrics.dump()), output, pickle.HIGHEST_PROTOCOL)
+        output.close()
+
+
+def run_processes(function, args_list):
+    """
+    Calls function(*args) for each args of args_list in its own process,
+    waits for them and returns the number of processes that failed.
+    The processes are new interpreters, as forking a process running threads
+    may deadlock, so function must be a function of a module and args
+    picklable. The metrics of the processes are added to the ones of the
+    caller.
+    """
+    payload = ([(s, config.items(s)) for s in config.sections()],
+        logging.getLogger().getEffectiveLevel(), function.__module__,
+        function.__name__)
+    processes = []
+    for args in args_list:
+        process = subprocess.Popen([sys.executable, '-c',
+                'from %s import _main; _main()' % __name__],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        pickle.dump(payload + (args,), process.stdin,
+            pickle.HIGHEST_PROTOCOL)
+        process.stdin.close()
+        processes.append(process)
+    failures = 0
+    for process in processes:
+        output = process.stdout.read()
+        process.wait()
+        try:
+            failed, dump = pickle.loads(output)
+        except (EOFError, pickle.UnpicklingError):
+            # The process died
+            failed = True
+        else:
+            metrics.load(dump)
+        failures += failed
+    return failures
@@ -0,0 +1,22 @@
+# This file is part electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+from trytond.model import fields
+
+__all__ = ['SMTPServer']
+
+
+class SMTPServer:
+    __metaclass__ = PoolMeta
+    __name__ = 'smtp.server'
+    rate_limit = fields.Float('Rate Limit',
+        help='Maximum messages sent per second by electronic mails. '
+        'Leave empty for no limit.')
+    max_connections = fields.Integer('Concurrent Senders',
+        help='Maximum connections sending at the same time by the server '
+        'processes of the host. The idle connections kept open are not '
+        'counted. Leave empty for no limit.')
+    max_recipients = fields.Integer('Maximum Recipients',
+        help='Maximum recipients of each message, emails with more '
+        'recipients are sent in several messages. Leave empty for no limit.')
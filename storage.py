@@ -0,0 +1,944 @@
+# This file is part of electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from StringIO import StringIO
+from abc import ABCMeta, abstractmethod
+from calendar import timegm
+from email import message_from_string
+from trytond.config import config
+from trytond.transaction import Transaction
+import errno
+import hashlib
+import heapq
+import json
+import logging
+import os
+import tempfile
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['Storage', 'FileSystemStorage', 'ShardedFileSystemStorage',
+    'S3Storage', 'STORAGES', 'get_storage', 'compress', 'decompress',
+    'compression_method', 'split_parts', 'join_parts', 'ChunkReader',
+    'merge_keys', 'sorted_keys']
+
+# Maximum size read to parse the headers of an email
+HEAD_SIZE = 64 * 1024
+CHUNK_SIZE = 16 * 1024
+
+# Compressed files start by the magic number of their format, an email file
+# never starts by these bytes
+MAGIC = {
+    'gzip': '\x1f\x8b',
+    'zstd': '\x28\xb5\x2f\xfd',
+    }
+MAGIC_SIZE = max(len(m) for m in MAGIC.values())
+
+
+def compression_of(data):
+    "Returns the compression of data from its first bytes or None"
+    for method, magic in MAGIC.iteritems():
+        if data and data.startswith(magic):
+            return method
+
+
+def compression_method():
+    """
+    Returns the method and level of the compression options of the
+    electronic_mail section
+    """
+    method = config.get('electronic_mail', 'compression', default='none')
+    if method == 'none':
+        method = None
+    elif method not in MAGIC:
+        raise ValueError('Unknown compression %s' % method)
+    elif method == 'zstd' and not zstandard:
+        raise ImportError('zstandard is required by the zstd compression')
+    return method, config.getint('electronic_mail', 'compression_level')
+
+
+def compress(data, method=None, level=None):
+    """
+    Returns data compressed with method (gzip or zstd) or data if method is
+    None or compressing does not save space
+    """
+    if method == 'gzip':
+        if level is None:
+            level = 6
+        # wbits 16 + MAX_WBITS writes the gzip format
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+    elif method == 'zstd':
+        compressed = zstandard.ZstdCompressor(
+            level=3 if level is None else level).compress(data)
+    else:
+        return data
+    return compressed if len(compressed) < len(data) else data
+
+
+def _decompressor(method):
+    if method == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif method == 'zstd':
+        if not zstandard:
+            raise ImportError('zstandard is required to read zstd files')
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+def decompress(data):
+    "Returns data decompressed if it is compressed"
+    method = compression_of(data)
+    if not method:
+        return data
+    decompressor = _decompressor(method)
+    return decompressor.decompress(data) + (decompressor.flush()
+        if method == 'gzip' else '')
+
+
+def decompress_chunks(chunks):
+    "Yields the decompressed chunks of chunks of a compressed or not file"
+    decompressor = None
+    method = None
+    for chunk in chunks:
+        if decompressor is None:
+            method = compression_of(chunk)
+            decompressor = _decompressor(method) or False
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor and method == 'gzip':
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+def read_chunks(file_p, size=None):
+    "Yields the chunks of file_p, at most size bytes"
+    while size is None or size > 0:
+        chunk = file_p.read(CHUNK_SIZE if size is None
+            else min(CHUNK_SIZE, size))
+        if not chunk:
+            break
+        if size is not None:
+            size -= len(chunk)
+        yield chunk
+
+
+def _sorted(keys, name):
+    last = None
+    for key in keys:
+        if last is not None and key < last:
+            raise ValueError('%s keys are not sorted: %s after %s'
+                % (name, key, last))
+        yield key
+        last = key
+
+
+def merge_keys(database_keys, stored_keys):
+    """
+    Yields (key, in database, in storage) for the keys of two sorted
+    iterables, reading them in step so that memory does not grow with them
+    """
+    database_keys = _sorted(database_keys, 'Database')
+    stored_keys = _sorted(stored_keys, 'Storage')
+    database_key = next(database_keys, None)
+    stored_key = next(stored_keys, None)
+    while database_key is not None or stored_key is not None:
+        if stored_key is None or (database_key is not None
+                and database_key < stored_key):
+            yield database_key, True, False
+            database_key = next(database_keys, None)
+        elif database_key is None or stored_key < database_key:
+            yield stored_key, False, True
+            stored_key = next(stored_keys, None)
+        else:
+            yield database_key, True, True
+            database_key = next(database_keys, None)
+            stored_key = next(stored_keys, None)
+
+
+def sorted_keys(keys, buffer_size=100000):
+    """
+    Yields the distinct keys of the iterable keys in sorted order. At most
+    buffer_size keys are kept in memory, the others are sorted by runs in
+    temporary files.
+    """
+    runs = []
+    buffer = set()
+    try:
+        for key in keys:
+            buffer.add(key)
+            if len(buffer) >= buffer_size:
+                run = tempfile.TemporaryFile()
+                run.writelines('%s\n' % k for k in sorted(buffer))
+                run.seek(0)
+                runs.append(run)
+                buffer = set()
+        last = None
+        for key in heapq.merge(sorted(buffer),
+                *[(line[:-1] for line in f) for f in runs]):
+            if key != last:
+                yield key
+                last = key
+    finally:
+        for run in runs:
+            run.close()
+
+
+class ChunkReader(object):
+    """
+    Read only file-like object over an iterable of chunks, so that a file is
+    read chunk by chunk whatever its storage, compression or split
+    """
+
+    def __init__(self, chunks, close=None):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._close = close
+
+    def _fill(self, size=None, line=False):
+        while ((size is None or len(self._buffer) < size)
+                and not (line and '\n' in self._buffer)):
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+
+    def _take(self, size):
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def peek(self, size):
+        self._fill(size)
+        return self._buffer[:size]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill()
+            return self._take(len(self._buffer))
+        self._fill(size)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        self._fill(size, line=True)
+        end = self._buffer.find('\n')
+        end = len(self._buffer) if end < 0 else end + 1
+        if size is not None:
+            end = min(end, size)
+        return self._take(end)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        if self._close:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def decompress_head(chunks, size=HEAD_SIZE):
+    """
+    Returns the headers of the email decompressed from chunks, an iterable
+    of the bytes of a compressed or not file, decompressing only the chunks
+    needed for size bytes
+    """
+    head = ''
+    decompressor = None
+    for chunk in chunks:
+        if decompressor is None:
+            decompressor = _decompressor(compression_of(chunk)) or False
+        head += decompressor.decompress(chunk) if decompressor else chunk
+        if (len(head) >= size
+                or '\n\n' in head or '\r\n\r\n' in head):
+            break
+    return header_part(head[:size])
+
+
+# Email files with parts stored apart start by this line and a line with
+# the JSON index of the parts
+SPLIT_MAGIC = '\x00EMAIL-SPLIT\n'
+
+
+def header_part(data):
+    "Returns data up to the blank line that ends the headers"
+    data = _skip_index(data)
+    for separator in ('\r\n\r\n', '\n\n'):
+        index = data.find(separator)
+        if index >= 0:
+            return data[:index + len(separator)]
+    return data
+
+
+def _skip_index(data):
+    if data and data.startswith(SPLIT_MAGIC):
+        index = data.find('\n', len(SPLIT_MAGIC))
+        return data[index + 1:] if index >= 0 else ''
+    return data
+
+
+def split_parts(data, min_size):
+    """
+    Returns the skeleton of the email file data, without the bodies of its
+    parts of at least min_size bytes, and the list of (offset in skeleton,
+    part number in walk order, body) of these parts.
+    Returns None if no part is removed.
+    """
+    msg = message_from_string(data)
+    if not msg.is_multipart():
+        return
+    pieces, parts = [], []
+    position = offset = 0
+    for number, part in enumerate(msg.walk()):
+        if part.is_multipart():
+            continue
+        body = part.get_payload()
+        if not isinstance(body, str) or len(body) < min_size:
+            continue
+        start = data.find(body, position)
+        if start < 0:
+            return
+        pieces.append(data[position:start])
+        offset += start - position
+        parts.append((offset, number, body))
+        position = start + len(body)
+    if not parts:
+        return
+    pieces.append(data[position:])
+    skeleton = ''.join(pieces)
+    # The bodies are found by content, check they are the right ones
+    if join_parts(skeleton, [(o, b) for o, _, b in parts]) != data:
+        return
+    return skeleton, parts
+
+
+def join_parts(skeleton, parts):
+    "Returns the email file of skeleton with the (offset, body) parts"
+    pieces = []
+    position = 0
+    for offset, body in parts:
+        pieces.append(skeleton[position:offset])
+        pieces.append(body)
+        position = offset
+    pieces.append(skeleton[position:])
+    return ''.join(pieces)
+
+
+class Storage(object):
+    """
+    Content addressed store of the email files of a database.
+
+    Keys are the hexadecimal digest of the content (legacy MD5 keys may have
+    a -<collision> suffix). Files are compressed with the compression option
+    of the electronic_mail section (none, gzip or zstd) and the
+    compression_level option. Files are read whatever their compression.
+
+    If the split_part_size option is set, the bodies of the MIME parts of at
+    least this size are stored apart, in the parts storage, under the SHA-256
+    digest of the body, so that the same attachment is stored once.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+        self._parts = None
+
+    @abstractmethod
+    def _make_parts(self):
+        "Returns a new storage for the parts stored apart"
+
+    @property
+    def parts(self):
+        "Storage of the parts stored apart"
+        if self._parts is None:
+            self._parts = self._make_parts()
+        return self._parts
+
+    @abstractmethod
+    def get_raw(self, key):
+        "Returns the bytes stored under key or None if it does not exist"
+
+    @abstractmethod
+    def put_raw(self, key, data):
+        "Stores the bytes data under key"
+
+    def open_raw(self, key):
+        """
+        Returns a file-like object reading the bytes stored under key or None
+        if it does not exist
+        """
+        data = self.get_raw(key)
+        if data is not None:
+            return StringIO(data)
+
+    def _magic(self, key):
+        "Returns the first bytes stored under key or None"
+        data = self.get_raw(key)
+        if data is not None:
+            return data[:MAGIC_SIZE]
+
+    def _get_file(self, key):
+        data = self.get_raw(key)
+        if data is not None:
+            return decompress(data)
+
+    def _open_file(self, key):
+        file_p = self.open_raw(key)
+        if file_p is not None:
+            return ChunkReader(decompress_chunks(read_chunks(file_p)),
+                file_p.close)
+
+    def open(self, key):
+        """
+        Returns a file-like object reading the content stored under key or
+        None if it does not exist. The content is read, decompressed and
+        reassembled by chunks so that it is never fully in memory.
+        """
+        reader = self._open_file(key)
+        if reader is None or reader.peek(len(SPLIT_MAGIC)) != SPLIT_MAGIC:
+            return reader
+        reader.readline()
+        index = json.loads(reader.readline())
+
+        def chunks():
+            position = 0
+            for offset, _, part_key, _ in index:
+                for chunk in read_chunks(reader, offset - position):
+                    yield chunk
+                position = offset
+                part = self.parts._open_file(part_key)
+                if part is None:
+                    raise IOError('Part %s of email file %s is missing'
+                        % (part_key, key))
+                with part:
+                    for chunk in read_chunks(part):
+                        yield chunk
+            for chunk in read_chunks(reader):
+                yield chunk
+        return ChunkReader(chunks(), reader.close)
+
+    def get_part(self, key):
+        "Returns the body of a part stored apart or None"
+        return self.parts._get_file(key)
+
+    def get_index(self, key):
+        """
+        Returns the list of (offset, part number, part key, size) of the parts
+        stored apart of the email file stored under key, or None if its parts
+        are not stored apart. Only the beginning of the file is read.
+        """
+        reader = self._open_file(key)
+        if reader is None:
+            return
+        with reader:
+            if reader.peek(len(SPLIT_MAGIC)) == SPLIT_MAGIC:
+                reader.readline()
+                return json.loads(reader.readline())
+
+    def get_split(self, key):
+        """
+        Returns the skeleton and the index (see get_index) of the email file
+        stored under key, or None if its parts are not stored apart
+        """
+        data = self._get_file(key)
+        if data is None or not data.startswith(SPLIT_MAGIC):
+            return
+        end = data.index('\n', len(SPLIT_MAGIC))
+        return data[end + 1:], json.loads(data[len(SPLIT_MAGIC):end])
+
+    def get(self, key):
+        "Returns the content stored under key or None if it does not exist"
+        data = self._get_file(key)
+        if data is None or not data.startswith(SPLIT_MAGIC):
+            return data
+        skeleton, index = self.get_split(key)
+        parts = []
+        for offset, _, part_key, _ in index:
+            body = self.get_part(part_key)
+            if body is None:
+                logger.error('Part %s of email file %s is missing'
+                    % (part_key, key))
+                return None
+            parts.append((offset, body))
+        return join_parts(skeleton, parts)
+
+    def get_head(self, key, size=HEAD_SIZE):
+        """
+        Returns the headers of the email stored under key, reading at most
+        size bytes, or None if it does not exist
+        """
+        data = self._get_file(key)
+        if data is not None:
+            return header_part(_skip_index(data)[:size])
+
+    def _put(self, key, data):
+        method, level = compression_method()
+        self.put_raw(key, compress(data, method, level))
+
+    def put(self, key, data):
+        "Stores data under key"
+        min_size = config.getint('electronic_mail', 'split_part_size',
+            default=0)
+        split = split_parts(data, min_size) if min_size else None
+        if split:
+            skeleton, parts = split
+            index = []
+            # Parts are stored first so the email file never misses them
+            for offset, number, body in parts:
+                part_key = hashlib.sha256(body).hexdigest()
+                if not self.parts.touch(part_key):
+                    self.parts._put(part_key, body)
+                index.append((offset, number, part_key, len(body)))
+            data = SPLIT_MAGIC + json.dumps(index) + '\n' + skeleton
+        self._put(key, data)
+
+    @abstractmethod
+    def touch(self, key):
+        """
+        Sets the modification time of key to now, so that it is not deleted
+        as orphan, and returns True if it exists
+        """
+
+    @abstractmethod
+    def keys(self):
+        "Yields the stored keys in sorted order"
+
+    @abstractmethod
+    def modified(self, key):
+        "Returns the timestamp of the last write of key or None"
+
+    def verify(self, key):
+        """
+        Returns True if the digest of the content stored under key is the
+        digest of key, reading it by chunks
+        """
+        digest = key.split('-')[0]
+        if len(digest) == 64:
+            hasher = hashlib.sha256()
+        elif len(digest) == 32:
+            hasher = hashlib.md5()
+        else:
+            return True
+        file_p = self.open(key)
+        if file_p is None:
+            return False
+        try:
+            with file_p:
+                for chunk in read_chunks(file_p):
+                    hasher.update(chunk)
+        except (IOError, zlib.error), e:
+            logger.warning('Unable to read email file %s: %s' % (key, e))
+            return False
+        return hasher.hexdigest() == digest
+
+    def compression(self, key):
+        "Returns the compression of the file stored under key or None"
+        return compression_of(self._magic(key))
+
+    @abstractmethod
+    def exists(self, key):
+        "Returns True if a file is stored under key"
+
+    @abstractmethod
+    def delete(self, key):
+        "Deletes the file stored under key if it exists"
+
+
+class FileSystemStorage(Storage):
+    """
+    Stores files in <DATA PATH>/<DB NAME>/email/<key[0:2]>/<key>
+    and parts in <DATA PATH>/<DB NAME>/email_parts/<key[0:2]>/<key>
+    """
+    depth = 1
+    width = 2
+
+    def __init__(self, database_name, path=None):
+        super(FileSystemStorage, self).__init__(database_name)
+        if path is None:
+            path = os.path.join(config.get('database', 'path'),
+                database_name, 'email')
+        self.root = path
+
+    def _path(self, key, depth, width):
+        parts = [key[i * width:(i + 1) * width] for i in range(depth)]
+        return os.path.join(self.root, *(parts + [key]))
+
+    def path(self, key):
+        return self._path(key, self.depth, self.width)
+
+    def _make_parts(self):
+        return self.__class__(self.database_name, self.root + '_parts')
+
+    def _keys(self, depth):
+        "Yields the keys of the files depth directories below root, sorted"
+        def walk(directory, level):
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                return
+            for name in names:
+                filename = os.path.join(directory, name)
+                if level < depth:
+                    # Directories are named by the start of their keys, so
+                    # walking them sorted gives the keys sorted
+                    if len(name) == self.width and os.path.isdir(filename):
+                        for key in walk(filename, level + 1):
+                            yield key
+                elif not name.startswith('.') and os.path.isfile(filename):
+                    yield name
+        return walk(self.root, 0)
+
+    def keys(self):
+        return self._keys(self.depth)
+
+    def modified(self, key):
+        try:
+            return os.path.getmtime(self.path(key))
+        except OSError:
+            return None
+
+    def touch(self, key):
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            return False
+        return True
+
+    def _read(self, filename, size=-1):
+        try:
+            with open(filename, 'rb') as file_p:
+                return file_p.read(size)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logger.error('Unable to read email file %s: %s'
+                    % (filename, e))
+            return None
+
+    def get_raw(self, key):
+        return self._read(self.path(key))
+
+    def _open(self, filename):
+        try:
+            return open(filename, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logger.error('Unable to read email file %s: %s'
+                    % (filename, e))
+            return None
+
+    def open_raw(self, key):
+        return self._open(self.path(key))
+
+    def _magic(self, key):
+        return self._read(self.path(key), MAGIC_SIZE)
+
+    def _read_head(self, filename, size):
+        lines = []
+        read = 0
+        try:
+            with open(filename, 'rb') as file_p:
+                if compression_of(file_p.read(MAGIC_SIZE)):
+                    file_p.seek(0)
+                    return decompress_head(
+                        iter(lambda: file_p.read(CHUNK_SIZE), ''), size)
+                file_p.seek(0)
+                if file_p.read(len(SPLIT_MAGIC)) == SPLIT_MAGIC:
+                    # Skip the index line
+                    file_p.readline()
+                else:
+                    file_p.seek(0)
+                for line in file_p:
+                    lines.append(line)
+                    read += len(line)
+                    if line in ('\n', '\r\n') or read >= size:
+                        break
+        except IOError:
+            return None
+        return ''.join(lines)[:size]
+
+    def get_head(self, key, size=HEAD_SIZE):
+        return self._read_head(self.path(key), size)
+
+    def put_raw(self, key, data):
+        filename = self.path(key)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0770)
+            except OSError:
+                # Created meanwhile by another process
+                if not os.path.isdir(directory):
+                    raise
+        # Write then rename so that readers never see a partial file
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file_p:
+                file_p.write(data)
+            os.chmod(tmp_filename, 0660)
+            os.rename(tmp_filename, filename)
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    """
+    Stores files with a deeper directory fan-out:
+    <DATA PATH>/<DB NAME>/email/<key[0:2]>/<key[2:4]>/<key[4:6]>/<key>
+
+    The depth is set by the storage_depth option. Files written by
+    FileSystemStorage are still read.
+    """
+
+    def __init__(self, database_name, path=None):
+        super(ShardedFileSystemStorage, self).__init__(database_name, path)
+        self.depth = config.getint('electronic_mail', 'storage_depth',
+            default=3)
+
+    def legacy_path(self, key):
+        return self._path(key, FileSystemStorage.depth,
+            FileSystemStorage.width)
+
+    def keys(self):
+        last = None
+        for key in heapq.merge(self._keys(self.depth),
+                self._keys(FileSystemStorage.depth)):
+            if key != last:
+                yield key
+            last = key
+
+    def touch(self, key):
+        if super(ShardedFileSystemStorage, self).touch(key):
+            return True
+        try:
+            os.utime(self.legacy_path(key), None)
+        except OSError:
+            return False
+        return True
+
+    def modified(self, key):
+        modified = super(ShardedFileSystemStorage, self).modified(key)
+        if modified is None:
+            try:
+                modified = os.path.getmtime(self.legacy_path(key))
+            except OSError:
+                pass
+        return modified
+
+    def get_raw(self, key):
+        data = super(ShardedFileSystemStorage, self).get_raw(key)
+        if data is None:
+            data = self._read(self.legacy_path(key))
+        return data
+
+    def open_raw(self, key):
+        file_p = super(ShardedFileSystemStorage, self).open_raw(key)
+        if file_p is None:
+            file_p = self._open(self.legacy_path(key))
+        return file_p
+
+    def _magic(self, key):
+        data = super(ShardedFileSystemStorage, self)._magic(key)
+        if data is None:
+            data = self._read(self.legacy_path(key), MAGIC_SIZE)
+        return data
+
+    def put_raw(self, key, data):
+        super(ShardedFileSystemStorage, self).put_raw(key, data)
+        # Rewritten files are moved out of the legacy path
+        try:
+            os.remove(self.legacy_path(key))
+        except OSError:
+            pass
+
+    def get_head(self, key, size=HEAD_SIZE):
+        data = super(ShardedFileSystemStorage, self).get_head(key, size)
+        if data is None:
+            data = self._read_head(self.legacy_path(key), size)
+        return data
+
+    def exists(self, key):
+        return (super(ShardedFileSystemStorage, self).exists(key)
+            or os.path.isfile(self.legacy_path(key)))
+
+    def delete(self, key):
+        super(ShardedFileSystemStorage, self).delete(key)
+        try:
+            os.remove(self.legacy_path(key))
+        except OSError:
+            pass
+
+
+class S3Storage(Storage):
+    """
+    Stores files in an S3 compatible bucket as <prefix><DB NAME>/email/<key>
+    and parts as <prefix><DB NAME>/email_parts/<key>
+
+    Options of the electronic_mail section: s3_bucket, s3_prefix,
+    s3_endpoint (for MinIO or other S3 compatible services), s3_region,
+    s3_access_key and s3_secret_key (boto3 default credentials otherwise).
+    """
+
+    def __init__(self, database_name, client=None, bucket=None,
+            folder='email'):
+        super(S3Storage, self).__init__(database_name)
+        if client is None:
+            if not boto3:
+                raise ImportError('boto3 is required by the s3 storage')
+            client = boto3.client('s3',
+                endpoint_url=config.get('electronic_mail', 's3_endpoint'),
+                region_name=config.get('electronic_mail', 's3_region'),
+                aws_access_key_id=config.get('electronic_mail',
+                    's3_access_key'),
+                aws_secret_access_key=config.get('electronic_mail',
+                    's3_secret_key'))
+        self.client = client
+        self.bucket = bucket or config.get('electronic_mail', 's3_bucket')
+        self.prefix = '%s%s/%s/' % (
+            config.get('electronic_mail', 's3_prefix', default=''),
+            database_name, folder)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def _make_parts(self):
+        return S3Storage(self.database_name, client=self.client,
+            bucket=self.bucket, folder='email_parts')
+
+    def keys(self):
+        # S3 lists the keys in sorted order
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket,
+                Prefix=self.prefix):
+            for content in page.get('Contents', []):
+                yield content['Key'][len(self.prefix):]
+
+    def modified(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket,
+                Key=self._key(key))
+        except ClientError, e:
+            if self._not_found(e):
+                return None
+            raise
+        return timegm(response['LastModified'].utctimetuple())
+
+    def touch(self, key):
+        # Copying an object onto itself updates its LastModified
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=self._key(key),
+                CopySource={'Bucket': self.bucket, 'Key': self._key(key)},
+                MetadataDirective='REPLACE')
+        except ClientError, e:
+            if self._not_found(e):
+                return False
+            raise
+        return True
+
+    @staticmethod
+    def _not_found(exception):
+        return exception.response.get('Error', {}).get('Code') in (
+            '404', 'NoSuchKey', 'NotFound')
+
+    def _get_body(self, key, **kwargs):
+        try:
+            response = self.client.get_object(Bucket=self.bucket,
+                Key=self._key(key), **kwargs)
+        except ClientError, e:
+            if self._not_found(e):
+                return None
+            raise
+        return response['Body']
+
+    def _get_object(self, key, **kwargs):
+        body = self._get_body(key, **kwargs)
+        if body is not None:
+            return body.read()
+
+    def get_raw(self, key):
+        return self._get_object(key)
+
+    def open_raw(self, key):
+        return self._get_body(key)
+
+    def _magic(self, key):
+        return self._get_object(key, Range='bytes=0-%s' % (MAGIC_SIZE - 1))
+
+    def get_head(self, key, size=HEAD_SIZE):
+        # Compressed headers are smaller than size
+        data = self._get_object(key, Range='bytes=0-%s' % (size - 1))
+        if data is not None:
+            return decompress_head([data], size)
+
+    def put_raw(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key),
+            Body=data)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError, e:
+            if self._not_found(e):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+STORAGES = {
+    'filesystem': FileSystemStorage,
+    'sharded': ShardedFileSystemStorage,
+    's3': S3Storage,
+    }
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(database_name=None):
+    """
+    Returns the storage of the database selected by the storage option of the
+    electronic_mail section (filesystem by default)
+    """
+    if database_name is None:
+        database_name = Transaction().database.name
+    name = config.get('electronic_mail', 'storage', default='filesystem')
+    with _storages_lock:
+        storage = _storages.get((database_name, name))
+        if storage is None:
+            storage = _storages[(database_name, name)] = STORAGES[name](
+                database_name)
+    return storage
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# This file is part of the electronic_mail module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmarks of the storage, parsing and sending paths of electronic_mail.
+
+Run with a database configured as for the tests, for example:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+        python -m trytond.modules.electronic_mail.tests.benchmark \\
+        --count 200 --output benchmark.json
+
+The corpus is generated from --seed so results of different commits are
+comparable. Emails are sent to a local SMTP server of the benchmark.
+"""
+from __future__ import division
+from binascii import unhexlify
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from time import time
+import argparse
+import asyncore
+import json
+import os
+import platform
+import random
+import shutil
+import smtpd
+import subprocess
+import sys
+import tempfile
+import threading
+
+KINDS = ['plain', 'html', 'multipart', 'charset']
+CHARSETS = [
+    ('iso-8859-1', u'Acci\xf3 r\xe0pida, \xf1and\xfa i cig\xfce\xf1a'),
+    ('koi8-r', u'Привет, мир'),
+    ('shift_jis', u'こんにちは世界'),
+    ]
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+    'eiusmod tempor incididunt ut labore et dolore magna aliqua invoice '
+    'order delivery payment account').split()
+
+
+def _text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def make_message(kind, index, rng, attachment_size=1024 * 1024):
+    "Returns a synthetic email.Message of kind"
+    text = _text(rng, 2000)
+    if kind == 'plain':
+        msg = MIMEText(text, 'plain', 'utf-8')
+    elif kind == 'html':
+        msg = MIMEText('<html><body><p>%s</p></body></html>' % text, 'html',
+            'utf-8')
+    elif kind == 'multipart':
+        # Fixed boundaries so that the same seed gives the same files
+        msg = MIMEMultipart(boundary='==mixed-%s==' % index)
+        alternative = MIMEMultipart('alternative',
+            boundary='==alternative-%s==' % index)
+        alternative.attach(MIMEText(text, 'plain', 'utf-8'))
+        alternative.attach(MIMEText('<p>%s</p>' % text, 'html', 'utf-8'))
+        msg.attach(alternative)
+        # Random bytes so that the attachment is not compressible
+        data = unhexlify('%0*x' % (attachment_size * 2,
+                rng.getrandbits(attachment_size * 8)))
+        attachment = MIMEApplication(data)
+        attachment.add_header('Content-Disposition', 'attachment',
+            filename='attachment-%s.bin' % index)
+        msg.attach(attachment)
+    elif kind == 'charset':
+        charset, sample = CHARSETS[index % len(CHARSETS)]
+        msg = MIMEText((sample + u'\n') * 50, 'plain', charset)
+    else:
+        raise ValueError('Unknown kind %s' % kind)
+    msg['From'] = 'sender%s@example.com' % (index % 10)
+    msg['To'] = 'recipient%s@example.com' % index
+    msg['Subject'] = '%s benchmark %s' % (kind, index)
+    msg['Date'] = formatdate(1000000000 + index * 60, localtime=False)
+    msg['Message-ID'] = '<%s.%s@benchmark.example.com>' % (kind, index)
+    return msg
+
+
+def generate_corpus(kind, count, seed=0, attachment_size=1024 * 1024):
+    "Returns count messages of kind, the same ones for the same seed"
+    rng = random.Random('%s-%s' % (seed, kind))
+    return [make_message(kind, i, rng, attachment_size)
+        for i in range(count)]
+
+
+class SinkSMTPServer(smtpd.SMTPServer):
+    "Local SMTP server that accepts and counts all the messages"
+
+    def __init__(self, host='127.0.0.1', port=0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.host = host
+        self.port = self.socket.getsockname()[1]
+        self.messages = 0
+        self.recipients = 0
+        self._thread = None
+        self._running = False
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += 1
+        self.recipients += len(rcpttos)
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+        asyncore.close_all()
+
+
+def measure(count, function, size=0):
+    "Calls function and returns its timings for count items of size bytes"
+    start = time()
+    function()
+    elapsed = time() - start
+    result = {
+        'count': count,
+        'seconds': round(elapsed, 6),
+        'per_second': round(count / elapsed, 3) if elapsed else None,
+        }
+    if size:
+        result['bytes'] = size
+        result['mb_per_second'] = (round(size / elapsed / 1024 / 1024, 3)
+            if elapsed else None)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_smtp_server(host, port):
+    "Creates an smtp.server record of the smtp module for host and port"
+    from trytond.pool import Pool
+    SMTPServer = Pool().get('smtp.server')
+    server, = SMTPServer.create([{
+                'name': 'Benchmark',
+                'smtp_server': host,
+                'smtp_port': port,
+                'smtp_ssl': False,
+                'smtp_tls': False,
+                'smtp_email': 'benchmark@example.com',
+                'state': 'done',
+                }])
+    return server
+
+
+def benchmark_kind(kind, corpus, mailbox, results):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    ElectronicMail = Pool().get('electronic.mail')
+    files = [m.as_string() for m in corpus]
+    size = sum(len(f) for f in files)
+    count = len(corpus)
+
+    def create():
+        for mail in corpus:
+            ElectronicMail.create_from_email(mail, mailbox)
+    with Transaction().set_context(check_email=False):
+        results['%s.create_from_email' % kind] = measure(count, create, size)
+    emails = ElectronicMail.search([('mailbox', '=', mailbox.id)],
+        order=[('id', 'DESC')], limit=count)
+
+    def set_email():
+        for email, data in zip(emails, reversed(files)):
+            ElectronicMail.set_email([email], 'email_file', data)
+    with Transaction().set_context(check_email=False):
+        results['%s.set_email' % kind] = measure(count, set_email, size)
+
+    def get_file():
+        for email in emails:
+            email._get_email()
+    results['%s._get_email' % kind] = measure(count, get_file, size)
+
+    def parse():
+        for data in files:
+            ElectronicMail.parse_email(data)
+    results['%s.parse_email' % kind] = measure(count, parse, size)
+
+    def get_email():
+        ElectronicMail.get_email(emails, ['email_file'])
+    results['%s.get_email' % kind] = measure(count, get_email, size)
+
+
+def benchmark_send(corpus, mailbox, server, results):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    ElectronicMail = Pool().get('electronic.mail')
+    with Transaction().set_context(check_email=False):
+        emails = ElectronicMail.create_from_emails(corpus, mailbox)
+    received = server.messages
+
+    def send():
+        ElectronicMail.send_emails(emails)
+    results['send_emails'] = measure(len(emails), send,
+        sum(len(m.as_string()) for m in corpus))
+    results['send_emails']['received'] = server.messages - received
+
+
+def run(count=100, kinds=None, seed=0, attachment_size=1024 * 1024,
+        send_count=None, smtp_backend='thread'):
+    "Returns the benchmark results as a dict"
+    from trytond import backend
+    from trytond.config import config
+    from trytond.tests.test_tryton import (install_module, DB_NAME, USER,
+        CONTEXT)
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    if kinds is None:
+        kinds = KINDS
+    if send_count is None:
+        send_count = count
+    path = tempfile.mkdtemp()
+    config.set('database', 'path', path)
+    if not config.has_section('electronic_mail'):
+        config.add_section('electronic_mail')
+    config.set('electronic_mail', 'smtp_backend', smtp_backend)
+    server = SinkSMTPServer()
+    server.start()
+    results = {}
+    try:
+        install_module('electronic_mail')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            pool = Pool()
+            Mailbox = pool.get('electronic.mail.mailbox')
+            Configuration = pool.get('electronic.mail.configuration')
+            smtp_server = create_smtp_server(server.host, server.port)
+            inbox, outbox, sent, draft, error = Mailbox.create([
+                    {'name': 'Inbox'},
+                    {'name': 'Outbox', 'smtp_server': smtp_server.id},
+                    {'name': 'Sent'},
+                    {'name': 'Draft'},
+                    {'name': 'Error'},
+                    ])
+            Configuration.write([Configuration(1)], {
+                    'sent': sent.id,
+                    'draft': draft.id,
+                    'error': error.id,
+                    'outbox': outbox.id,
+                    })
+            for kind in kinds:
+                corpus = generate_corpus(kind, count, seed, attachment_size)
+                benchmark_kind(kind, corpus, inbox, results)
+            benchmark_send(generate_corpus('plain', send_count, seed),
+                outbox, server, results)
+            Transaction().rollback()
+        database = backend.name()
+    finally:
+        server.stop()
+        shutil.rmtree(path)
+    return {
+        'revision': git_revision(),
+        'date': formatdate(localtime=False),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'backend': database,
+        'parameters': {
+            'count': count,
+            'kinds': kinds,
+            'seed': seed,
+            'attachment_size': attachment_size,
+            'send_count': send_count,
+            'smtp_backend': smtp_backend,
+            },
+        'results': results,
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the electronic_mail module')
+    parser.add_argument('--count', type=int, default=100,
+        help='emails of each kind')
+    parser.add_argument('--kind', dest='kinds', action='append',
+        choices=KINDS, help='kind of emails (all by default)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--attachment-size', type=int, default=1024 * 1024,
+        help='bytes of the attachment of multipart emails')
+    parser.add_argument('--send-count', type=int,
+        help='emails sent (count by default)')
+    parser.add_argument('--backend', choices=['thread', 'asyncio'],
+        default='thread', help='SMTP sending backend')
+    parser.add_argument('--output', help='JSON file (stdout by default)')
+    options = parser.parse_args(args)
+    result = run(options.count, options.kinds, options.seed,
+        options.attachment_size, options.send_count, options.backend)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as file_p:
+            file_p.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
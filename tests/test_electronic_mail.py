@@ -1,18 +1,1376 @@
 # This file is part of the electronic_mail module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import os
+import shutil
+import smtplib
+import socket
+import tempfile
+import threading
+import time
 import unittest
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from datetime import datetime, timedelta
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from mailbox import mbox
+from StringIO import StringIO
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+from trytond.modules.electronic_mail.aiosender import (asyncio,
+    AsyncDeliveryPool)
+from trytond.modules.electronic_mail.cache import SizeLRUCache
+from trytond.modules.electronic_mail.charset import (decode_payload,
+    detect_charset)
+from trytond.modules.electronic_mail.electronic_mail import (ElectronicMail,
+    _decode_body, charset_cache, ACL_CACHE)
+from trytond.modules.electronic_mail.metrics import Metrics, metrics
+from trytond.modules.electronic_mail.sender import (is_permanent_error,
+    retry_delay, quote_data, DeliveryPool, FileSemaphore, FileTokenBucket,
+    SMTPConnection, TokenBucket, run_processes, smtp_pool, send_stream)
+from trytond.config import config
+from trytond.modules.electronic_mail.storage import (Storage,
+    FileSystemStorage, ShardedFileSystemStorage, S3Storage, compress,
+    decompress, ChunkReader, get_storage, merge_keys, sorted_keys)
+from trytond.modules.electronic_mail.tests.benchmark import (SinkSMTPServer,
+    create_smtp_server)
+
+try:
+    import boto3
+    from moto import mock_s3
+except ImportError:
+    mock_s3 = None
+
+
+def send_count(count):
+    "Function of the processes of test_run_processes"
+    # Not mixed with the result written on stdout
+    print 'Printed by the process'
+    metrics.inc('electronic_mail_test_processes_total', count)
+    if count == 3:
+        raise ValueError('Failed')
+
+
+class SMTPSink(SinkSMTPServer):
+    """
+    Local SMTP server failing the messages to refused and later recipients.
+    It counts the connections and refuses the ones after max_connections.
+    """
+
+    def __init__(self, max_connections=None):
+        SinkSMTPServer.__init__(self)
+        self.max_connections = max_connections
+        self.connections = 0
+        self.received = []
+
+    def handle_accept(self):
+        self.connections += 1
+        if self.max_connections and self.connections > self.max_connections:
+            pair = self.accept()
+            if pair is not None:
+                pair[0].sendall('421 Too many connections\r\n')
+                pair[0].close()
+            return
+        SinkSMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if any('refused' in r for r in rcpttos):
+            return '550 No such user'
+        if any('later' in r for r in rcpttos):
+            return '451 Try again later'
+        SinkSMTPServer.process_message(self, peer, mailfrom, rcpttos, data)
+        self.received.append((mailfrom, rcpttos, data))
 
 
 class ElectronicMailTestCase(ModuleTestCase):
     'Test Electronic Mail module'
     module = 'electronic_mail'
 
+    def setUp(self):
+        super(ElectronicMailTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.database_path = config.get('database', 'path')
+        config.set('database', 'path', self.path)
+
+    def tearDown(self):
+        # Also the semaphores, their lock files are in the removed path
+        smtp_pool.clear()
+        config.set('database', 'path', self.database_path)
+        shutil.rmtree(self.path)
+        super(ElectronicMailTestCase, self).tearDown()
+
+    def set_config(self, option, value):
+        "Sets option of the electronic_mail section for the test"
+        if not config.has_section('electronic_mail'):
+            config.add_section('electronic_mail')
+        previous = config.get('electronic_mail', option)
+
+        def restore():
+            if previous is None:
+                config.remove_option('electronic_mail', option)
+            else:
+                config.set('electronic_mail', option, previous)
+        config.set('electronic_mail', option, value)
+        self.addCleanup(restore)
+
+    def start_smtp(self, max_connections=None):
+        "Returns the running SMTPSink and the outbox sending to it"
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        Configuration = pool.get('electronic.mail.configuration')
+        sink = SMTPSink(max_connections)
+        sink.start()
+        self.addCleanup(sink.stop)
+        server = create_smtp_server(sink.host, sink.port)
+        outbox, sent, draft, error = Mailbox.create([
+                {'name': 'Outbox', 'smtp_server': server.id},
+                {'name': 'Sent'},
+                {'name': 'Draft'},
+                {'name': 'Error'},
+                ])
+        Configuration.write([Configuration(1)], {
+                'outbox': outbox.id,
+                'sent': sent.id,
+                'draft': draft.id,
+                'error': error.id,
+                })
+        return sink, outbox
+
+    def create_email(self, mailbox, subject='Test', to='to@example.com',
+            body='Body'):
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        msg = MIMEText(body)
+        msg['From'] = 'from@example.com'
+        msg['To'] = to
+        msg['Subject'] = subject
+        return ElectronicMail.create_from_email(msg, mailbox)
+
+    @with_transaction()
+    def test_mailbox_users(self):
+        'Users of the mailbox of the emails'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        user = Transaction().user
+        mailbox, other = Mailbox.create([{
+                    'name': 'Shared',
+                    'read_users': [('add', [user])],
+                    }, {
+                    'name': 'Other',
+                    }])
+        email = self.create_email(mailbox)
+
+        names = ['mailbox_read_users', 'mailbox_write_users']
+        self.assertEqual(ElectronicMail.get_mailbox_users([email], names), {
+                'mailbox_read_users': {email.id: (user,)},
+                'mailbox_write_users': {email.id: ()},
+                })
+        for name, result in [('mailbox_read_users', [email]),
+                ('mailbox_write_users', [])]:
+            self.assertEqual(ElectronicMail.search([
+                        ('mailbox', '=', mailbox.id),
+                        (name, '=', user),
+                        ]), result)
+
+        # The access control read is cleared when the mailboxes change
+        self.assertIn(ACL_CACHE, Transaction().get_cache())
+        Mailbox.write([mailbox], {'write_users': [('add', [user])]})
+        self.assertNotIn(ACL_CACHE, Transaction().get_cache())
+        self.assertEqual(ElectronicMail.get_mailbox_users([email], names)[
+                'mailbox_write_users'], {email.id: (user,)})
+        self.assertIn(ACL_CACHE, Transaction().get_cache())
+        Mailbox.delete([other])
+        self.assertNotIn(ACL_CACHE, Transaction().get_cache())
+
+        # Also when their relations with the users change
+        ReadUser = pool.get('electronic.mail.mailbox.read.res.user')
+        read_user, = ReadUser.search([('mailbox', '=', mailbox.id)])
+        ReadUser.delete([read_user])
+        self.assertNotIn(ACL_CACHE, Transaction().get_cache())
+        self.assertEqual(ElectronicMail.get_mailbox_users([email], names)[
+                'mailbox_read_users'], {email.id: ()})
+        third, = Mailbox.create([{'name': 'Third'}])
+        ElectronicMail.get_mailbox_users([email], names)
+        read_user, = ReadUser.create([{'mailbox': third.id, 'user': user}])
+        self.assertNotIn(ACL_CACHE, Transaction().get_cache())
+        ElectronicMail.get_mailbox_users([email], names)
+        ReadUser.write([read_user], {'mailbox': mailbox.id})
+        self.assertNotIn(ACL_CACHE, Transaction().get_cache())
+        self.assertEqual(ElectronicMail.get_mailbox_users([email], names)[
+                'mailbox_read_users'], {email.id: (user,)})
+
+    @with_transaction()
+    def test_mailbox_menu(self):
+        'Menus of the mailboxes'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ActWindow = pool.get('ir.action.act_window')
+        Menu = pool.get('ir.ui.menu')
+        table = Mailbox.__table__()
+        cursor = Transaction().connection.cursor()
+        mailboxes = Mailbox.create([{'name': 'Menu 1'}, {'name': 'Menu 2'}])
+        Mailbox.create_menu(mailboxes)
+        act_windows = [m.act_window for m in mailboxes]
+        for mailbox, act_window in zip(mailboxes, act_windows):
+            self.assertEqual(act_window.name, mailbox.name)
+            self.assertEqual(act_window.pyson_domain,
+                '[["mailbox", "=", %s]]' % mailbox.id)
+        menus = Menu.search([('name', 'in', ['Menu 1', 'Menu 2'])])
+        self.assertEqual(len(menus), 2)
+
+        Mailbox.write([mailboxes[0]], {'name': 'Renamed'})
+        self.assertEqual(ActWindow(act_windows[0].id).name, 'Renamed')
+        self.assertEqual(len(Menu.search([('name', '=', 'Renamed')])), 1)
+
+        # Mailboxes of 4.0 found from the domain of their action
+        cursor.execute(*table.update([table.act_window], [None],
+                where=table.id.in_([m.id for m in mailboxes])))
+        act_window = ActWindow.__table__()
+        cursor.execute(*act_window.update([act_window.domain],
+                [str([('mailbox', '=', mailboxes[1].id)])],
+                where=act_window.id == act_windows[1].id))
+        Mailbox._link_act_windows()
+        cursor.execute(*table.select(table.act_window,
+                where=table.id.in_([m.id for m in mailboxes]),
+                order_by=table.id))
+        self.assertEqual([r[0] for r in cursor.fetchall()],
+            [a.id for a in act_windows])
+
+        Mailbox.delete(mailboxes)
+        self.assertEqual(ActWindow.search([
+                    ('id', 'in', [a.id for a in act_windows]),
+                    ]), [])
+        self.assertEqual(Menu.search([('id', 'in', [m.id for m in menus])]),
+            [])
+
+    @with_transaction()
+    def test_search_rec_name(self):
+        'Search emails by name'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        mailbox, = Mailbox.create([{'name': 'Search'}])
+        email = self.create_email(mailbox, subject='Invoice 42',
+            to='accounting@example.com')
+        for value in ['%voice%', '%42', '%counting@%', 'invoice 42']:
+            self.assertEqual(ElectronicMail.search([
+                        ('mailbox', '=', mailbox.id),
+                        ('rec_name', 'ilike', value),
+                        ]), [email])
+        self.assertEqual(ElectronicMail.search([
+                    ('mailbox', '=', mailbox.id),
+                    ('rec_name', 'ilike', '%order%'),
+                    ]), [])
+
+    @with_transaction()
+    def test_search_full_text(self):
+        'Search emails by full text'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        mailbox, other = Mailbox.create([{'name': 'Search'}, {'name': 'Other'}])
+        invoice = self.create_email(mailbox, subject='Invoice 42',
+            to='accounting@example.com', body='Payment of the order')
+        order = self.create_email(mailbox, subject='Order',
+            body='Order shipped, the order was paid')
+        other_order = self.create_email(other, subject='Order',
+            body='Order order order order')
+
+        def search(name, text):
+            return ElectronicMail.search([
+                    ('mailbox', '=', mailbox.id),
+                    (name, 'ilike', text),
+                    ], order=[('id', 'ASC')])
+        self.assertEqual(search('full_text', 'invoice'), [invoice])
+        self.assertEqual(search('full_text', 'accounting'), [invoice])
+        self.assertEqual(search('full_text', 'pay'), [invoice])
+        self.assertEqual(search('full_text', 'order'), [invoice, order])
+        self.assertEqual(search('full_text', 'order paid'), [order])
+        self.assertEqual(search('full_text', 'refund'), [])
+        self.assertEqual(search('full_text_body', 'invoice'), [])
+        self.assertEqual(search('full_text_body', 'shipped'), [order])
+
+        # Only the writes of indexed fields update the index
+        ElectronicMail.write([invoice], {'subject': 'Refund 42'})
+        self.assertEqual(search('full_text', 'refund'), [invoice])
+        self.assertEqual(search('full_text', 'invoice'), [])
+
+        domain = [('mailbox', '=', mailbox.id)]
+        self.assertEqual(ElectronicMail.search_full_text_ranked('order',
+                domain=domain), [order, invoice])
+        self.assertEqual(ElectronicMail.search_full_text_ranked('order',
+                domain=domain, limit=1), [order])
+        self.assertEqual(ElectronicMail.search_full_text_ranked('order',
+                limit=1), [other_order])
+        self.assertEqual(ElectronicMail.search_full_text_ranked('shipped',
+                domain=domain, name='full_text_body'), [order])
+
+    @with_transaction()
+    def test_bodies(self):
+        'Bodies stored and backfilled'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        table = ElectronicMail.__table__()
+        cursor = Transaction().connection.cursor()
+        mailbox, = Mailbox.create([{'name': 'Bodies'}])
+        msg = MIMEMultipart()
+        alternative = MIMEMultipart('alternative')
+        alternative.attach(MIMEText('Plain body'))
+        alternative.attach(MIMEText('<p>HTML body</p>', 'html'))
+        msg.attach(alternative)
+        attachment = MIMEApplication('data')
+        attachment.add_header('Content-Disposition', 'attachment',
+            filename='data.bin')
+        msg.attach(attachment)
+        msg['From'] = 'from@example.com'
+        msg['To'] = 'to@example.com'
+        msg['Subject'] = 'Bodies'
+        email = ElectronicMail.create_from_email(msg, mailbox)
+
+        def bodies():
+            cursor.execute(*table.select(table.body_plain, table.body_html,
+                    table.num_attach, where=table.id == email.id))
+            return cursor.fetchone()
+        expected = (u'Plain body', u'<p>HTML body</p>', 1)
+        self.assertEqual(bodies(), expected)
+
+        # Emails saved before the bodies were stored
+        cursor.execute(*table.update(
+                [table.body_plain, table.body_html, table.num_attach],
+                [None, None, None], where=table.id == email.id))
+        ElectronicMail._backfill_bodies(batch_size=1)
+        self.assertEqual(bodies(), expected)
+
+    @with_transaction()
+    def test_create_from_emails(self):
+        'Create emails from messages'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        mailbox, = Mailbox.create([{'name': 'Create'}])
+        msgs = []
+        for i in range(2):
+            msg = MIMEText('Body %s' % i)
+            msg['From'] = 'from@example.com'
+            msg['To'] = 'to%s@example.com' % i
+            msg['Cc'] = 'cc%s@example.com' % i
+            msg['Subject'] = 'Create %s' % i
+            msgs.append(msg)
+
+        emails = ElectronicMail.create_from_emails(msgs, mailbox,
+            {'bcc': 'bcc@example.com'})
+        self.assertEqual([e.subject for e in emails], ['Create 0', 'Create 1'])
+        for i, (email, msg) in enumerate(zip(emails, msgs)):
+            self.assertEqual(email.mailbox, mailbox)
+            self.assertEqual(email.from_, 'from@example.com')
+            self.assertEqual(email.to, 'to%s@example.com' % i)
+            self.assertEqual(email.cc, 'cc%s@example.com' % i)
+            self.assertEqual(email.bcc, 'bcc@example.com')
+            self.assertEqual(email.body_plain, 'Body %s' % i)
+            self.assertEqual(get_storage().get(email._storage_key()),
+                msg.as_string())
+        self.assertEqual(ElectronicMail.create_from_emails(msgs, None), [])
+
+    @with_transaction()
+    def test_addresses(self):
+        'Addresses of the email headers'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        mailbox, = Mailbox.create([{'name': 'Addresses'}])
+        email = self.create_email(mailbox,
+            to='=?utf-8?q?Jos=C3=A9?= <jose@example.com>, other@example.com')
+        self.assertEqual(email.all_to, [
+                (u'Jos\xe9', u'jose@example.com'),
+                (u'', u'other@example.com'),
+                ])
+        self.assertEqual(email.all_cc, [])
+        self.assertEqual(email.all_bcc, [])
+
+    @with_transaction()
+    def test_import_mailbox(self):
+        'Import an mbox file twice'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        mailbox, = Mailbox.create([{'name': 'Import'}])
+        filename = os.path.join(self.path, 'import.mbox')
+        archive = mbox(filename)
+        for i in [1, 2, 1]:
+            msg = MIMEText('Body %s' % i)
+            msg['From'] = 'from@example.com'
+            msg['To'] = 'to@example.com'
+            msg['Subject'] = 'Import %s' % i
+            msg['Message-ID'] = '<%s@example.com>' % i
+            archive.add(msg)
+        archive.close()
+
+        self.assertEqual(ElectronicMail.import_mailbox(filename, mailbox,
+                batch_size=2, commit=False), (2, 1))
+        # Run again, as after an interruption
+        self.assertEqual(ElectronicMail.import_mailbox(filename, mailbox,
+                commit=False), (0, 3))
+        self.assertEqual(sorted(e.subject for e in ElectronicMail.search([
+                        ('mailbox', '=', mailbox.id),
+                        ])), ['Import 1', 'Import 2'])
+
+    @with_transaction()
+    def test_get_email(self):
+        'Email file read from the storage'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        mailbox, = Mailbox.create([{'name': 'Files'}])
+        email = self.create_email(mailbox, body='Body of the file')
+        key = email._storage_key()
+        data = get_storage().get(key)
+        self.assertIn('Body of the file', data)
+
+        values, = ElectronicMail.read([email.id], ['email_file', 'body_plain'])
+        self.assertEqual(str(values['email_file']), data)
+        self.assertEqual(values['body_plain'], 'Body of the file')
+
+        get_storage().delete(key)
+        values, = ElectronicMail.read([email.id], ['email_file'])
+        self.assertEqual(values['email_file'], None)
+
+    @with_transaction()
+    def test_storage_keys(self):
+        'Storage keys of the emails in sorted order'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        table = ElectronicMail.__table__()
+        cursor = Transaction().connection.cursor()
+        mailbox, = Mailbox.create([{'name': 'Keys'}])
+        expected = []
+        for digest, count in [('0key', 12), ('1key', 1), ('2key', 3)]:
+            for collision in range(count):
+                email = self.create_email(mailbox,
+                    subject='%s %s' % (digest, collision))
+                cursor.execute(*table.update(
+                        [table.digest, table.collision],
+                        [digest, collision or None],
+                        where=table.id == email.id))
+                expected.append('%s-%s' % (digest, collision) if collision
+                    else digest)
+        keys = [k for k in ElectronicMail._storage_keys(3)
+            if k[1:].startswith('key')]
+        self.assertEqual(keys, sorted(expected))
+        self.assertEqual(len(list(merge_keys(
+                        ElectronicMail._storage_keys(3), []))),
+            len(list(ElectronicMail._storage_keys(1000))))
+
+    @with_transaction()
+    def test_check_storage_parts(self):
+        'Parts of the orphan files kept are not deleted'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        self.set_config('split_part_size', '1024')
+        storage = get_storage()
+        msg = MIMEMultipart()
+        msg['Subject'] = 'Orphan'
+        msg.attach(MIMEText('body'))
+        msg.attach(MIMEApplication('%PDF' + 'x' * 10000))
+        data = msg.as_string()
+        key = ElectronicMail.make_digest(data)
+        storage.put(key, data)
+        (_, _, part_key, _), = storage.get_index(key)
+        old = time.time() - 30 * 24 * 60 * 60
+        os.utime(storage.parts.path(part_key), (old, old))
+
+        # The orphan file is kept during the grace period with its part
+        ElectronicMail._check_storage(grace_days=7)
+        self.assertTrue(storage.exists(key))
+        self.assertTrue(storage.parts.exists(part_key))
+
+        os.utime(storage.path(key), (old, old))
+        ElectronicMail._check_storage(grace_days=7)
+        self.assertFalse(storage.exists(key))
+        ElectronicMail._check_storage(grace_days=7)
+        self.assertFalse(storage.parts.exists(part_key))
+
+    @with_transaction()
+    def test_dequeue(self):
+        'Dequeue leases the emails'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        ElectronicMail = pool.get('electronic.mail')
+        mailbox, = Mailbox.create([{'name': 'Queue'}])
+        email1 = self.create_email(mailbox)
+        email2 = self.create_email(mailbox)
+        later = self.create_email(mailbox)
+        later.next_attempt_at = datetime.now() + timedelta(hours=1)
+        later.save()
+
+        self.assertEqual(ElectronicMail.dequeue([mailbox], limit=1,
+                commit=False), [email1])
+        self.assertEqual(ElectronicMail.dequeue([mailbox], commit=False),
+            [email2])
+        self.assertEqual(ElectronicMail.dequeue([mailbox], commit=False), [])
+        table = ElectronicMail.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(table.leased_until,
+                where=table.id.in_([email1.id, email2.id, later.id]),
+                order_by=table.id))
+        leased = [r[0] for r in cursor.fetchall()]
+        self.assertTrue(leased[0] and leased[1])
+        self.assertEqual(leased[2], None)
+
+    @with_transaction()
+    def test_send_emails(self):
+        'Send emails to the mailboxes of their result'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Configuration = pool.get('electronic.mail.configuration')
+        sink, outbox = self.start_smtp()
+        configuration = Configuration(1)
+        sent = self.create_email(outbox, to='to@example.com')
+        refused = self.create_email(outbox, to='refused@example.com')
+        later = self.create_email(outbox, to='later@example.com')
+
+        ElectronicMail.send_emails([sent, refused, later])
+        sent, refused, later = ElectronicMail.browse(
+            [sent.id, refused.id, later.id])
+        self.assertEqual(sent.mailbox, configuration.sent)
+        self.assertTrue(sent.flag_send)
+        self.assertEqual(refused.mailbox, configuration.error)
+        self.assertEqual(refused.next_attempt_at, None)
+        self.assertEqual(later.mailbox, outbox)
+        self.assertGreater(later.next_attempt_at, datetime.now())
+        for email in [sent, refused, later]:
+            self.assertEqual(email.attempts, 1)
+            self.assertEqual(email.leased_until, None)
+        self.assertEqual(sink.messages, 1)
+
+    @with_transaction()
+    def test_send_emails_unreachable(self):
+        'Release the leases of the emails not sent without connection'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        sink, outbox = self.start_smtp()
+        sink.stop()
+        email = self.create_email(outbox)
+        self.assertEqual(ElectronicMail.dequeue([outbox], commit=False),
+            [email])
+
+        ElectronicMail.send_emails([email])
+        table = ElectronicMail.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(table.leased_until, table.attempts,
+                where=table.id == email.id))
+        self.assertEqual(cursor.fetchone(), (None, 0))
+        self.assertEqual(ElectronicMail.dequeue([outbox], commit=False),
+            [email])
+
+    @with_transaction()
+    def test_send_emails_merged(self):
+        'Send identical emails in one transaction'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Configuration = pool.get('electronic.mail.configuration')
+        sink, outbox = self.start_smtp()
+        msg = MIMEText('Newsletter')
+        msg['From'] = 'from@example.com'
+        msg['Subject'] = 'Newsletter'
+        emails = ElectronicMail.create_from_emails([msg, msg], outbox)
+        ElectronicMail.write([emails[0]], {'to': 'to1@example.com'},
+            [emails[1]], {'to': 'to2@example.com'})
+        self.assertEqual(emails[0]._storage_key(), emails[1]._storage_key())
+
+        ElectronicMail.send_emails(emails)
+        self.assertEqual((sink.messages, sink.recipients), (1, 2))
+        self.assertEqual(sorted(sink.received[0][1]),
+            ['to1@example.com', 'to2@example.com'])
+        for email in ElectronicMail.browse([e.id for e in emails]):
+            self.assertEqual(email.mailbox, Configuration(1).sent)
+
+    @with_transaction()
+    def test_send_emails_shard(self):
+        'Send the emails of a shard'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Configuration = pool.get('electronic.mail.configuration')
+        sink, outbox = self.start_smtp()
+        emails = [self.create_email(outbox, to='to%s@example.com' % i)
+            for i in range(4)]
+
+        ElectronicMail._send_emails_shard([outbox], shards=[(0, 2)],
+            commit=False)
+        table = ElectronicMail.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(table.id, table.mailbox,
+                where=table.id.in_([e.id for e in emails])))
+        mailboxes = dict(cursor.fetchall())
+        sent = Configuration(1).sent.id
+        for email in emails:
+            self.assertEqual(mailboxes[email.id],
+                sent if email.id % 2 == 0 else outbox.id)
+        self.assertEqual(sink.messages, 2)
+
+    @with_transaction()
+    def test_send_emails_connections(self):
+        'Send emails when only some connections can be opened'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Configuration = pool.get('electronic.mail.configuration')
+        self.set_config('smtp_workers', '3')
+        sink, outbox = self.start_smtp(max_connections=1)
+        emails = [self.create_email(outbox, to='to%s@example.com' % i)
+            for i in range(3)]
+
+        ElectronicMail.send_emails(emails)
+        for email in ElectronicMail.browse([e.id for e in emails]):
+            self.assertEqual(email.mailbox, Configuration(1).sent)
+        self.assertEqual(sink.messages, 3)
+        self.assertEqual(sink.connections, 2)
+
+        # Not even one connection
+        smtp_pool.clear()
+        email = self.create_email(outbox)
+        ElectronicMail.send_emails([email])
+        email = ElectronicMail(email.id)
+        self.assertEqual((email.mailbox, email.attempts), (outbox, 0))
+
+    @with_transaction()
+    def test_send_emails_max_attempts(self):
+        'Send emails until max_attempts'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Configuration = pool.get('electronic.mail.configuration')
+        sink, outbox = self.start_smtp()
+        configuration = Configuration(1)
+        configuration.max_attempts = 2
+        configuration.save()
+        email = self.create_email(outbox, to='later@example.com')
+
+        ElectronicMail.send_emails([email])
+        email = ElectronicMail(email.id)
+        self.assertEqual(email.mailbox, outbox)
+        self.assertEqual(email.attempts, 1)
+        self.assertTrue(email.next_attempt_at)
+
+        ElectronicMail.send_emails([email])
+        email = ElectronicMail(email.id)
+        self.assertEqual(email.mailbox, configuration.error)
+        self.assertEqual(email.attempts, 2)
+        self.assertEqual(email.next_attempt_at, None)
+
+        # Without error mailbox the email stays to be retried
+        class Configuration(object):
+            error = None
+            max_attempts = 2
+            retry_delay = 60
+            retry_max_delay = 3600
+
+        attempts, mailbox, _, next_attempt_at = email._get_failed_state(
+            smtplib.SMTPDataError(550, 'No such user'), Configuration())
+        self.assertEqual((attempts, mailbox), (3, email.mailbox.id))
+        self.assertTrue(next_attempt_at)
+
+    @unittest.skipIf(asyncio is None, 'asyncio or trollius is not installed')
+    @with_transaction()
+    def test_send_emails_asyncio(self):
+        'Send emails with asyncio'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Configuration = pool.get('electronic.mail.configuration')
+        self.set_config('smtp_backend', 'asyncio')
+        sink, outbox = self.start_smtp()
+        server = outbox.smtp_server
+        server.max_connections = 1
+        server.save()
+        email1 = self.create_email(outbox, to='to1@example.com')
+        email2 = self.create_email(outbox, to='to2@example.com')
+        # The addresses of the records are unicode
+        email2 = ElectronicMail(email2.id)
+        self.assertIsInstance(email2.to, unicode)
+
+        # The idle connection kept by send_email does not hold the only
+        # connection of the server
+        self.assertTrue(email1.send_email())
+        ElectronicMail.send_emails([email2])
+        email2 = ElectronicMail(email2.id)
+        self.assertEqual(email2.mailbox, Configuration(1).sent)
+        self.assertEqual(email2.attempts, 1)
+        self.assertEqual([r for _, r, _ in sink.received],
+            [['to1@example.com'], ['to2@example.com']])
+
+    @with_transaction()
+    def test_send_email_missing_file(self):
+        'Send an email without file'
+        sink, outbox = self.start_smtp()
+        email = self.create_email(outbox)
+        get_storage().delete(email._storage_key())
+        self.assertFalse(email.send_email())
+        self.assertFalse(email.flag_send)
+        self.assertEqual(sink.messages, 0)
+
+    @with_transaction()
+    def test_smtp_pool(self):
+        'SMTP connections kept open between sendings'
+        sink, outbox = self.start_smtp()
+        server = outbox.smtp_server
+
+        def send(count=1):
+            for _ in range(count):
+                self.assertTrue(self.create_email(outbox).send_email())
+            return sink.connections
+
+        self.assertEqual(send(2), 1)
+
+        # Connection dropped by the server while idle
+        connection = smtp_pool.get(server)
+        connection.smtp.sock.shutdown(socket.SHUT_RDWR)
+        smtp_pool.put(connection)
+        self.assertEqual(send(), 2)
+
+        # The server settings changed
+        server.rate_limit = 100
+        server.save()
+        self.assertEqual(send(2), 3)
+
+        self.set_config('smtp_idle_timeout', '1')
+        smtp_pool.clear()
+        self.assertEqual(send(), 4)
+        time.sleep(1)
+        self.assertEqual(send(), 5)
+
+        self.set_config('smtp_max_messages', '1')
+        smtp_pool.clear()
+        self.assertEqual(send(2), 7)
+        self.assertEqual(sink.messages, 9)
+
+    @with_transaction()
+    def test_send_email_wait(self):
+        'Send an email waits a bounded time for a connection'
+        self.set_config('smtp_wait_timeout', '0')
+        sink, outbox = self.start_smtp()
+        server = outbox.smtp_server
+        server.max_connections = 1
+        server.save()
+        email = self.create_email(outbox)
+        connection = smtp_pool.get(server)
+        try:
+            self.assertRaises(UserError, email.send_email)
+        finally:
+            smtp_pool.put(connection)
+        self.assertTrue(email.send_email())
+        self.assertEqual(sink.messages, 1)
+
+
+class SMTPStandIn(asyncio.Protocol if asyncio else object):
+    "Local SMTP server refusing the recipients containing refused"
+
+    def __init__(self, messages, pipelining=True):
+        self.messages = messages
+        self.pipelining = pipelining
+        self.buffer = ''
+        self.data = None
+        self.rcpts = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.reply('220 stand-in')
+
+    def reply(self, line):
+        self.transport.write(line + '\r\n')
+
+    def data_received(self, data):
+        self.buffer += data
+        while '\r\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\r\n', 1)
+            if self.data is not None:
+                if line == '.':
+                    self.messages.append((self.rcpts, '\r\n'.join(self.data)))
+                    self.data = None
+                    self.reply('250 Queued')
+                else:
+                    self.data.append(line[1:] if line.startswith('.')
+                        else line)
+                continue
+            command = line[:4].upper()
+            if command == 'EHLO':
+                if self.pipelining:
+                    self.reply('250-stand-in')
+                    self.reply('250 PIPELINING')
+                else:
+                    self.reply('250 stand-in')
+            elif command == 'MAIL':
+                self.rcpts = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                if 'refused' in line:
+                    self.reply('550 No such user')
+                else:
+                    self.rcpts.append(line[8:])
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                if self.rcpts:
+                    self.data = []
+                    self.reply('354 Go ahead')
+                else:
+                    self.reply('554 No valid recipients')
+            elif command == 'RSET':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                self.transport.close()
+            else:
+                self.reply('502 Not implemented')
+
+
+@unittest.skipIf(asyncio is None, 'asyncio or trollius is not installed')
+class AsyncSenderTestCase(unittest.TestCase):
+    'Test Electronic Mail asyncio sending'
+
+    def start_server(self, pipelining=True):
+        "Starts a stand-in server and returns its messages and its port"
+        loop = asyncio.new_event_loop()
+        messages = []
+        server = loop.run_until_complete(loop.create_server(
+                lambda: SMTPStandIn(messages, pipelining), '127.0.0.1', 0))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.close()
+        self.addCleanup(stop)
+        return messages, server.sockets[0].getsockname()[1]
+
+    def test_deliver(self):
+        'Test AsyncDeliveryPool deliver'
+        for pipelining in (True, False):
+            messages, port = self.start_server(pipelining)
+            pool = AsyncDeliveryPool('127.0.0.1', port, connections=5,
+                max_recipients=2, timeout=10)
+            pool.open()
+            self.addCleanup(pool.close)
+            jobs = []
+            for i in range(30):
+                data = 'Subject: %s\n\n.dot\nbody %s' % (i, i)
+                if i % 2:
+                    data = (lambda data: lambda: StringIO(data))(data)
+                jobs.append((i, 'a@example.com',
+                        ['b%s@example.com' % i, 'refused@example.com',
+                            'c%s@example.com' % i, 'd%s@example.com' % i],
+                        data))
+            jobs.append((30, 'a@example.com', ['refused@example.com'], ''))
+            jobs.append((31, 'a@example.com',
+                    ['refused1@example.com', 'refused2@example.com',
+                        'e@example.com'], 'Subject: 31\n\nbody'))
+            results = dict((k, (e, r)) for k, e, r in pool.deliver(jobs))
+            pool.close()
+
+            self.assertEqual(sorted(results), range(32))
+            self.assertEqual([k for k, (e, _) in results.iteritems() if e],
+                [30])
+            exception, _ = results[30]
+            self.assertIsInstance(exception, smtplib.SMTPRecipientsRefused)
+            self.assertTrue(is_permanent_error(exception))
+            self.assertEqual(results[1][1], {
+                    'refused@example.com': (550, 'No such user'),
+                    })
+            self.assertEqual(sorted(results[31][1]),
+                ['refused1@example.com', 'refused2@example.com'])
+            # One transaction per 2 recipients
+            self.assertEqual(len(messages), 61)
+            self.assertIn((['<b1@example.com>'],
+                    'Subject: 1\r\n\r\n.dot\r\nbody 1'), messages)
+            self.assertIn((['<c1@example.com>', '<d1@example.com>'],
+                    'Subject: 1\r\n\r\n.dot\r\nbody 1'), messages)
+
+    def test_open_error(self):
+        'Test AsyncDeliveryPool open error'
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        pool = AsyncDeliveryPool('127.0.0.1', port, connections=2,
+            timeout=10)
+        self.assertRaises(EnvironmentError, pool.open)
+
+
+class CacheTestCase(unittest.TestCase):
+    'Test Electronic Mail caches'
+
+    def test_size_lru_cache(self):
+        'Test SizeLRUCache'
+        cache = SizeLRUCache(10)
+        cache.set('a', 1, 4)
+        cache.set('b', 2, 4)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3, 4)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.size, 8)
+        cache.set('d', 4, 11)
+        self.assertNotIn('d', cache)
+
+
+class CharsetTestCase(unittest.TestCase):
+    'Test Electronic Mail charset detection'
+
+    def test_detect_charset(self):
+        'Test detect_charset'
+        self.assertEqual(detect_charset('plain ascii'), 'utf-8')
+        self.assertEqual(detect_charset(u'Acci\xf3'.encode('utf-8')),
+            'utf-8')
+        self.assertNotEqual(detect_charset(
+                u'Acci\xf3 r\xe0pida '.encode('latin-1') * 20), 'utf-8')
+
+    def test_decode_payload(self):
+        'Test decode_payload'
+        self.assertEqual(decode_payload(u'Acci\xf3'.encode('latin-1'),
+                'iso-8859-1'), (u'Acci\xf3', 'iso8859-1'))
+        # Wrong or unknown declared charsets are detected
+        body, charset = decode_payload(u'Acci\xf3'.encode('utf-8'), 'ascii')
+        self.assertEqual((body, charset), (u'Acci\xf3', 'utf-8'))
+        body, charset = decode_payload('text', 'unknown-charset')
+        self.assertEqual((body, charset), (u'text', 'utf-8'))
+
+    def test_decode_body_cache(self):
+        'Test _decode_body caches only the wrong charsets'
+        charset_cache.clear()
+        part = MIMEText(u'Acci\xf3'.encode('latin-1'), 'plain', 'ISO-8859-1')
+        self.assertEqual(_decode_body(part, 'latin'), u'Acci\xf3')
+        self.assertNotIn('latin', charset_cache)
+        part = MIMEText(u'Acci\xf3'.encode('utf-8'), 'plain', 'us-ascii')
+        self.assertEqual(_decode_body(part, 'ascii'), u'Acci\xf3')
+        self.assertEqual(charset_cache.get('ascii'), 'utf-8')
+        charset_cache.clear()
+
+
+class MetricsTestCase(unittest.TestCase):
+    'Test Electronic Mail metrics'
+
+    def test_metrics(self):
+        'Test Metrics'
+        metrics = Metrics()
+        notified = []
+        metrics.add_hook(lambda *args: notified.append(args))
+        metrics.inc('electronic_mail_sent_total', server=1,
+            result='sent')
+        metrics.inc('electronic_mail_sent_total', server=1,
+            result='sent')
+        metrics.observe('electronic_mail_parse_seconds', 0.02)
+        self.assertEqual(metrics.counter('electronic_mail_sent_total',
+                server=1, result='sent'), 2)
+        self.assertEqual(metrics.histogram('electronic_mail_parse_seconds'),
+            (0.02, 1))
+        self.assertEqual(len(notified), 3)
+
+        text = metrics.prometheus()
+        self.assertIn('# TYPE electronic_mail_sent_total counter', text)
+        self.assertIn('electronic_mail_sent_total{result="sent",'
+            'server="1"} 2', text)
+        self.assertIn('electronic_mail_parse_seconds_bucket{le="0.01"} 0',
+            text)
+        self.assertIn('electronic_mail_parse_seconds_bucket{le="0.025"} 1',
+            text)
+        self.assertIn('electronic_mail_parse_seconds_count 1', text)
+
+        other = Metrics()
+        other.load(metrics.dump())
+        other.load(metrics.dump())
+        self.assertEqual(other.counter('electronic_mail_sent_total',
+                server=1, result='sent'), 4)
+        self.assertEqual(other.histogram('electronic_mail_parse_seconds'),
+            (0.04, 2))
+
+    def test_export_if_due(self):
+        'Test Metrics.export_if_due'
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'metrics.prom')
+        if not config.has_section('electronic_mail'):
+            config.add_section('electronic_mail')
+        for option, value in [('metrics_file', filename),
+                ('metrics_interval', '3600')]:
+            config.set('electronic_mail', option, value)
+            self.addCleanup(config.remove_option, 'electronic_mail', option)
+        metrics = Metrics()
+        metrics.inc('electronic_mail_sent_total', server=1, result='sent')
+        metrics.export_if_due()
+        self.assertTrue(os.path.exists(filename))
+        os.remove(filename)
+        metrics.export_if_due()
+        self.assertFalse(os.path.exists(filename))
+        metrics.export()
+        self.assertTrue(os.path.exists(filename))
+
+
+class SenderTestCase(unittest.TestCase):
+    'Test Electronic Mail sending'
+
+    def test_is_permanent_error(self):
+        'Test is_permanent_error'
+        self.assertTrue(is_permanent_error(
+                smtplib.SMTPDataError(554, 'Rejected')))
+        self.assertFalse(is_permanent_error(
+                smtplib.SMTPDataError(451, 'Try again later')))
+        self.assertTrue(is_permanent_error(smtplib.SMTPRecipientsRefused({
+                        'a@example.com': (550, 'Unknown'),
+                        })))
+        self.assertFalse(is_permanent_error(smtplib.SMTPRecipientsRefused({
+                        'a@example.com': (550, 'Unknown'),
+                        'b@example.com': (452, 'Mailbox full'),
+                        })))
+        self.assertFalse(is_permanent_error(
+                smtplib.SMTPServerDisconnected()))
+
+    def test_retry_delay(self):
+        'Test retry_delay'
+        for attempts, maximum in [(1, 300), (2, 600), (3, 1200), (20, 3600)]:
+            delay = retry_delay(attempts, 300, 3600)
+            self.assertLessEqual(delay, maximum)
+            self.assertGreaterEqual(delay, maximum / 2)
+        self.assertEqual(retry_delay(3, 300, 3600, jitter=0), 1200)
+
+    def test_token_bucket(self):
+        'Test TokenBucket'
+        bucket = TokenBucket(100, capacity=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_file_token_bucket(self):
+        'Test FileTokenBucket'
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'rate')
+        bucket1 = FileTokenBucket(filename, 100, capacity=2)
+        bucket2 = FileTokenBucket(filename, 100, capacity=2)
+        self.assertEqual(bucket1.acquire(), 0)
+        self.assertEqual(bucket2.acquire(), 0)
+        self.assertGreater(bucket1.acquire(), 0)
+
+    def test_file_semaphore(self):
+        'Test FileSemaphore'
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'connections')
+        semaphore1 = FileSemaphore(filename, 2)
+        semaphore2 = FileSemaphore(filename, 2)
+        self.assertTrue(semaphore1.acquire())
+        self.assertTrue(semaphore2.acquire(False))
+        self.assertFalse(semaphore1.acquire(False))
+        self.assertFalse(semaphore2.acquire(False))
+        semaphore1.release()
+        self.assertTrue(semaphore2.acquire(False))
+        self.assertRaises(ValueError, semaphore1.release)
+        semaphore2.release()
+        semaphore2.release()
+        self.assertTrue(semaphore1.acquire(False))
+
+    def test_quote_data(self):
+        'Test quote_data'
+        for data in ['', 'a', 'a\n.b\r\n.\r\n', '.a\rb\r', 'a\r\n..\n']:
+            quoted = smtplib.quotedata(data)
+            if not quoted.endswith(smtplib.CRLF):
+                quoted += smtplib.CRLF
+            quoted += '.' + smtplib.CRLF
+            for size in (1, 2, 100):
+                chunks = [data[i:i + 2] for i in range(0, len(data), 2)]
+                self.assertEqual(''.join(quote_data(ChunkReader(chunks),
+                            size)), quoted)
+
+    def test_max_recipients(self):
+        'Test SMTPConnection max_recipients'
+        sent = []
+
+        class SMTP(object):
+            def sendmail(self, from_addr, to_addrs, msg):
+                sent.append(to_addrs)
+                if all(a.startswith('refused') for a in to_addrs):
+                    raise smtplib.SMTPRecipientsRefused(dict(
+                            (a, (550, 'Unknown')) for a in to_addrs))
+                return {}
+
+        connection = SMTPConnection(None, SMTP, max_recipients=2)
+        connection.sendmail('a@example.com',
+            ['b@example.com', 'c@example.com', 'd@example.com'], 'msg')
+        self.assertEqual(sent, [['b@example.com', 'c@example.com'],
+                ['d@example.com']])
+        self.assertEqual(connection.messages, 1)
+
+        # A refused transaction does not stop the others
+        self.assertEqual(connection.sendmail('a@example.com',
+                ['refused1@example.com', 'refused2@example.com',
+                    'd@example.com'], 'msg'), {
+                'refused1@example.com': (550, 'Unknown'),
+                'refused2@example.com': (550, 'Unknown'),
+                })
+        self.assertRaises(smtplib.SMTPRecipientsRefused, connection.sendmail,
+            'a@example.com', ['refused1@example.com'], 'msg')
+
+    def test_send_stream_options(self):
+        'Test send_stream MAIL options'
+        commands = []
+
+        class SMTP(smtplib.SMTP):
+            def ehlo_or_helo_if_needed(self):
+                pass
+
+            def putcmd(self, cmd, args=''):
+                commands.append(cmd if not args else '%s %s' % (cmd, args))
+
+            def getreply(self):
+                return {'mail': 250, 'rcpt': 250, 'data': 354}.get(
+                    commands[-1].split()[0] if commands else None, 250), ''
+
+            def send(self, data):
+                commands.append(data)
+
+        smtp = SMTP()
+        smtp.does_esmtp = True
+        smtp.esmtp_features = {'size': '1000', '8bitmime': ''}
+        send_stream(smtp, 'a@example.com', ['b@example.com'],
+            StringIO('Subject: test\n\nbody\n'), size=100)
+        self.assertEqual(commands[0],
+            'mail FROM:<a@example.com> SIZE=100 BODY=8BITMIME')
+
+        # Without the extensions the options are not sent
+        commands[:] = []
+        smtp.esmtp_features = {}
+        send_stream(smtp, 'a@example.com', ['b@example.com'],
+            StringIO('Subject: test\n\nbody\n'), size=100)
+        self.assertEqual(commands[0], 'mail FROM:<a@example.com>')
+
+    def test_run_processes(self):
+        'Test run_processes'
+        self.assertEqual(run_processes(send_count, [(1,), (2,), (3,)]), 1)
+        self.assertEqual(
+            metrics.counter('electronic_mail_test_processes_total'), 6)
+
+    def test_delivery_pool(self):
+        'Test DeliveryPool'
+        sink = SMTPSink()
+        sink.start()
+        self.addCleanup(sink.stop)
+        connections = [SMTPConnection(None,
+                lambda: smtplib.SMTP(sink.host, sink.port))
+            for _ in range(2)]
+        self.addCleanup(lambda: [c.close() for c in connections])
+        jobs = [(i, 'from@example.com',
+                ['%s%s@example.com' % ('refused' if i % 3 else 'to', i)],
+                'Subject: %s\n\nbody %s\n' % (i, i))
+            for i in range(9)]
+        results = {}
+        for key, exception, refused in DeliveryPool(connections).deliver(
+                iter(jobs)):
+            self.assertNotIn(key, results)
+            results[key] = exception
+        self.assertEqual(sorted(results), range(9))
+        for key, exception in results.iteritems():
+            if key % 3:
+                self.assertEqual(exception.smtp_code, 550)
+            else:
+                self.assertEqual(exception, None)
+        self.assertEqual(sorted(r[1] for r in sink.received),
+            [['to0@example.com'], ['to3@example.com'], ['to6@example.com']])
+        self.assertEqual(sink.connections, 2)
+
+    def test_delivery_jobs(self):
+        'Test merge of identical emails in delivery jobs'
+        class Email(object):
+            def __init__(self, id, priority, from_, recipients, key):
+                self.id = id
+                self.priority = priority
+                self.from_ = from_
+                self.recipients = recipients
+                self.key = key
+
+            def recipients_from_fields(self):
+                return self.recipients
+
+            def _storage_key(self):
+                return self.key
+
+            def _open_email(self):
+                return self.key
+
+        emails = [
+            Email(1, 3, 'a@example.com', ['b@one.com'], 'k1'),
+            Email(2, 3, 'a@example.com', ['c@two.com'], 'k1'),
+            Email(3, 1, 'a@example.com', ['d@two.com'], 'k2'),
+            Email(4, 3, 'x@example.com', ['e@one.com'], 'k1'),
+            Email(5, 3, 'a@example.com',
+                ['b@one.com', 'f@one.com', 'g@one.com'], 'k1'),
+            Email(6, 3, 'a@example.com', ['h@three.com'], None),
+            Email(7, 3, 'a@example.com', ['b@one.com'], 'k1'),
+            ]
+        jobs = ElectronicMail._delivery_jobs(emails, max_recipients=3)
+        self.assertEqual([[i for i, _ in job[0]] for job in jobs],
+            [[3], [1, 5, 7], [4], [6], [2]])
+        self.assertEqual(jobs[1][1:], ('a@example.com',
+                ['b@one.com', 'f@one.com', 'g@one.com'], 'k1'))
+        self.assertEqual(len(ElectronicMail._delivery_jobs(emails,
+                    max_recipients=0)), len(emails))
+
+
+class StorageTestCase(unittest.TestCase):
+    'Test Electronic Mail storages'
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_storage(self, storage):
+        key = 'ab' * 32
+        self.assertIsNone(storage.get(key))
+        self.assertFalse(storage.exists(key))
+        storage.put(key, 'Subject: test\n\nbody')
+        self.assertTrue(storage.exists(key))
+        self.assertEqual(storage.get(key), 'Subject: test\n\nbody')
+        with storage.open(key) as file_p:
+            self.assertEqual(file_p.read(), 'Subject: test\n\nbody')
+        storage.delete(key)
+        self.assertFalse(storage.exists(key))
+
+    def test_filesystem(self):
+        'Test filesystem storage'
+        storage = FileSystemStorage('test', self.path)
+        self.check_storage(storage)
+        self.assertEqual(storage.path('abcdef'),
+            os.path.join(self.path, 'ab', 'abcdef'))
+        self.assertRaises(TypeError, Storage, 'test')
+
+    def test_sharded(self):
+        'Test sharded filesystem storage'
+        storage = ShardedFileSystemStorage('test', self.path)
+        self.check_storage(storage)
+        self.assertEqual(storage.path('abcdef01'),
+            os.path.join(self.path, 'ab', 'cd', 'ef', 'abcdef01'))
+
+        FileSystemStorage('test', self.path).put('abcdef01', 'legacy')
+        self.assertEqual(storage.get('abcdef01'), 'legacy')
+
+    def test_keys(self):
+        'Test storage keys and merge_keys'
+        legacy = FileSystemStorage('test', self.path)
+        storage = ShardedFileSystemStorage('test', self.path)
+        legacy.put('abcd02', 'Subject: 2\n\n')
+        storage.put('abcd01', 'Subject: 1\n\n')
+        storage.put('0bcd03', 'Subject: 3\n\n')
+        self.assertEqual(list(legacy.keys()), ['abcd02'])
+        self.assertEqual(list(storage.keys()), ['0bcd03', 'abcd01', 'abcd02'])
+        self.assertIsNotNone(storage.modified('abcd02'))
+        self.assertTrue(storage.touch('abcd02'))
+        self.assertFalse(storage.touch('abcd04'))
+        self.assertTrue(storage.verify('abcd01') is True)
+
+        self.assertEqual(list(merge_keys(['a', 'c', 'd'], ['b', 'c'])), [
+                ('a', True, False),
+                ('b', False, True),
+                ('c', True, True),
+                ('d', True, False),
+                ])
+        with self.assertRaises(ValueError):
+            list(merge_keys(['b', 'a'], []))
+
+        keys = ['%02d' % (i * 7 % 30) for i in range(60)]
+        self.assertEqual(list(sorted_keys(keys, buffer_size=4)),
+            sorted(set(keys)))
+        self.assertEqual(list(sorted_keys([])), [])
+
+    def test_compression(self):
+        'Test compressed storage'
+        data = 'Subject: test\n\n' + 'body ' * 1000
+        compressed = compress(data, 'gzip')
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(decompress(compressed), data)
+        self.assertEqual(decompress(data), data)
+        self.assertEqual(compress('short', 'gzip'), 'short')
+
+        if not config.has_section('electronic_mail'):
+            config.add_section('electronic_mail')
+        config.set('electronic_mail', 'compression', 'gzip')
+        self.addCleanup(config.remove_option, 'electronic_mail',
+            'compression')
+        storage = ShardedFileSystemStorage('test', self.path)
+        storage.put('abcdef01', data)
+        self.assertEqual(storage.compression('abcdef01'), 'gzip')
+        self.assertEqual(storage.get('abcdef01'), data)
+        self.assertEqual(storage.get_head('abcdef01'), 'Subject: test\n\n')
+        with storage.open('abcdef01') as file_p:
+            self.assertEqual(file_p.readline(), 'Subject: test\n')
+            self.assertEqual(file_p.read(), data[14:])
+
+        # Files saved uncompressed remain readable
+        FileSystemStorage('test', self.path).put_raw('abcdef02', data)
+        self.assertEqual(storage.compression('abcdef02'), None)
+        self.assertEqual(storage.get('abcdef02'), data)
+
+    def test_split_parts(self):
+        'Test email files with parts stored apart'
+        attachment = MIMEApplication('%PDF' + 'x' * 10000)
+        attachment.add_header('Content-Disposition', 'attachment',
+            filename='terms.pdf')
+        files = []
+        for i in range(2):
+            msg = MIMEMultipart()
+            msg['Subject'] = 'test %s' % i
+            msg.attach(MIMEText('body %s' % i))
+            msg.attach(attachment)
+            files.append(msg.as_string())
+
+        if not config.has_section('electronic_mail'):
+            config.add_section('electronic_mail')
+        config.set('electronic_mail', 'split_part_size', '1024')
+        self.addCleanup(config.remove_option, 'electronic_mail',
+            'split_part_size')
+        storage = FileSystemStorage('test', self.path)
+        for i, data in enumerate(files):
+            storage.put('%02d' % i, data)
+            self.assertEqual(storage.get('%02d' % i), data)
+            with storage.open('%02d' % i) as file_p:
+                self.assertEqual(''.join(file_p), data)
+            self.assertEqual(storage.get_head('%02d' % i),
+                data[:data.index('\n\n') + 2])
+        (skeleton0, index0), (skeleton1, index1) = (storage.get_split('00'),
+            storage.get_split('01'))
+        self.assertEqual(len(index0), 1)
+        self.assertEqual(index0[0][2], index1[0][2])
+        self.assertLess(len(skeleton0), 1024)
+        self.assertTrue(storage.parts.exists(index0[0][2]))
+        self.assertFalse(storage.exists(index0[0][2]))
+
+    @unittest.skipIf(mock_s3 is None, 'moto is not installed')
+    def test_s3(self):
+        'Test S3 storage'
+        with mock_s3():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket='emails')
+            self.check_storage(S3Storage('test', client=client,
+                    bucket='emails'))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         ElectronicMailTestCase))
-    return suite
\ No newline at end of file
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        AsyncSenderTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        CacheTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        CharsetTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        MetricsTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        SenderTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        StorageTestCase))
+    return suite